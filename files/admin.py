@@ -2,23 +2,31 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
 from django.contrib.auth.models import User
 
-from django.http import HttpResponse
-import csv
-from django.core.mail import send_mail
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import path, reverse
+from django.utils.html import format_html
 from django.contrib import messages
-import random, string
 from django.conf import settings
-from .models import FileUpload, StudentProfile
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import F
+from django.utils.decorators import method_decorator
+from django.utils.functional import cached_property
+import hashlib
+import io
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import get_object_or_404, redirect, render
+from django.views.decorators.http import require_http_methods, require_POST
+from .models import LEVEL_CHOICES, FileUpload, StudentProfile, UploadSession
+from . import catalog
+from . import chunked
+from . import rollups
+from . import exports
+from . import ingest
+from . import passwords
+from .forms import BulkUploadForm
 
-# openpyxl is optional; fall back to CSV export if not installed
-try:
-    from openpyxl import Workbook
-    from openpyxl.utils import get_column_letter
-    OPENPYXL_AVAILABLE = True
-except Exception:
-    Workbook = None
-    get_column_letter = None
-    OPENPYXL_AVAILABLE = False
 
 
 @admin.register(FileUpload)
@@ -27,6 +35,7 @@ class FileUploadAdmin(admin.ModelAdmin):
     list_filter = ('level', 'semester', 'category', 'archived')
     actions = ('archive_selected',)
     search_fields = ('title',)
+    readonly_fields = ('size', 'content_type', 'extension', 'checksum')
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         # Show only staff users in the uploaded_by dropdown
@@ -38,8 +47,181 @@ class FileUploadAdmin(admin.ModelAdmin):
             obj.uploaded_by = request.user
         super().save_model(request, obj, form, change)
 
+    def get_urls(self):
+        urls = [
+            path('bulk-upload/', self.admin_site.admin_view(self.bulk_upload_view), name='files_fileupload_bulk_upload'),
+            path('downloads/', self.admin_site.admin_view(self.downloads_view), name='files_fileupload_downloads'),
+            path('chunked/', self.admin_site.admin_view(self.chunked_start_view), name='files_fileupload_chunked_start'),
+            path('chunked/<uuid:token>/', self.admin_site.admin_view(self.chunked_session_view), name='files_fileupload_chunked'),
+            path('chunked/<uuid:token>/complete/', self.admin_site.admin_view(self.chunked_complete_view), name='files_fileupload_chunked_complete'),
+        ]
+        return urls + super().get_urls()
+
+    DASHBOARD_PERIODS = (7, 30, 90, 365)
+
+    def downloads_view(self, request):
+        # Download statistics from the daily rollups (`manage.py rollup_downloads`);
+        # never reads the raw event log.
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        try:
+            days = int(request.GET.get('days', 30))
+        except ValueError:
+            days = 30
+        if days not in self.DASHBOARD_PERIODS:
+            days = 30
+        try:
+            level = int(request.GET['level'])
+        except (KeyError, ValueError):
+            level = None
+        data = rollups.dashboard(days=days, level=level)
+        titles = FileUpload.objects.only('title').in_bulk([row['file_id'] for row in data['top_files']])
+        for row in data['top_files']:
+            obj = titles.get(row['file_id'])
+            row['title'] = obj.title if obj else f'Deleted file #{row["file_id"]}'
+            row['exists'] = obj is not None
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Downloads',
+            opts=self.model._meta,
+            days=days,
+            periods=self.DASHBOARD_PERIODS,
+            level=level,
+            level_choices=LEVEL_CHOICES,
+            **data,
+        )
+        return render(request, 'admin/files/fileupload/downloads.html', context)
+
+    def render_change_form(self, request, context, add=False, change=False, form_url='', obj=None):
+        # The add form sends large files in chunks (static/files/chunked_upload.js).
+        context.update(chunk_size=chunked.chunk_size(), chunked_max_size=chunked.max_size())
+        return super().render_change_form(request, context, add, change, form_url, obj)
+
+    # Resumable chunked uploads (see files/chunked.py). JSON in and out; the
+    # session belongs to the staff user who started it.
+
+    def _chunked_session(self, request, token):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        session = get_object_or_404(UploadSession, token=token)
+        if session.created_by_id != request.user.pk and not request.user.is_superuser:
+            raise PermissionDenied
+        return session
+
+    def _session_json(self, session, status=200):
+        return JsonResponse({
+            'upload_id': session.token.hex,
+            'filename': session.filename,
+            'size': session.size,
+            'chunk_size': session.chunk_size,
+            'offset': session.received,
+            'complete': session.complete,
+            'url': reverse('admin:files_fileupload_chunked', args=[session.token]),
+        }, status=status)
+
+    @method_decorator(require_POST)
+    def chunked_start_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        try:
+            session = chunked.start(request.POST.get('filename'), request.POST.get('size'), request.user)
+        except chunked.ChunkError as exc:
+            return JsonResponse({'error': str(exc)}, status=exc.status)
+        return self._session_json(session, status=201)
+
+    @method_decorator(require_http_methods(['GET', 'PUT', 'DELETE']))
+    def chunked_session_view(self, request, token):
+        # GET: where to resume. PUT: one chunk, raw bytes, at X-Chunk-Offset
+        # with an optional X-Chunk-SHA256. DELETE: abandon the upload.
+        session = self._chunked_session(request, token)
+        if request.method == 'DELETE':
+            chunked.discard(session)
+            return HttpResponse(status=204)
+        if request.method == 'PUT':
+            try:
+                offset = int(request.headers.get('X-Chunk-Offset', ''))
+                length = int(request.headers.get('Content-Length', ''))
+            except ValueError:
+                return JsonResponse({'error': 'X-Chunk-Offset and Content-Length are required.'}, status=411)
+            try:
+                # Read from the request stream, never request.body: the chunk
+                # goes to disk without being held in memory.
+                chunked.write_chunk(session, offset, length, request, request.headers.get('X-Chunk-SHA256', ''))
+            except chunked.ChunkError as exc:
+                session.refresh_from_db()
+                return JsonResponse({'error': str(exc), 'offset': session.received}, status=exc.status)
+        return self._session_json(session)
+
+    @method_decorator(require_POST)
+    def chunked_complete_view(self, request, token):
+        # The rest of the add form is posted here and validated like a normal
+        # add, with the assembled file in place of the file field.
+        session = self._chunked_session(request, token)
+        try:
+            upload = chunked.assembled_file(session)
+        except chunked.ChunkError as exc:
+            return JsonResponse({'error': str(exc), 'offset': session.received}, status=exc.status)
+        try:
+            with transaction.atomic():
+                # Deleting the session claims it: a second request completing
+                # the same upload deletes nothing and gets a 409 instead of
+                # adding the file twice.
+                if not UploadSession.objects.filter(pk=session.pk, received=session.size).delete()[0]:
+                    return JsonResponse({'error': 'This upload has already been completed.'}, status=409)
+                form = self.get_form(request, None, change=False)(request.POST, {'file': upload})
+                if not form.is_valid():
+                    # Keep the session so the form can be corrected and sent again.
+                    transaction.set_rollback(True)
+                    return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+                obj = self.save_form(request, form, change=False)
+                self.save_model(request, obj, form, change=False)
+                self.save_related(request, form, [], change=False)
+                self.log_addition(request, obj, self.construct_change_message(request, form, [], add=True))
+        finally:
+            upload.close()
+        chunked.remove_part(session)
+        return JsonResponse({
+            'id': obj.pk,
+            'url': reverse('admin:files_fileupload_change', args=[obj.pk]),
+        }, status=201)
+
+    def bulk_upload_view(self, request):
+        # ZIP + metadata CSV, ingested like `manage.py ingest_files` but without
+        # a manifest: the uploaded ZIP only exists for this request, so there is
+        # no later run to resume. Imports too large for one request belong in
+        # the command, which can be re-run with its manifest.
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = BulkUploadForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            metadata = io.TextIOWrapper(form.cleaned_data['metadata'].file, encoding='utf-8-sig', newline='')
+            try:
+                rows = ingest.read_metadata(metadata)
+                result = ingest.ingest(
+                    form.cleaned_data['archive'], rows,
+                    uploaded_by=request.user, notify=form.cleaned_data['notify'],
+                )
+            except ingest.IngestError as exc:
+                form.add_error(None, str(exc))
+            else:
+                self.message_user(
+                    request,
+                    f'{len(result.created)} file(s) added in {result.seconds:.1f}s ({result.files_per_sec or 0} files/s).',
+                )
+                for filename, error in result.failed:
+                    self.message_user(request, f'{filename}: {error}', level=messages.ERROR)
+                return redirect('admin:files_fileupload_changelist')
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Bulk upload files',
+            form=form,
+            opts=self.model._meta,
+        )
+        return render(request, 'admin/files/fileupload/bulk_upload.html', context)
+
     def archive_selected(self, request, queryset):
-        updated = queryset.update(archived=True)
+        # Also invalidates the cached catalog, since update() sends no signals.
+        updated = catalog.archive_files(queryset)
         self.message_user(request, f'{updated} file(s) marked archived.')
     archive_selected.short_description = 'Mark selected files as archived'
 
@@ -52,24 +234,52 @@ class StudentProfileInline(admin.StackedInline):
     fields = ('middle_name', 'level')
 
 
+class CachedCountPaginator(Paginator):
+    """Paginator that reuses the row count of an identical query for a minute.
+
+    Paging through a large user table otherwise runs the same COUNT(*) on
+    every page view.
+    """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None:
+            return super().count
+        key = 'admin-count:' + hashlib.md5(str(query).encode()).hexdigest()
+        count = cache.get(key)
+        if count is None:
+            count = super().count
+            cache.set(key, count, int(getattr(settings, 'ADMIN_COUNT_CACHE_SECONDS', 60)))
+        return count
+
+
 class UserAdmin(DjangoUserAdmin):
     inlines = (StudentProfileInline,)
     list_display = ('username', 'email', 'first_name', 'middle_name_display', 'last_name', 'level_display', 'is_staff')
-    actions = ('make_staff', 'remove_staff', 'deactivate_users', 'activate_users', 'reset_passwords', 'export_selected_users_excel')
+    list_filter = DjangoUserAdmin.list_filter + ('studentprofile__level',)
+    # Skip the extra unfiltered COUNT(*) next to filtered results.
+    show_full_result_count = False
+    paginator = CachedCountPaginator
+
+    def get_queryset(self, request):
+        # Profile columns come from the same joined query, so the changelist
+        # doesn't fetch studentprofile once per row, and they can be sorted.
+        return super().get_queryset(request).annotate(
+            profile_middle_name=F('studentprofile__middle_name'),
+            profile_level=F('studentprofile__level'),
+        )
+    actions = ('make_staff', 'remove_staff', 'deactivate_users', 'activate_users', 'reset_passwords', 'export_selected_users_excel', 'export_selected_users_csv')
 
     def middle_name_display(self, obj):
-        try:
-            return obj.studentprofile.middle_name
-        except StudentProfile.DoesNotExist:
-            return ''
+        return obj.profile_middle_name or ''
     middle_name_display.short_description = 'Middle name'
+    middle_name_display.admin_order_field = 'profile_middle_name'
 
     def level_display(self, obj):
-        try:
-            return obj.studentprofile.level
-        except StudentProfile.DoesNotExist:
-            return ''
+        return obj.profile_level or ''
     level_display.short_description = 'Level'
+    level_display.admin_order_field = 'profile_level'
 
     def make_staff(self, request, queryset):
         updated = queryset.update(is_staff=True)
@@ -92,89 +302,93 @@ class UserAdmin(DjangoUserAdmin):
     activate_users.short_description = 'Activate selected users'
 
     def reset_passwords(self, request, queryset):
-        for user in queryset:
-            pwd = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
-            user.set_password(pwd)
-            user.save()
-            if user.email:
-                try:
-                    res = send_mail(
-                        'Your password has been reset',
-                        f'Hello {user.username},\n\nYour password has been reset by an admin. Temporary password: {pwd}\nPlease login and change your password.',
-                        settings.DEFAULT_FROM_EMAIL,
-                        [user.email],
-                        fail_silently=False,
-                    )
-                    # do not log password-reset emails to EmailLog
-                except Exception as exc:
-                    # swallow/logging handled by server; do not create EmailLog entries
-                    pass
-        self.message_user(request, 'Selected users have been reset and (if they have an email) notified.')
+        # Small selections are reset right away; larger ones in the background
+        # with a progress page, since hashing takes a while per user.
+        threshold = int(getattr(settings, 'PASSWORD_RESET_ASYNC_THRESHOLD', 50))
+        if queryset.count() > threshold:
+            token = passwords.start_reset(queryset)
+            url = reverse('admin:auth_user_reset_progress', args=[token])
+            self.message_user(request, format_html(
+                'Password reset started. <a href="{}">Follow its progress</a>.', url,
+            ))
+            return
+        result = passwords.reset_passwords(queryset)
+        message = f"{result['reset']} user(s) reset and {result['emailed']} notified."
+        if result['email_failed']:
+            message += f" {result['email_failed']} email(s) could not be sent."
+        self.message_user(request, message)
     reset_passwords.short_description = 'Reset password for selected users and email them'
 
+    def reset_progress_view(self, request, token):
+        if not self.has_change_permission(request):
+            raise Http404
+        state = passwords.get_progress(token)
+        if state is None:
+            raise Http404('Unknown password reset')
+        return JsonResponse(state)
+
+    def _export(self, request, queryset, fmt):
+        # Large selections are written in the background; the admin gets a link.
+        threshold = int(getattr(settings, 'EXPORT_ASYNC_THRESHOLD', 5000))
+        if queryset.count() > threshold:
+            token = exports.start_export(queryset, fmt)
+            url = reverse('admin:auth_user_export_download', args=[token, fmt])
+            self.message_user(request, format_html(
+                'The export is being prepared. <a href="{}">Download it when ready</a>.', url,
+            ))
+            return None
+
+        filename = f'users_export.{fmt}'
+        if fmt == 'csv':
+            response = StreamingHttpResponse(exports.iter_csv(queryset), content_type=exports.CONTENT_TYPES['csv'])
+            response['Content-Disposition'] = f'attachment; filename={filename}'
+            return response
+        return FileResponse(
+            exports.xlsx_file(queryset), as_attachment=True, filename=filename,
+            content_type=exports.CONTENT_TYPES['xlsx'],
+        )
+
     def export_selected_users_excel(self, request, queryset):
         # If openpyxl is not available, fall back to CSV
-        if not OPENPYXL_AVAILABLE:
-            response = HttpResponse(content_type='text/csv')
-            response['Content-Disposition'] = 'attachment; filename=users_export.csv'
-            writer = csv.writer(response)
-            headers = ['id', 'username', 'email', 'first_name', 'middle_name', 'last_name', 'is_active', 'is_staff']
-            writer.writerow(headers)
-            for user in queryset:
-                try:
-                    middle = user.studentprofile.middle_name
-                except StudentProfile.DoesNotExist:
-                    middle = ''
-                row = [
-                    user.pk,
-                    user.username,
-                    user.email,
-                    user.first_name,
-                    middle,
-                    user.last_name,
-                    'yes' if user.is_active else 'no',
-                    'yes' if user.is_staff else 'no',
-                ]
-                writer.writerow(row)
-            return response
+        return self._export(request, queryset, 'xlsx' if exports.OPENPYXL_AVAILABLE else 'csv')
+    export_selected_users_excel.short_description = 'Export selected users to Excel (.xlsx)'
 
-        wb = Workbook()
-        ws = wb.active
-        headers = ['id', 'username', 'email', 'first_name', 'middle_name', 'last_name', 'is_active', 'is_staff']
-        ws.append(headers)
-        for user in queryset:
-            try:
-                middle = user.studentprofile.middle_name
-            except StudentProfile.DoesNotExist:
-                middle = ''
-            row = [
-                user.pk,
-                user.username,
-                user.email,
-                user.first_name,
-                middle,
-                user.last_name,
-                'yes' if user.is_active else 'no',
-                'yes' if user.is_staff else 'no',
-            ]
-            ws.append(row)
-
-        # Adjust column widths
-        for i, col in enumerate(ws.columns, 1):
-            max_length = 0
-            for cell in col:
-                try:
-                    if cell.value:
-                        max_length = max(max_length, len(str(cell.value)))
-                except Exception:
-                    pass
-            ws.column_dimensions[get_column_letter(i)].width = min(50, (max_length + 2))
-
-        response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-        response['Content-Disposition'] = 'attachment; filename=users_export.xlsx'
-        wb.save(response)
+    def export_selected_users_csv(self, request, queryset):
+        return self._export(request, queryset, 'csv')
+    export_selected_users_csv.short_description = 'Export selected users to CSV'
+
+    def get_urls(self):
+        urls = [
+            path(
+                'reset-progress/<str:token>/',
+                self.admin_site.admin_view(self.reset_progress_view),
+                name='auth_user_reset_progress',
+            ),
+            path(
+                'export/<str:token>/<str:fmt>/',
+                self.admin_site.admin_view(self.export_download_view),
+                name='auth_user_export_download',
+            ),
+        ]
+        return urls + super().get_urls()
+
+    def export_download_view(self, request, token, fmt):
+        # Serves a background export once written; until then says so and refreshes.
+        if not self.has_view_permission(request):
+            raise Http404
+        status = exports.export_status(token, fmt)
+        if status is None:
+            raise Http404('Unknown export')
+        if status == 'ready':
+            return FileResponse(
+                open(exports.export_path(token, fmt), 'rb'), as_attachment=True,
+                filename=f'users_export.{fmt}', content_type=exports.CONTENT_TYPES[fmt],
+            )
+        if status == 'failed':
+            return HttpResponse('The export failed; see the server log.', status=500, content_type='text/plain')
+        response = HttpResponse('The export is still being prepared. This page will refresh.', status=202, content_type='text/plain')
+        response['Refresh'] = '5'
         return response
-    export_selected_users_excel.short_description = 'Export selected users to Excel (.xlsx)'
 
 
 # Register the custom User admin
@@ -12,3 +12,4 @@ class FilesConfig(AppConfig):
             from . import signals  # noqa: F401
         except Exception:
             pass
+        from . import checks  # noqa: F401
@@ -0,0 +1,251 @@
+"""Scheduled online snapshots of the SQLite database.
+
+Snapshots are taken with SQLite's online backup API (a consistent copy even
+while other connections write), gzip-compressed into DB_BACKUP_DIR as
+`db_snapshot_<timestamp>.sqlite3.gz`, and pruned to the newest DB_BACKUP_KEEP.
+A snapshot is skipped when the database hasn't changed since the last one.
+
+Views call `note_write()` after a write worth protecting; that only bumps a
+counter. A background thread, started with each worker's first request,
+takes a snapshot every DB_BACKUP_INTERVAL seconds or after DB_BACKUP_WRITES
+noted writes, whichever comes first. Set DB_BACKUP_IN_PROCESS = False to run
+`manage.py backup_db --loop` (or cron) instead.
+
+Only one process snapshots at a time (a lock file in DB_BACKUP_DIR). The
+holder touches the lock while it copies; a lock untouched for
+DB_BACKUP_LOCK_STALE seconds is assumed to belong to a crashed process.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PREFIX = 'db_snapshot_'
+SNAPSHOT_SUFFIX = '.sqlite3.gz'
+_STATE_FILE = '.last_snapshot.json'
+_LOCK_FILE = '.snapshot.lock'
+# How often the lock holder touches the lock file while copying.
+_LOCK_REFRESH_SECONDS = 5
+
+_lock = threading.Lock()
+_wake = threading.Event()
+_writes = 0
+# pid of the process running the scheduler thread (threads don't survive fork).
+_scheduler_pid = None
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def backup_dir():
+    return Path(_setting('DB_BACKUP_DIR', Path(settings.BASE_DIR) / 'db_backups'))
+
+
+def database_path():
+    """Path of the default SQLite database, or None for other backends."""
+    db = settings.DATABASES.get('default', {})
+    if 'sqlite3' not in db.get('ENGINE', '') or not db.get('NAME'):
+        return None
+    path = str(db['NAME'])
+    if path == ':memory:' or path.startswith('file:'):
+        return None
+    return path
+
+
+def _fingerprint(db_path):
+    # Cheap change detector: size and mtime of the database and its WAL file.
+    parts = []
+    for path in (db_path, db_path + '-wal'):
+        try:
+            st = os.stat(path)
+            parts.append([st.st_size, st.st_mtime_ns])
+        except OSError:
+            parts.append(None)
+    return parts
+
+
+def _read_state(directory):
+    try:
+        with open(directory / _STATE_FILE) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def _acquire_file_lock(directory):
+    # Several worker processes may schedule snapshots; only one runs at a time.
+    path = directory / _LOCK_FILE
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - path.stat().st_mtime < float(_setting('DB_BACKUP_LOCK_STALE', 600)):
+                return None
+            path.unlink()
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return None
+    os.close(fd)
+    return path
+
+
+def _lock_refresher(lock):
+    # Returns a callable that touches `lock` (at most every few seconds) so a
+    # long copy isn't mistaken for a crashed one and taken over mid-write.
+    last = time.monotonic()
+
+    def refresh(*args):
+        nonlocal last
+        now = time.monotonic()
+        if now - last >= _LOCK_REFRESH_SECONDS:
+            last = now
+            try:
+                os.utime(lock)
+            except OSError:
+                pass
+    return refresh
+
+
+def snapshot(force=False):
+    """Take a compressed snapshot; return its path, or None if skipped."""
+    db_path = database_path()
+    if not db_path or not os.path.exists(db_path):
+        return None
+    directory = backup_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    lock = _acquire_file_lock(directory)
+    if lock is None:
+        return None
+    tmp_path = directory / f'.snapshot-{os.getpid()}.tmp'
+    refresh = _lock_refresher(lock)
+    try:
+        state = _read_state(directory)
+        fingerprint = _fingerprint(db_path)
+        if not force and state.get('fingerprint') == fingerprint:
+            return None
+
+        src = sqlite3.connect(Path(db_path).resolve().as_uri() + '?mode=ro', uri=True)
+        dst = sqlite3.connect(str(tmp_path))
+        try:
+            # Copy in steps so writers are only blocked for a few pages at a time.
+            src.backup(dst, pages=1024, sleep=0.005, progress=refresh)
+        finally:
+            dst.close()
+            src.close()
+
+        digest = hashlib.sha256()
+        with open(tmp_path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+                digest.update(chunk)
+                refresh()
+        digest = digest.hexdigest()
+        if not force and state.get('sha256') == digest:
+            # Files were touched but the contents are identical.
+            tmp_path.unlink()
+            _write_state(directory, dict(state, fingerprint=fingerprint))
+            return None
+
+        ts = timezone.now().strftime('%Y%m%dT%H%M%S%fZ')
+        target = directory / f'{SNAPSHOT_PREFIX}{ts}{SNAPSHOT_SUFFIX}'
+        with open(tmp_path, 'rb') as src_fh, gzip.open(target, 'wb', compresslevel=6) as dst_fh:
+            for chunk in iter(lambda: src_fh.read(1024 * 1024), b''):
+                dst_fh.write(chunk)
+                refresh()
+        tmp_path.unlink()
+        _write_state(directory, {'fingerprint': fingerprint, 'sha256': digest, 'file': target.name})
+        prune(directory)
+        return target
+    finally:
+        for path in (tmp_path, lock):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def _write_state(directory, state):
+    tmp = directory / (_STATE_FILE + '.tmp')
+    with open(tmp, 'w') as fh:
+        json.dump(state, fh)
+    os.replace(tmp, directory / _STATE_FILE)
+
+
+def prune(directory=None):
+    """Delete all but the newest DB_BACKUP_KEEP snapshots; return the removed paths."""
+    directory = directory or backup_dir()
+    keep = max(1, int(_setting('DB_BACKUP_KEEP', 20)))
+    snapshots = sorted(directory.glob(f'{SNAPSHOT_PREFIX}*{SNAPSHOT_SUFFIX}'))
+    removed = snapshots[:-keep]
+    for path in removed:
+        try:
+            path.unlink()
+        except OSError:
+            logger.warning('Could not remove old snapshot %s', path)
+    return removed
+
+
+def _in_process():
+    return _setting('DB_BACKUP_IN_PROCESS', True) and database_path()
+
+
+def start():
+    """Start this process's snapshot scheduler if it isn't running yet.
+
+    Connected to request_started, so the interval snapshots run in every
+    worker that serves requests, whether or not anything calls note_write().
+    """
+    if _in_process():
+        _ensure_scheduler()
+
+
+def note_write():
+    """Record a database write; a snapshot follows in the background when due."""
+    global _writes
+    if not _in_process():
+        return
+    with _lock:
+        _writes += 1
+        due = _writes >= int(_setting('DB_BACKUP_WRITES', 50))
+    _ensure_scheduler()
+    if due:
+        _wake.set()
+
+
+def _scheduler():
+    global _writes
+    while True:
+        _wake.wait(timeout=float(_setting('DB_BACKUP_INTERVAL', 3600)))
+        _wake.clear()
+        with _lock:
+            _writes = 0
+        started = time.perf_counter()
+        try:
+            snapshot()
+        except Exception:
+            logger.exception('Database snapshot failed')
+        metrics.observe_task('db_snapshot', time.perf_counter() - started)
+
+
+def _ensure_scheduler():
+    global _scheduler_pid
+    pid = os.getpid()
+    if _scheduler_pid == pid:
+        return
+    with _lock:
+        if _scheduler_pid == pid:
+            return
+        _scheduler_pid = pid
+    threading.Thread(target=_scheduler, name='db-snapshot-scheduler', daemon=True).start()
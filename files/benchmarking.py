@@ -0,0 +1,197 @@
+"""Helpers shared by the `bench` and `bench_*` management commands."""
+import datetime
+import hashlib
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+from django.utils import timezone
+
+
+@contextmanager
+def temporary_database():
+    """Run the block against a freshly migrated throwaway database.
+
+    Works like the test runner's database setup, except that SQLite uses a
+    file on disk (not the in-memory default) so locking behaves as it does
+    in production.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='bench-db-')
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_name = test_settings.get('NAME')
+    if connection.vendor == 'sqlite':
+        test_settings['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+    old_config = setup_databases(verbosity=0, interactive=False, aliases={'default'}, serialized_aliases=set())
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+        test_settings['NAME'] = old_name
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def percentiles(samples):
+    """Return p50/p95/p99/max (in milliseconds) for a list of durations in seconds."""
+    if not samples:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    ordered = sorted(samples)
+    if len(ordered) > 1:
+        cuts = statistics.quantiles(ordered, n=100, method='inclusive')
+    else:
+        cuts = ordered * 99
+
+    def ms(value):
+        return round(value * 1000, 3)
+
+    return {'p50': ms(cuts[49]), 'p95': ms(cuts[94]), 'p99': ms(cuts[98]), 'max': ms(ordered[-1])}
+
+
+def seed_uploads(count, file_name='uploads/bench.txt', archived_ratio=0.1, days=730, batch_size=5000, seed=0,
+                 files=None):
+    """Bulk-insert `count` FileUpload rows spread over levels, categories,
+    semesters and the last `days` days, all pointing at `file_name`.
+
+    `files` is an optional list of dicts (name, size, content_type,
+    extension) for stored files to spread the rows over instead.
+    bulk_create sends no signals, so nothing is indexed or notified.
+    """
+    from .models import CATEGORY_CHOICES, LEVEL_CHOICES, SEMESTER_CHOICES, FileUpload
+
+    rng = random.Random(seed)
+    levels = [k for k, _ in LEVEL_CHOICES]
+    categories = [k for k, _ in CATEGORY_CHOICES]
+    semesters = [k for k, _ in SEMESTER_CHOICES]
+    files = files or [{'name': file_name, 'size': 1024, 'content_type': 'text/plain', 'extension': 'txt'}]
+    now = timezone.now()
+    field = FileUpload._meta.get_field('uploaded_at')
+    # auto_now_add would stamp every row with the same time.
+    field.auto_now_add = False
+    try:
+        for offset in range(0, count, batch_size):
+            batch = []
+            for i in range(offset, min(count, offset + batch_size)):
+                stored = rng.choice(files)
+                batch.append(FileUpload(
+                    title=f'Bench file {i}',
+                    file=stored['name'],
+                    level=rng.choice(levels),
+                    category=rng.choice(categories),
+                    semester=rng.choice(semesters),
+                    archived=rng.random() < archived_ratio,
+                    uploaded_at=now - datetime.timedelta(seconds=rng.randrange(days * 86400)),
+                    size=stored['size'],
+                    content_type=stored['content_type'],
+                    extension=stored['extension'],
+                    checksum=stored.get('checksum', ''),
+                ))
+            FileUpload.objects.bulk_create(batch)
+    finally:
+        field.auto_now_add = True
+
+
+def seed_users(count, password, batch_size=2000, seed=0):
+    """Bulk-insert `count` users (bench0, bench1, ...) with student profiles.
+
+    The password is hashed once and shared, so seeding stays fast while
+    logins still pay the real hashing cost.
+    """
+    from django.contrib.auth.hashers import make_password
+    from django.contrib.auth.models import User
+    from .models import LEVEL_CHOICES, StudentProfile
+
+    rng = random.Random(seed)
+    levels = [k for k, _ in LEVEL_CHOICES]
+    password_hash = make_password(password)
+    for offset in range(0, count, batch_size):
+        users = User.objects.bulk_create([
+            User(
+                username=f'bench{i}', email=f'bench{i}@example.com', password=password_hash,
+                first_name='Bench', last_name=f'User{i}',
+            )
+            for i in range(offset, min(count, offset + batch_size))
+        ])
+        StudentProfile.objects.bulk_create([
+            StudentProfile(user=user, middle_name='B', level=rng.choice(levels)) for user in users
+        ])
+    return [f'bench{i}' for i in range(count)]
+
+
+def write_sample_files(directory, count, sizes, seed=0):
+    """Write `count` files of mixed sizes (bytes, cycled from `sizes`) under
+    `directory`/uploads and return their descriptions for seed_uploads()."""
+    rng = random.Random(seed)
+    kinds = [('pdf', 'application/pdf'), ('txt', 'text/plain'), ('jpg', 'image/jpeg'), ('docx',
+             'application/vnd.openxmlformats-officedocument.wordprocessingml.document')]
+    os.makedirs(os.path.join(directory, 'uploads'), exist_ok=True)
+    files = []
+    for i in range(count):
+        size = sizes[i % len(sizes)]
+        extension, content_type = kinds[i % len(kinds)]
+        name = f'uploads/bench_{i}.{extension}'
+        data = rng.randbytes(size)
+        with open(os.path.join(directory, name), 'wb') as fh:
+            fh.write(data)
+        files.append({
+            'name': name, 'size': size, 'content_type': content_type, 'extension': extension,
+            'checksum': hashlib.sha256(data).hexdigest(),
+        })
+    return files
+
+
+def sqlite_write_worker(db_path, db_options, ops, seed, barrier, results):
+    """One process of `manage.py bench_sqlite_writes`.
+
+    Runs a mix of the writes the site does under load against `db_path` with
+    the given DATABASES OPTIONS and puts its timings on `results`. Runs in a
+    spawned child, so it sets Django up itself.
+    """
+    import django
+    django.setup()
+    from django.contrib.auth.models import User
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.db import OperationalError, connection, transaction
+    from django.db.models import F
+    from .models import FileUpload, StudentProfile
+
+    connection.close()
+    connection.settings_dict.update(NAME=db_path, OPTIONS=dict(db_options))
+    rng = random.Random(seed)
+    pks = list(FileUpload.objects.values_list('pk', flat=True))
+
+    def login():
+        # Session row written in a transaction, like django.contrib.auth.login().
+        session = SessionStore()
+        session['_auth_user_id'] = str(rng.randrange(1, 1000))
+        session.save()
+
+    def download():
+        FileUpload.objects.filter(pk=rng.choice(pks)).update(download_count=F('download_count') + 1)
+
+    def register():
+        # Read then write in one transaction, like StudentRegistrationForm.save().
+        username = f'w{seed}-{rng.getrandbits(48):x}'
+        with transaction.atomic():
+            if not User.objects.filter(username=username).exists():
+                user = User.objects.create(username=username, password='!')
+                StudentProfile.objects.create(user=user, level=rng.randint(1, 5))
+
+    operations = [login, login, download, download, download, register]
+    latencies, errors = [], 0
+    barrier.wait()
+    started = time.perf_counter()
+    for _ in range(ops):
+        op_started = time.perf_counter()
+        try:
+            rng.choice(operations)()
+        except OperationalError:
+            errors += 1
+        latencies.append(time.perf_counter() - op_started)
+    elapsed = time.perf_counter() - started
+    connection.close()
+    results.put({'latencies': latencies, 'errors': errors, 'seconds': elapsed})
@@ -0,0 +1,86 @@
+"""Content-addressed storage for uploads.
+
+Every distinct file body (by SHA-256) is stored once and recorded as a Blob;
+FileUpload rows with the same contents point `file` at the same storage name.
+`claim()` is called when a file is attached, in the transaction that saves
+the row, and `release()` when a row is deleted or its file replaced. The
+stored file is removed once the last reference is released.
+
+Files stored before blobs existed have no Blob row and are never deleted by
+`release()`; `manage.py dedupe_files` collapses them and creates their blobs.
+"""
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .models import Blob
+
+logger = logging.getLogger(__name__)
+
+
+def _reuse(checksum):
+    # Take a reference on an existing blob; None if there is no live one.
+    with transaction.atomic():
+        blob = Blob.objects.filter(sha256=checksum).values_list('pk', 'name').first()
+        if blob and Blob.objects.filter(pk=blob[0], refcount__gt=0).update(refcount=F('refcount') + 1):
+            return blob[1]
+    return None
+
+
+def find(checksum):
+    """Return the storage name of the live blob with `checksum`, or None."""
+    if not checksum:
+        return None
+    return Blob.objects.filter(sha256=checksum, refcount__gt=0).values_list('name', flat=True).first()
+
+
+def claim(storage, checksum, size, store):
+    """Return `(name, reused)` for contents with `checksum`.
+
+    An existing blob gets one more reference; otherwise `store()` saves the
+    file and returns its storage name, which becomes a new blob. Without a
+    checksum the file is simply stored.
+    """
+    if not checksum:
+        return store(), False
+    name = _reuse(checksum)
+    if name:
+        return name, True
+    name = store()
+    try:
+        with transaction.atomic():
+            Blob.objects.create(sha256=checksum, name=name, size=size, refcount=1)
+        return name, False
+    except IntegrityError:
+        pass
+    except Exception:
+        storage.delete(name)
+        raise
+    # Another upload of the same contents won the race: use its copy.
+    existing = _reuse(checksum)
+    if existing is None:
+        logger.warning('Could not register blob %s for %s; keeping it unshared', checksum, name)
+        return name, False
+    storage.delete(name)
+    return existing, True
+
+
+def release(storage, name):
+    """Drop one reference to `name`; delete the stored file after the last one."""
+    if not name:
+        return
+    with transaction.atomic():
+        if not Blob.objects.filter(name=name, refcount__gt=0).update(refcount=F('refcount') - 1):
+            return  # not a blob (stored before deduplication)
+        deleted, _ = Blob.objects.filter(name=name, refcount=0).delete()
+        if deleted:
+            # Only once the rows pointing at it are gone for good.
+            transaction.on_commit(lambda: _delete(storage, name))
+
+
+def _delete(storage, name):
+    try:
+        storage.delete(name)
+    except Exception:
+        logger.exception('Could not delete unreferenced file %s', name)
@@ -0,0 +1,145 @@
+"""Cached catalog pages for the home page and its filters.
+
+`files.views.index` renders each page of date-grouped cards once per filter
+combination and cursor and keeps the HTML in the cache. Keys include the
+catalog version, a single database row that is bumped whenever an upload is
+saved, deleted or archived (see files/signals.py and the `archive_selected`
+admin action). Because the version lives in the database rather than in the
+cache, every gunicorn worker sees a change on its next request even with a
+per-process local-memory cache; stale entries simply stop being read and
+expire after CATALOG_CACHE_TTL seconds.
+
+Download counts on the cards are not catalog changes, so they can lag by up
+to CATALOG_CACHE_TTL.
+
+The filter dropdowns show how many visible files match each option. Counts
+per (level, category, semester) combination come from one grouped aggregate,
+cached together with the version they describe. Adding or archiving files
+adjusts the cached counts in place (`apply_delta`); any other change, or a
+process whose cache missed an update, recomputes them on the next read.
+"""
+import hashlib
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F
+
+from .models import CatalogVersion, FileUpload
+
+KEY_PREFIX = 'catalog'
+FACETS_KEY = f'{KEY_PREFIX}:facets'
+# FileUpload columns that appear on (or select) catalog cards. A save limited
+# to other columns (download_count, checksum, ...) leaves the cache valid.
+CATALOG_FIELDS = frozenset({
+    'title', 'level', 'category', 'semester', 'archived', 'uploaded_at', 'uploaded_by',
+    'file', 'original_name', 'size', 'content_type', 'extension', 'thumbnail',
+})
+
+
+def current_version():
+    """Return the catalog version (one primary-key lookup)."""
+    version = CatalogVersion.objects.filter(pk=1).values_list('version', flat=True).first()
+    return version or 0
+
+
+def bump_version():
+    """Invalidate every cached catalog page; return the new version."""
+    with transaction.atomic():
+        # The row stays locked until commit, so the value read back is ours.
+        if not CatalogVersion.objects.filter(pk=1).update(version=F('version') + 1):
+            CatalogVersion.objects.get_or_create(pk=1, defaults={'version': 1})
+        return current_version()
+
+
+def page_key(version, level, category, semester, after):
+    # `after` comes from the query string, so hash it rather than trust its length.
+    raw = f'{level}:{category}:{semester}:{after or ""}'
+    return f'{KEY_PREFIX}:{version}:{hashlib.md5(raw.encode()).hexdigest()}'
+
+
+def get_page(version, level, category, semester, after):
+    """Return the cached page HTML, or None."""
+    if ttl() <= 0:
+        return None
+    return cache.get(page_key(version, level, category, semester, after))
+
+
+def set_page(version, level, category, semester, after, html):
+    if ttl() > 0:
+        cache.set(page_key(version, level, category, semester, after), html, ttl())
+
+
+def ttl():
+    # 0 disables the catalog cache.
+    return int(getattr(settings, 'CATALOG_CACHE_TTL', 600))
+
+
+def _grouped_counts(queryset):
+    rows = queryset.values_list('level', 'category', 'semester').annotate(n=Count('pk')).order_by()
+    return {(level, category, semester): n for level, category, semester, n in rows}
+
+
+def combination_counts(version):
+    """Return {(level, category, semester): count} for visible files."""
+    cached = cache.get(FACETS_KEY)
+    if cached and cached['version'] == version:
+        return cached['counts']
+    counts = _grouped_counts(FileUpload.objects.filter(archived=False))
+    # Kept until replaced; the stored version says whether it is current.
+    cache.set(FACETS_KEY, {'version': version, 'counts': counts}, None)
+    return counts
+
+
+def apply_delta(version, deltas):
+    """After commit, add `deltas` ({combination: +/-n}) to the counts cached for version - 1."""
+    def apply():
+        cached = cache.get(FACETS_KEY)
+        if not cached or cached['version'] != version - 1:
+            # Cache is missing or another change came between; recompute lazily.
+            return
+        counts = dict(cached['counts'])
+        for key, n in deltas.items():
+            counts[key] = counts.get(key, 0) + n
+            if counts[key] <= 0:
+                del counts[key]
+        cache.set(FACETS_KEY, {'version': version, 'counts': counts}, None)
+    transaction.on_commit(apply)
+
+
+def archive_files(queryset):
+    """Archive the files in `queryset`; return how many were archived."""
+    visible = queryset.filter(archived=False)
+    with transaction.atomic():
+        removed = _grouped_counts(visible)
+        updated = visible.update(archived=True)
+        # update() sends no signals, so invalidate the cached catalog here.
+        version = bump_version()
+    apply_delta(version, {key: -n for key, n in removed.items()})
+    return updated
+
+
+def facets(counts, level=None, category=None, semester=None):
+    """Per-option counts for each filter, given the other current filters.
+
+    Returns {'level': {1: n, ...}, 'category': {...}, 'semester': {...},
+    'total': n}, where e.g. the level counts respect the selected category
+    and semester but not the selected level.
+    """
+    result = {'level': defaultdict(int), 'category': defaultdict(int), 'semester': defaultdict(int), 'total': 0}
+    for (l, c, s), n in counts.items():
+        level_ok = level is None or l == level
+        category_ok = category is None or c == category
+        semester_ok = semester is None or s == semester
+        if category_ok and semester_ok:
+            result['level'][l] += n
+        if level_ok and semester_ok:
+            result['category'][c] += n
+        if level_ok and category_ok:
+            result['semester'][s] += n
+            if semester_ok:
+                result['total'] += n
+    for name in ('level', 'category', 'semester'):
+        result[name] = dict(result[name])
+    return result
@@ -0,0 +1,42 @@
+"""System checks for the files app."""
+from django.core.checks import Tags, Warning, register
+from django.db import connections
+
+
+def date_indexes():
+    """FileUpload indexes that contain a LocalDate (their SQL embeds TIME_ZONE)."""
+    from .models import FileUpload, LocalDate
+    return [
+        index for index in FileUpload._meta.indexes
+        if any(
+            isinstance(node, LocalDate)
+            for expression in index.expressions if hasattr(expression, 'flatten')  # F() has no subexpressions
+            for node in expression.flatten()
+        )
+    ]
+
+
+@register(Tags.database)
+def check_date_indexes(app_configs, databases=None, **kwargs):
+    # Runs with `migrate` and `check --database default`. An index built for
+    # another TIME_ZONE no longer matches the catalog queries, which then
+    # sort the whole table.
+    from .models import FileUpload
+    warnings = []
+    for alias in databases or ():
+        connection = connections[alias]
+        if connection.vendor != 'sqlite':
+            continue
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'")
+            built = dict(cursor.fetchall())
+        editor = connection.schema_editor()
+        for index in date_indexes():
+            if index.name in built and built[index.name] != str(index.create_sql(FileUpload, editor)):
+                warnings.append(Warning(
+                    f'Index {index.name} was built for a different TIME_ZONE.',
+                    hint='Run `python manage.py rebuild_date_indexes`.',
+                    obj=FileUpload,
+                    id='files.W001',
+                ))
+    return warnings
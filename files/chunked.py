@@ -0,0 +1,179 @@
+"""Resumable chunked uploads for large files.
+
+The admin add form (static/files/chunked_upload.js) sends big files in
+fixed-size chunks instead of one multipart POST:
+
+1. `start()` opens an UploadSession and an empty part file in
+   CHUNKED_UPLOAD_DIR.
+2. `write_chunk()` streams each chunk from the request straight into the
+   part file at its offset. A chunk must start where the previous one ended
+   and match its SHA-256 if one was sent; a bad chunk is cut off again. After
+   a disconnect the client asks for the session's `received` offset and
+   carries on from there.
+3. `assembled_file()` wraps the finished part file as an uploaded file for the
+   admin form. FileSystemStorage moves it into place and other backends read
+   it once, so the bytes are not copied a second time.
+
+Sessions untouched for CHUNKED_UPLOAD_EXPIRE_SECONDS are removed by `prune()`.
+"""
+import hashlib
+import logging
+import mimetypes
+import os
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.utils import timezone
+
+from .models import UploadSession
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+
+
+class ChunkError(Exception):
+    """A chunk was rejected; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def upload_dir():
+    return Path(getattr(settings, 'CHUNKED_UPLOAD_DIR', Path(settings.BASE_DIR) / 'upload_chunks'))
+
+
+def chunk_size():
+    return int(getattr(settings, 'CHUNKED_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+
+
+def max_size():
+    return int(getattr(settings, 'CHUNKED_UPLOAD_MAX_SIZE', 2 * 1024 ** 3))
+
+
+def part_path(session):
+    return upload_dir() / f'{session.token.hex}.part'
+
+
+def start(filename, size, user=None):
+    """Open a session for a file of `size` bytes."""
+    filename = os.path.basename(str(filename or '').replace('\\', '/')).strip()
+    if not filename:
+        raise ChunkError('A filename is required.')
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise ChunkError('A size in bytes is required.')
+    if size <= 0:
+        raise ChunkError('The file is empty.')
+    if size > max_size():
+        raise ChunkError(f'Files larger than {max_size()} bytes are not accepted.', status=413)
+    prune()
+    directory = upload_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    session = UploadSession.objects.create(
+        filename=filename[:255], size=size, chunk_size=chunk_size(), created_by=user,
+    )
+    part_path(session).touch()
+    return session
+
+
+def write_chunk(session, offset, length, stream, checksum=''):
+    """Append `length` bytes read from `stream` at `offset`; return the new offset."""
+    if offset != session.received:
+        raise ChunkError(f'Expected offset {session.received}.', status=409)
+    expected = min(session.chunk_size, session.size - offset)
+    if expected <= 0:
+        raise ChunkError('The upload is already complete.', status=409)
+    if length != expected:
+        raise ChunkError(f'This chunk must be {expected} bytes.')
+    path = part_path(session)
+    if not path.exists():
+        raise ChunkError('The upload has expired.', status=410)
+
+    digest = hashlib.sha256()
+    with open(path, 'r+b') as fh:
+        fh.seek(offset)
+        remaining = length
+        while remaining:
+            data = stream.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            digest.update(data)
+            fh.write(data)
+            remaining -= len(data)
+        if remaining or (checksum and digest.hexdigest() != checksum.lower()):
+            # Drop the partial or corrupt chunk so the retry starts clean.
+            fh.truncate(offset)
+            raise ChunkError('Chunk incomplete or checksum mismatch; resend it.')
+        fh.truncate(offset + length)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+    # Conditional on the old offset, so two clients can't both advance it.
+    updated = UploadSession.objects.filter(pk=session.pk, received=offset).update(
+        received=offset + length, updated_at=timezone.now(),
+    )
+    if not updated:
+        raise ChunkError('Another request wrote this chunk.', status=409)
+    session.received = offset + length
+    return session.received
+
+
+class AssembledUpload(UploadedFile):
+    """A finished part file, handed to the admin form like a regular upload."""
+
+    def __init__(self, path, name, size):
+        self._path = str(path)
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        super().__init__(open(path, 'rb'), name, content_type, size)
+        # Read once here so FileUpload.save() doesn't hash the file again.
+        self.sha256 = file_checksum(path)
+
+    def temporary_file_path(self):
+        # FileSystemStorage moves the file into MEDIA_ROOT instead of copying it.
+        return self._path
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for data in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def assembled_file(session):
+    if not session.complete:
+        raise ChunkError(f'Only {session.received} of {session.size} bytes received.', status=409)
+    path = part_path(session)
+    if not path.exists():
+        raise ChunkError('The upload has expired.', status=410)
+    return AssembledUpload(path, session.filename, session.size)
+
+
+def remove_part(session):
+    """Delete whatever is left of the session's part file."""
+    try:
+        part_path(session).unlink()
+    except FileNotFoundError:
+        pass
+    except OSError:
+        logger.warning('Could not delete %s', part_path(session), exc_info=True)
+
+
+def discard(session):
+    """Delete the session and whatever is left of its part file."""
+    remove_part(session)
+    session.delete()
+
+
+def prune():
+    """Remove sessions untouched for CHUNKED_UPLOAD_EXPIRE_SECONDS."""
+    keep = int(getattr(settings, 'CHUNKED_UPLOAD_EXPIRE_SECONDS', 86400))
+    cutoff = timezone.now() - timedelta(seconds=keep)
+    for session in UploadSession.objects.filter(updated_at__lt=cutoff):
+        discard(session)
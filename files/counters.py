@@ -0,0 +1,157 @@
+"""Write-behind buffer for download counts and the download event log.
+
+`record_download` only bumps an in-process counter and queues a
+DownloadEvent; a background thread flushes them every
+DOWNLOAD_COUNT_FLUSH_INTERVAL seconds (or once DOWNLOAD_COUNT_MAX_PENDING
+downloads have accumulated): atomic `F('download_count') + n` updates plus
+one `bulk_create` of the events, inside a single transaction. Pending
+downloads are also flushed when the process exits. Set the interval to 0 to
+write every download straight through.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pending = Counter()
+_events = []  # unsaved DownloadEvent rows, in order
+_pending_total = 0
+_last_flush = time.monotonic()
+# pid of the process that started the flusher thread (threads don't survive fork).
+_flusher_pid = None
+
+
+def flush_interval():
+    return float(getattr(settings, 'DOWNLOAD_COUNT_FLUSH_INTERVAL', 5.0))
+
+
+def max_pending():
+    return int(getattr(settings, 'DOWNLOAD_COUNT_MAX_PENDING', 500))
+
+
+def _write(counts, events):
+    from .models import DownloadEvent, FileUpload
+    with transaction.atomic():
+        for pk, n in counts.items():
+            FileUpload.objects.filter(pk=pk).update(download_count=F('download_count') + n)
+        DownloadEvent.objects.bulk_create(events, batch_size=500)
+
+
+def _event(pk, user_id, level, bytes_served):
+    from .models import DownloadEvent
+    if level is None:
+        return []
+    return [DownloadEvent(file_id=pk, user_id=user_id, level=level, bytes_served=bytes_served, created_at=timezone.now())]
+
+
+def _buffer(pk, count, events):
+    # Add to the in-memory buffer; True when it's big enough to flush now.
+    global _pending_total
+    with _lock:
+        _pending[pk] += count
+        _events.extend(events)
+        _pending_total += count
+        due = _pending_total >= max_pending()
+    _ensure_flusher()
+    return due
+
+
+def record_download(pk, count=1, user_id=None, level=None, bytes_served=0):
+    """Count `count` downloads of FileUpload `pk` and log one download event.
+
+    Without a `level` (callers that only keep the counter) no event is logged.
+    """
+    events = _event(pk, user_id, level, bytes_served)
+    if flush_interval() <= 0:
+        _write({pk: count}, events)
+        return
+    if _buffer(pk, count, events):
+        flush()
+
+
+async def arecord_download(pk, count=1, user_id=None, level=None, bytes_served=0):
+    """record_download for async views: buffering stays on the event loop,
+    only a database write goes to a thread."""
+    events = _event(pk, user_id, level, bytes_served)
+    if flush_interval() <= 0:
+        await sync_to_async(_write)({pk: count}, events)
+        return
+    if _buffer(pk, count, events):
+        await sync_to_async(flush)()
+
+
+def pending_count(pk):
+    """Downloads of `pk` recorded in this process but not yet written."""
+    with _lock:
+        return _pending.get(pk, 0)
+
+
+def flush():
+    """Write all pending increments in one transaction; return how many were written."""
+    global _pending_total, _last_flush
+    with _lock:
+        if not _pending:
+            _last_flush = time.monotonic()
+            return 0
+        batch = dict(_pending)
+        events = _events[:]
+        _pending.clear()
+        del _events[:]
+        _pending_total = 0
+        _last_flush = time.monotonic()
+    try:
+        _write(batch, events)
+    except Exception:
+        # Put the counts and events back so the next flush retries them.
+        with _lock:
+            for pk, n in batch.items():
+                _pending[pk] += n
+                _pending_total += n
+            _events[:0] = events
+        logger.exception('Could not flush %d download count(s)', sum(batch.values()))
+        return 0
+    return sum(batch.values())
+
+
+def _flusher():
+    while True:
+        interval = flush_interval() or 1.0
+        time.sleep(max(0.0, interval - (time.monotonic() - _last_flush)))
+        if time.monotonic() - _last_flush < interval:
+            continue
+        flush()
+        # This thread owns its own DB connection; don't let it go stale.
+        close_old_connections()
+
+
+def _ensure_flusher():
+    global _flusher_pid
+    pid = os.getpid()
+    if _flusher_pid == pid:
+        return
+    with _lock:
+        if _flusher_pid == pid:
+            return
+        _flusher_pid = pid
+    threading.Thread(target=_flusher, name='download-count-flusher', daemon=True).start()
+
+
+@atexit.register
+def _flush_on_shutdown():
+    # Gunicorn workers and runserver exit normally on restart/shutdown, so
+    # whatever is still buffered gets written here.
+    try:
+        flush()
+    except Exception:
+        pass
@@ -0,0 +1,201 @@
+"""Constant-memory user exports for the admin (CSV and XLSX).
+
+Rows come from one joined query (users + student profiles) read in chunks
+with `.iterator()`, so memory does not grow with the number of users.
+
+* CSV is streamed straight to the client with StreamingHttpResponse.
+* XLSX uses openpyxl's write-only mode, which spools rows to a temporary
+  file instead of keeping cells in memory. Write-only sheets need their
+  column widths before the first row, so widths come from a Max(Length())
+  aggregate over the same selection.
+
+Selections larger than EXPORT_ASYNC_THRESHOLD users are written to
+EXPORT_DIR by a background thread instead; the admin links to
+`admin:auth_user_export_download`, which serves the file once it is ready.
+"""
+import csv
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Max
+from django.db.models.functions import Length
+
+# openpyxl is optional; XLSX exports fall back to CSV if not installed
+try:
+    from openpyxl import Workbook
+    from openpyxl.utils import get_column_letter
+    OPENPYXL_AVAILABLE = True
+except Exception:
+    Workbook = None
+    get_column_letter = None
+    OPENPYXL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+HEADERS = ['id', 'username', 'email', 'first_name', 'middle_name', 'last_name', 'is_active', 'is_staff']
+# Queried columns, in HEADERS order.
+_COLUMNS = ['pk', 'username', 'email', 'first_name', 'studentprofile__middle_name', 'last_name', 'is_active', 'is_staff']
+CHUNK_SIZE = 2000
+MAX_COLUMN_WIDTH = 50
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+
+def user_rows(queryset):
+    """Yield one export row per user, reading the selection in chunks."""
+    rows = queryset.order_by('pk').values_list(*_COLUMNS).iterator(chunk_size=CHUNK_SIZE)
+    for pk, username, email, first_name, middle, last_name, is_active, is_staff in rows:
+        yield [
+            pk,
+            username,
+            email,
+            first_name,
+            middle or '',
+            last_name,
+            'yes' if is_active else 'no',
+            'yes' if is_staff else 'no',
+        ]
+
+
+class Echo:
+    """File-like object whose write() returns the value, for streaming csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(queryset):
+    writer = csv.writer(Echo())
+    yield writer.writerow(HEADERS)
+    for row in user_rows(queryset):
+        yield writer.writerow(row)
+
+
+def column_widths(queryset):
+    """Width per column from the longest value in the selection (one query)."""
+    text_columns = {
+        name: Max(Length(column)) for name, column in zip(HEADERS, _COLUMNS)
+        if name not in ('id', 'is_active', 'is_staff')
+    }
+    longest = queryset.order_by().aggregate(max_id=Max('pk'), **text_columns)
+    widths = []
+    for name in HEADERS:
+        if name == 'id':
+            length = len(str(longest['max_id'] or ''))
+        elif name in ('is_active', 'is_staff'):
+            length = 3
+        else:
+            length = longest[name] or 0
+        widths.append(min(MAX_COLUMN_WIDTH, max(length, len(name)) + 2))
+    return widths
+
+
+def write_xlsx(queryset, fileobj):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Users')
+    for i, width in enumerate(column_widths(queryset), 1):
+        ws.column_dimensions[get_column_letter(i)].width = width
+    ws.append(HEADERS)
+    for row in user_rows(queryset):
+        ws.append(row)
+    wb.save(fileobj)
+
+
+def write_csv(queryset, fileobj):
+    # `fileobj` is opened in text mode with newline=''.
+    fileobj.writelines(iter_csv(queryset))
+
+
+def xlsx_file(queryset):
+    """Write the XLSX export to a temporary file and return it, rewound."""
+    tmp = tempfile.TemporaryFile()
+    write_xlsx(queryset, tmp)
+    tmp.seek(0)
+    return tmp
+
+
+def export_dir():
+    return Path(getattr(settings, 'EXPORT_DIR', Path(settings.BASE_DIR) / 'exports'))
+
+
+def export_path(token, fmt):
+    """Path of a finished export, or None for a malformed token/format."""
+    try:
+        token = uuid.UUID(hex=token).hex
+    except (TypeError, ValueError):
+        return None
+    if fmt not in CONTENT_TYPES:
+        return None
+    return export_dir() / f'users_{token}.{fmt}'
+
+
+def export_status(token, fmt):
+    """'ready', 'running', 'failed' or None (unknown token)."""
+    path = export_path(token, fmt)
+    if path is None:
+        return None
+    if path.exists():
+        return 'ready'
+    if path.with_name(path.name + '.failed').exists():
+        return 'failed'
+    if path.with_name(path.name + '.part').exists():
+        return 'running'
+    return None
+
+
+def _write_export(queryset, fmt, path):
+    part = path.with_name(path.name + '.part')
+    try:
+        if fmt == 'xlsx':
+            with open(part, 'wb') as fh:
+                write_xlsx(queryset, fh)
+        else:
+            with open(part, 'w', newline='', encoding='utf-8') as fh:
+                write_csv(queryset, fh)
+        os.replace(part, path)
+    except Exception:
+        logger.exception('User export %s failed', path.name)
+        path.with_name(path.name + '.failed').touch()
+        try:
+            part.unlink()
+        except OSError:
+            pass
+    finally:
+        close_old_connections()
+
+
+def start_export(queryset, fmt):
+    """Write the export in a background thread; return its token."""
+    directory = export_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    prune_exports()
+    token = uuid.uuid4().hex
+    path = export_path(token, fmt)
+    # The .part file marks the export as running until it is renamed.
+    path.with_name(path.name + '.part').touch()
+    threading.Thread(
+        target=_write_export, args=(queryset.all(), fmt, path), name='user-export', daemon=True,
+    ).start()
+    return token
+
+
+def prune_exports():
+    """Delete exports older than EXPORT_KEEP_SECONDS."""
+    keep = int(getattr(settings, 'EXPORT_KEEP_SECONDS', 86400))
+    cutoff = time.time() - keep
+    for path in export_dir().glob('users_*'):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
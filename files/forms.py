@@ -1,3 +1,5 @@
+import zipfile
+
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
@@ -62,3 +64,17 @@ class StudentRegistrationForm(UserCreationForm):
         if username and User.objects.filter(username__iexact=username).exists():
             raise ValidationError('A user with that username already exists.')
         return username
+
+
+class BulkUploadForm(forms.Form):
+    # Admin bulk upload: a ZIP of files plus the metadata CSV used by `manage.py ingest_files`.
+    archive = forms.FileField(help_text='ZIP file containing the documents.')
+    metadata = forms.FileField(help_text='CSV with columns filename, title, level, category, semester.')
+    notify = forms.BooleanField(required=False, initial=True, help_text='Queue one summary email to all users.')
+
+    def clean_archive(self):
+        archive = self.cleaned_data['archive']
+        if not zipfile.is_zipfile(archive):
+            raise ValidationError('Upload a .zip file.')
+        archive.seek(0)
+        return archive
@@ -0,0 +1,368 @@
+"""Bulk ingestion of files from a directory or ZIP plus a metadata CSV.
+
+The CSV has a header row with `filename,title,level,category,semester`
+(`filename` relative to the directory/ZIP root; level, category and semester
+use the same values as the admin form). Files are uploaded to storage by a
+bounded thread pool, then the rows are inserted with `bulk_create`, which
+sends no per-row signals. The work those signals would have done happens
+once at the end: the new rows are added to the search index, the catalog
+version is bumped, and a single summary notification is queued. Thumbnails
+are generated on first view.
+
+Progress is appended to a JSON-lines manifest as each file is uploaded and
+each batch is inserted, so an interrupted run can be repeated with the same
+manifest and picks up where it stopped. A batch is recorded only after it
+commits; rows resumed from the manifest whose upload (same checksum, title
+and filename) is already in the table are therefore skipped rather than
+inserted twice.
+"""
+import csv
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import blobs
+from . import catalog
+from . import search
+from .models import CATEGORY_CHOICES, LEVEL_CHOICES, SEMESTER_CHOICES, FileUpload
+from .utils import queue_email
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_COLUMNS = ('filename', 'title', 'level', 'category', 'semester')
+DEFAULT_WORKERS = 4
+BATCH_SIZE = 200
+
+
+class IngestError(Exception):
+    """The source or metadata CSV can't be used."""
+
+
+@dataclass
+class IngestResult:
+    created: list = field(default_factory=list)  # FileUpload pks inserted by this run
+    skipped: int = 0  # already ingested according to the manifest
+    recovered: list = field(default_factory=list)  # pks an interrupted run inserted but didn't record
+    failed: list = field(default_factory=list)  # (filename, error)
+    bytes_uploaded: int = 0
+    seconds: float = 0.0
+
+    @property
+    def files_per_sec(self):
+        return round(len(self.created) / self.seconds, 2) if self.seconds else None
+
+    @property
+    def mb_per_sec(self):
+        return round(self.bytes_uploaded / self.seconds / 1e6, 2) if self.seconds else None
+
+
+def _choice(value, choices, label, cast=str):
+    valid = [k for k, _ in choices]
+    try:
+        value = cast(str(value).strip())
+    except (TypeError, ValueError):
+        value = None
+    if value not in valid:
+        raise ValueError(f'invalid {label} {value!r}')
+    return value
+
+
+def read_metadata(csv_file):
+    """Parse and validate the metadata CSV; return a list of row dicts."""
+    reader = csv.DictReader(csv_file)
+    missing = [c for c in REQUIRED_COLUMNS if c not in (reader.fieldnames or [])]
+    if missing:
+        raise IngestError(f'Metadata CSV is missing column(s): {", ".join(missing)}')
+    rows = []
+    errors = []
+    for line, row in enumerate(reader, start=2):
+        try:
+            filename = (row['filename'] or '').strip().replace('\\', '/')
+            if not filename:
+                raise ValueError('empty filename')
+            rows.append({
+                'filename': filename,
+                'title': (row['title'] or '').strip() or Path(filename).stem,
+                'level': _choice(row['level'], LEVEL_CHOICES, 'level', int),
+                'category': _choice(row['category'], CATEGORY_CHOICES, 'category'),
+                'semester': _choice(row['semester'], SEMESTER_CHOICES, 'semester', int),
+            })
+        except ValueError as exc:
+            errors.append(f'line {line}: {exc}')
+    if errors:
+        raise IngestError('Invalid metadata CSV:\n' + '\n'.join(errors))
+    return rows
+
+
+class DirectorySource:
+    def __init__(self, path):
+        self.root = Path(path).resolve()
+
+    def open(self, name):
+        path = (self.root / name).resolve()
+        if self.root not in path.parents:
+            raise IngestError(f'{name} is outside the source directory')
+        return open(path, 'rb')
+
+    def close(self):
+        pass
+
+
+class ZipSource:
+    def __init__(self, path_or_file):
+        self.zip = zipfile.ZipFile(path_or_file)
+        self._lock = threading.Lock()
+
+    def open(self, name):
+        # Members are streamed (and decompressed) by the upload threads; the
+        # open member handles share the archive's file under ZipFile's own
+        # lock, so only looking the member up needs ours.
+        with self._lock:
+            return self.zip.open(name)
+
+    def close(self):
+        self.zip.close()
+
+
+def open_source(path_or_file):
+    if isinstance(path_or_file, (str, os.PathLike)) and os.path.isdir(path_or_file):
+        return DirectorySource(path_or_file)
+    if zipfile.is_zipfile(path_or_file):
+        return ZipSource(path_or_file)
+    raise IngestError(f'{path_or_file} is neither a directory nor a ZIP file')
+
+
+class Manifest:
+    """Append-only JSON-lines record of uploaded files and inserted rows."""
+
+    def __init__(self, path):
+        self.path = Path(path) if path else None
+        self.uploaded = {}  # filename -> stored metadata
+        self.created = {}  # filename -> FileUpload pk
+        self._lock = threading.Lock()
+        if self.path and self.path.exists():
+            with open(self.path) as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    if entry.get('event') == 'uploaded':
+                        self.uploaded[entry['filename']] = entry['stored']
+                    elif entry.get('event') == 'created':
+                        self.created.update(entry['rows'])
+
+    def _append(self, entry):
+        if not self.path:
+            return
+        with self._lock, open(self.path, 'a') as fh:
+            fh.write(json.dumps(entry) + '\n')
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def record_upload(self, filename, stored):
+        self.uploaded[filename] = stored
+        self._append({'event': 'uploaded', 'filename': filename, 'stored': stored})
+
+    def record_created(self, rows):
+        self.created.update(rows)
+        self._append({'event': 'created', 'rows': rows})
+
+
+def _save(row, fh):
+    field_ = FileUpload._meta.get_field('file')
+    name = field_.generate_filename(None, os.path.basename(row['filename']))
+    return field_.storage.save(name, File(fh, name=name), max_length=field_.max_length)
+
+
+def _upload(source, row):
+    # Store one file; return the metadata FileUpload needs.
+    with source.open(row['filename']) as fh:
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in iter(lambda: fh.read(64 * 1024), b''):
+            digest.update(chunk)
+            size += len(chunk)
+        # Contents already in storage are referenced, not uploaded again. The
+        # blob itself is claimed when the row is inserted (_insert).
+        stored_name = blobs.find(digest.hexdigest())
+        uploaded = stored_name is None
+        if uploaded:
+            fh.seek(0)
+            stored_name = _save(row, fh)
+    # The stored copy may be shared and named differently; type and extension
+    # come from the file's own name.
+    original_name = os.path.basename(row['filename'])[:255]
+    content_type, _ = mimetypes.guess_type(original_name)
+    return {
+        'name': stored_name,
+        'uploaded': uploaded,
+        'original_name': original_name,
+        'size': size,
+        'checksum': digest.hexdigest(),
+        'content_type': content_type or 'application/octet-stream',
+        'extension': os.path.splitext(original_name)[1].lstrip('.').lower()[:16],
+    }
+
+
+def ingest(source_path, metadata_rows, manifest_path=None, workers=DEFAULT_WORKERS,
+           uploaded_by=None, notify=True, progress=None):
+    """Upload and insert every row not already done according to the manifest.
+
+    `progress(message)` is called with short status lines.
+    """
+    manifest = Manifest(manifest_path)
+    result = IngestResult()
+    todo = [r for r in metadata_rows if r['filename'] not in manifest.created]
+    result.skipped = len(metadata_rows) - len(todo)
+    source = open_source(source_path)
+    started = time.perf_counter()
+    try:
+        def upload(row):
+            stored = manifest.uploaded.get(row['filename'])
+            if stored is None:
+                stored = _upload(source, row)
+                manifest.record_upload(row['filename'], stored)
+                return row, stored, stored['size'] if stored['uploaded'] else 0, False
+            return row, stored, 0, True  # uploaded by an earlier, interrupted run
+
+        pending = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = [(row, pool.submit(upload, row)) for row in todo]
+            for done, (row, future) in enumerate(futures, start=1):
+                try:
+                    row, stored, uploaded_bytes, resumed = future.result()
+                except Exception as exc:
+                    error = str(exc) or exc.__class__.__name__
+                    logger.warning('Could not upload %s: %s', row['filename'], error)
+                    result.failed.append((row['filename'], error))
+                    continue
+                result.bytes_uploaded += uploaded_bytes
+                pending.append((row, stored, resumed))
+                if len(pending) >= BATCH_SIZE:
+                    _insert(source, pending, manifest, uploaded_by, result)
+                    pending = []
+                if progress and (done % 50 == 0 or done == len(futures)):
+                    progress(f'{done}/{len(futures)} uploaded')
+        if pending:
+            _insert(source, pending, manifest, uploaded_by, result)
+    finally:
+        source.close()
+        result.seconds = time.perf_counter() - started
+
+    if result.created or result.recovered:
+        # Recovered rows never had their post-insert work done either.
+        _after_insert(result.created + result.recovered, notify, uploaded_by)
+    return result
+
+
+def _claim(source, row, stored):
+    # Take the blob reference for one file inside _insert's transaction.
+    # Returns (name for the row, our own copy if another blob made it
+    # redundant). Contents whose blob was deleted since _upload found it are
+    # stored now.
+    storage = FileUpload._meta.get_field('file').storage
+    own = stored['name'] if stored.get('uploaded', True) else None
+
+    def store():
+        if own:
+            return own
+        with source.open(row['filename']) as fh:
+            return _save(row, fh)
+
+    name, reused = blobs.claim(storage, stored['checksum'], stored['size'], store)
+    return name, own if reused and own and own != name else None
+
+
+def _row_key(row, stored):
+    original_name = stored.get('original_name') or os.path.basename(row['filename'])[:255]
+    return stored['checksum'], row['title'][:255], original_name
+
+
+def _already_inserted(pending):
+    # {filename: pk} for resumed rows whose batch committed before the run was
+    # cut off, i.e. before the manifest could record it.
+    keys = {row['filename']: _row_key(row, stored) for row, stored, resumed in pending if resumed}
+    if not keys:
+        return {}
+    condition = Q()
+    for checksum, title, original_name in keys.values():
+        condition |= Q(checksum=checksum, title=title, original_name=original_name)
+    existing = {
+        (checksum, title, original_name): pk
+        for pk, checksum, title, original_name in
+        FileUpload.objects.filter(condition).values_list('pk', 'checksum', 'title', 'original_name')
+    }
+    return {filename: existing[key] for filename, key in keys.items() if key in existing}
+
+
+def _insert(source, pending, manifest, uploaded_by, result):
+    # bulk_create sends no post_save signals; _after_insert does their work once.
+    # The blob references are taken in the same transaction as the rows, so a
+    # failed batch leaves the counts as they were; its uploaded files stay in
+    # the manifest for the next run.
+    storage = FileUpload._meta.get_field('file').storage
+    with transaction.atomic():
+        existing = _already_inserted(pending)
+        pending = [(row, stored) for row, stored, _ in pending if row['filename'] not in existing]
+        objs, redundant = [], []
+        for row, stored in pending:
+            name, copy = _claim(source, row, stored)
+            if copy:
+                redundant.append(copy)
+            objs.append(FileUpload(
+                title=row['title'][:255],
+                level=row['level'],
+                category=row['category'],
+                semester=row['semester'],
+                uploaded_by=uploaded_by,
+                file=name,
+                original_name=_row_key(row, stored)[2],
+                size=stored['size'],
+                checksum=stored['checksum'],
+                content_type=stored['content_type'],
+                extension=stored['extension'],
+            ))
+        FileUpload.objects.bulk_create(objs)
+        # Another upload of the same contents was registered first.
+        transaction.on_commit(lambda: [storage.delete(name) for name in redundant], robust=True)
+    created = {row['filename']: obj.pk for (row, _), obj in zip(pending, objs)}
+    manifest.record_created({**existing, **created})
+    result.recovered.extend(existing.values())
+    result.created.extend(created.values())
+
+
+def _after_insert(pks, notify, uploaded_by):
+    for obj in FileUpload.objects.filter(pk__in=pks).iterator():
+        try:
+            search.index_file(obj, with_body=True)
+        except Exception:
+            logger.exception('Could not index upload %s for search', obj.pk)
+    # Cached catalog pages and filter counts are rebuilt on their next read.
+    catalog.bump_version()
+    if notify:
+        titles = list(FileUpload.objects.filter(pk__in=pks).order_by('title').values_list('title', flat=True))
+        shown = titles[:50]
+        body = (
+            f'{len(titles)} new file(s) were added on {timezone.localdate():%Y-%m-%d}'
+            f' by {getattr(uploaded_by, "username", "Admin")}:\n\n'
+            + '\n'.join(f'- {t}' for t in shown)
+            + (f'\n...and {len(titles) - len(shown)} more.' if len(titles) > len(shown) else '')
+        )
+        try:
+            queue_email(f'{len(titles)} new files uploaded', body)
+        except Exception:
+            logger.exception('Could not queue the ingest summary notification')
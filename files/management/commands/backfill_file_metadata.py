@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from files.models import FileUpload
+
+METADATA_FIELDS = ['size', 'content_type', 'extension', 'checksum']
+
+
+def _read_metadata(obj, with_checksum):
+    # Runs in a worker thread: only touches the storage backend, never the DB.
+    try:
+        obj.populate_file_metadata(with_checksum=with_checksum)
+        return obj, None
+    except Exception as exc:
+        return obj, exc
+
+
+class Command(BaseCommand):
+    help = 'Store size, content type, extension and checksum for uploads saved before these columns existed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Parallel storage requests (default 8).')
+        parser.add_argument('--batch-size', type=int, default=200, help='Rows written per bulk update (default 200).')
+        parser.add_argument('--checksum', action='store_true', help='Also download each file to compute its SHA-256.')
+        parser.add_argument('--all', action='store_true', help='Recompute every row, not only rows missing metadata.')
+
+    def handle(self, *args, **options):
+        qs = FileUpload.objects.exclude(file='').order_by('pk')
+        if not options['all']:
+            qs = qs.filter(content_type='')
+        # Collect the ids first: SQLite gives no isolation between an open
+        # cursor and writes on the same connection.
+        pks = list(qs.values_list('pk', flat=True))
+        total = len(pks)
+        if not total:
+            self.stdout.write('Nothing to backfill.')
+            return
+
+        with_checksum = options['checksum']
+        batch_size = max(1, options['batch_size'])
+        done = failed = 0
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            # One batch in memory at a time; the pool keeps several storage
+            # calls in flight within each batch.
+            for start in range(0, total, batch_size):
+                batch = list(FileUpload.objects.filter(pk__in=pks[start:start + batch_size]))
+                done, failed = self._process(pool, batch, with_checksum, done, failed, total)
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {done} row(s), {failed} failure(s).'))
+
+    def _process(self, pool, batch, with_checksum, done, failed, total):
+        updated = []
+        for obj, exc in pool.map(lambda o: _read_metadata(o, with_checksum), batch):
+            if exc is not None:
+                failed += 1
+                self.stderr.write(f'#{obj.pk} {obj.file.name}: {exc}')
+            else:
+                updated.append(obj)
+        if updated:
+            FileUpload.objects.bulk_update(updated, METADATA_FIELDS)
+            done += len(updated)
+        self.stdout.write(f'{done}/{total} rows updated')
+        return done, failed
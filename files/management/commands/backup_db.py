@@ -0,0 +1,30 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from files import backup
+
+
+class Command(BaseCommand):
+    help = 'Take a compressed online snapshot of the SQLite database (skipped when nothing changed).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Snapshot even if the database is unchanged.')
+        parser.add_argument('--loop', action='store_true', help='Keep running, taking a snapshot every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=None, help='Seconds between snapshots with --loop (default DB_BACKUP_INTERVAL).')
+
+    def handle(self, *args, **options):
+        if not backup.database_path():
+            self.stderr.write('Snapshots are only supported for a file-based SQLite database.')
+            return
+        interval = options['interval'] or getattr(settings, 'DB_BACKUP_INTERVAL', 3600)
+        while True:
+            path = backup.snapshot(force=options['force'])
+            if path:
+                self.stdout.write(f'Wrote {path}')
+            else:
+                self.stdout.write('Database unchanged; no snapshot taken.')
+            if not options['loop']:
+                break
+            time.sleep(interval)
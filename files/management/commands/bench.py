@@ -0,0 +1,216 @@
+import json
+import logging
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from files import counters
+from files.benchmarking import percentiles, seed_uploads, seed_users, temporary_database, write_sample_files
+from files.models import CATEGORY_CHOICES, LEVEL_CHOICES, SEMESTER_CHOICES, FileUpload
+
+PASSWORD = 'Bench-pass-123'
+# Sample file sizes, cycled: mostly documents, a few large scans/recordings.
+FILE_SIZES = [16 * 1024, 120 * 1024, 600 * 1024, 48 * 1024, 2 * 1024 * 1024, 250 * 1024, 8 * 1024 * 1024]
+SCENARIOS = ('browse', 'download', 'preview_page', 'login', 'register')
+# Login and registration hash a password (deliberately slow), so they run fewer requests.
+AUTH_SCENARIOS = ('login', 'register')
+
+
+def _drain(response):
+    # Streamed bodies only do their work when read.
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    response.close()
+
+
+class Command(BaseCommand):
+    help = 'Seed a throwaway database with users and real files, run concurrent scenarios against the views and report latency as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500, help='Users with student profiles to seed (default 500).')
+        parser.add_argument('--files', type=int, default=5000, help='FileUpload rows to seed (default 5000).')
+        parser.add_argument('--stored-files', type=int, default=28, help='Distinct files of mixed sizes written to storage (default 28).')
+        parser.add_argument('--concurrency', type=int, default=4, help='Concurrent clients per scenario (default 4).')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per scenario (default 200).')
+        parser.add_argument('--auth-requests', type=int, default=20, help='Requests for the login and register scenarios (default 20).')
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Run only this scenario (repeatable).')
+        parser.add_argument('--no-cache', action='store_true', help='Disable the catalog page cache (CATALOG_CACHE_TTL=0).')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed for data and request mix (default 0).')
+        parser.add_argument('--output', help='Also write the JSON report to this file.')
+
+    def handle(self, *args, **options):
+        scenarios = options['scenario'] or list(SCENARIOS)
+        media = tempfile.mkdtemp(prefix='bench-media-')
+        overrides = dict(
+            MEDIA_ROOT=media,
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bench'}},
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+            DB_BACKUP_IN_PROCESS=False,
+        )
+        if options['no_cache']:
+            overrides['CATALOG_CACHE_TTL'] = 0
+        # Failed requests are counted in the report instead of logged one by one.
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        try:
+            with override_settings(**overrides), temporary_database():
+                started = time.perf_counter()
+                stored = write_sample_files(media, max(1, options['stored_files']), FILE_SIZES, seed=options['seed'])
+                usernames = seed_users(options['users'], PASSWORD, seed=options['seed'])
+                seed_uploads(options['files'], files=stored, seed=options['seed'])
+                data = {
+                    'usernames': usernames,
+                    'pks': list(FileUpload.objects.filter(archived=False).values_list('pk', flat=True)),
+                }
+                if not usernames or not data['pks']:
+                    raise CommandError('Seed at least one user and one visible file.')
+                report = {
+                    'commit': self._commit(),
+                    'vendor': connection.vendor,
+                    'dataset': {
+                        'users': options['users'],
+                        'files': options['files'],
+                        'stored_files': len(stored),
+                        'stored_bytes': sum(f['size'] for f in stored),
+                        'seed_seconds': round(time.perf_counter() - started, 2),
+                    },
+                    'concurrency': options['concurrency'],
+                    'catalog_cache': not options['no_cache'],
+                    'scenarios': {},
+                }
+                for name in scenarios:
+                    count = options['auth_requests'] if name in AUTH_SCENARIOS else options['requests']
+                    report['scenarios'][name] = self._run(name, count, options, data)
+                counters.flush()
+        finally:
+            shutil.rmtree(media, ignore_errors=True)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(output + '\n')
+        self.stdout.write(output)
+
+    def _commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, text=True, timeout=5,
+            ).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    # Each scenario takes (client, rng, data, n) and returns a response; n
+    # numbers the request within the run.
+
+    def browse(self, client, rng, data, n):
+        level = rng.choice(LEVEL_CHOICES)[0]
+        category = rng.choice(CATEGORY_CHOICES)[0]
+        semester = rng.choice(SEMESTER_CHOICES)[0]
+        url = rng.choice([
+            reverse('files:home'),
+            reverse('files:level', args=[level]),
+            reverse('files:category', args=[category]),
+            reverse('files:semester', args=[semester]),
+            reverse('files:home') + f'?level={level}&category={category}&semester={semester}',
+        ])
+        return client.get(url)
+
+    def download(self, client, rng, data, n):
+        return client.get(reverse('files:download', args=[rng.choice(data['pks'])]))
+
+    def preview_page(self, client, rng, data, n):
+        return client.get(reverse('files:preview_page', args=[rng.choice(data['pks'])]))
+
+    def login(self, client, rng, data, n):
+        client.logout()
+        return client.post(reverse('files:login'), {'username': rng.choice(data['usernames']), 'password': PASSWORD})
+
+    def register(self, client, rng, data, n):
+        client.logout()
+        username = f'newbench{n}'
+        return client.post(reverse('files:register'), {
+            'username': username, 'first_name': 'New', 'middle_name': 'B', 'last_name': 'Student',
+            'email': f'{username}@example.com', 'level': str(rng.choice(LEVEL_CHOICES)[0]),
+            'password1': PASSWORD, 'password2': PASSWORD,
+        })
+
+    def _run(self, name, count, options, data):
+        scenario = getattr(self, name)
+        threads = max(1, min(options['concurrency'], count))
+        numbers = iter(range(count))
+        numbers_lock = threading.Lock()
+        results = []  # (seconds, queries, status)
+        results_lock = threading.Lock()
+        errors = Counter()
+
+        def worker(index):
+            rng = random.Random(f'{options["seed"]}-{name}-{index}')
+            client = Client()
+            client.force_login(User.objects.get(username=rng.choice(data['usernames'])))
+            local = []
+            queries = 0
+
+            def count_queries(execute, sql, params, many, context):
+                nonlocal queries
+                queries += 1
+                return execute(sql, params, many, context)
+
+            try:
+                with connection.execute_wrapper(count_queries):
+                    while True:
+                        with numbers_lock:
+                            n = next(numbers, None)
+                        if n is None:
+                            break
+                        queries = 0
+                        started = time.perf_counter()
+                        try:
+                            response = scenario(client, rng, data, n)
+                            _drain(response)
+                            status = response.status_code
+                        except Exception as exc:
+                            # e.g. "database is locked" under concurrent writes
+                            status = 'error'
+                            with results_lock:
+                                errors[f'{exc.__class__.__name__}: {exc}'] += 1
+                        local.append((time.perf_counter() - started, queries, status))
+            finally:
+                connection.close()
+                with results_lock:
+                    results.extend(local)
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.perf_counter() - started
+
+        query_counts = [q for _, q, _ in results]
+        statuses = Counter(status for _, _, status in results)
+        return {
+            'requests': len(results),
+            'seconds': round(elapsed, 3),
+            'requests_per_sec': round(len(results) / elapsed, 1) if elapsed else None,
+            'latency_ms': percentiles([s for s, _, _ in results]),
+            'queries': {
+                'mean': round(sum(query_counts) / len(query_counts), 2) if query_counts else None,
+                'max': max(query_counts, default=None),
+            },
+            'status': {str(k): v for k, v in sorted(statuses.items(), key=lambda item: str(item[0]))},
+            'errors': dict(errors),
+        }
@@ -0,0 +1,250 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.test import Client, RequestFactory
+from django.test.utils import override_settings
+from django.urls import path
+
+from files import counters, views
+from files.benchmarking import percentiles, seed_uploads, seed_users, temporary_database, write_sample_files
+from files.models import FileUpload
+
+PASSWORD = 'Bench-pass-123'
+
+# The benchmark routes to both download views from this module
+# (ROOT_URLCONF=__name__), whatever ASYNC_FILE_VIEWS says.
+urlpatterns = [
+    path('sync/<int:pk>/', views.download_file),
+    path('async/<int:pk>/', views.adownload_file),
+]
+
+
+# Memory (private, so the database file mapped by each SQLite connection
+# isn't counted once per connection) and open files are read from /proc
+# (Linux); elsewhere they are reported as null.
+
+def _private_kb():
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('RssAnon:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _open_files(directory):
+    # Descriptors this process holds on files under `directory`.
+    if not os.path.isdir('/proc/self/fd'):
+        return None
+    count = 0
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            count += os.readlink(f'/proc/self/fd/{fd}').startswith(directory)
+        except OSError:
+            pass
+    return count
+
+
+class Command(BaseCommand):
+    help = ('Serve many concurrent slow downloads in-process: the async view under the ASGI handler '
+            'in one process, against the sync view behind a few WSGI workers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=2000, help='Concurrent slow clients for the ASGI run (default 2000).')
+        parser.add_argument('--file-size', type=int, default=256 * 1024, help='Size of the downloaded file in bytes (default 256 KB).')
+        parser.add_argument('--rate', type=int, default=8 * 1024, help='Bytes/s each client reads (default 8 KB/s, a poor mobile link).')
+        parser.add_argument('--ramp', type=float, default=30.0, help='Seconds over which the ASGI clients arrive (default 30).')
+        parser.add_argument('--abort-every', type=int, default=10,
+                            help='Every Nth ASGI client disconnects half way through (default 10; 0 = none).')
+        parser.add_argument('--sync-workers', type=int, default=4, help='Sync workers (threads) for the WSGI baseline (default 4).')
+        parser.add_argument('--sync-clients', type=int, default=4, help='Slow clients for the WSGI baseline (default 4).')
+        parser.add_argument('--output', help='Also write the JSON report to this file.')
+
+    def handle(self, *args, **options):
+        media = tempfile.mkdtemp(prefix='bench-media-')
+        overrides = dict(
+            MEDIA_ROOT=media,
+            ROOT_URLCONF=__name__,
+            ALLOWED_HOSTS=['testserver'],
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bench'}},
+            FILE_DELIVERY='proxy',
+            DB_BACKUP_IN_PROCESS=False,
+        )
+        try:
+            with override_settings(**overrides), temporary_database():
+                stored = write_sample_files(media, 1, [options['file_size']])
+                seed_uploads(1, files=stored, archived_ratio=0)
+                username = seed_users(1, PASSWORD)[0]
+                client = Client()
+                client.force_login(User.objects.get(username=username))
+                cookie = f'sessionid={client.cookies["sessionid"].value}'
+                pk = FileUpload.objects.values_list('pk', flat=True).get()
+                connection.close()
+                report = {
+                    'file_size': options['file_size'],
+                    'client_rate': options['rate'],
+                    'seconds_per_download': round(options['file_size'] / options['rate'], 3),
+                    'asgi': asyncio.run(self._asgi(f'/async/{pk}/', cookie, media, options)),
+                    'wsgi': self._wsgi(f'/sync/{pk}/', cookie, options),
+                }
+                counters.flush()
+        finally:
+            shutil.rmtree(media, ignore_errors=True)
+
+        asgi, wsgi = report['asgi'], report['wsgi']
+        if wsgi['completed']:
+            # How long the sync workers would take to serve the ASGI run's clients.
+            report['wsgi_seconds_for_asgi_clients'] = round(asgi['clients'] * wsgi['seconds'] / wsgi['completed'], 1)
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(output + '\n')
+        self.stdout.write(output)
+
+    async def _asgi(self, url, cookie, media, options):
+        # Each client is a coroutine speaking ASGI to the handler directly:
+        # clients arrive evenly over --ramp seconds, read at --rate, and every
+        # --abort-every'th one disconnects half way through.
+        app = get_asgi_application()
+        size, rate, every = options['file_size'], options['rate'], options['abort_every']
+        results = []  # (status, bytes, ttfb, seconds, aborted)
+        peak = {'threads': threading.active_count(), 'memory_kb': _private_kb(), 'streams': 0}
+        memory_before = peak['memory_kb']
+        streams = 0
+        files_before = _open_files(media)
+
+        async def sample():
+            while True:
+                peak['threads'] = max(peak['threads'], threading.active_count())
+                if memory_before is not None:
+                    peak['memory_kb'] = max(peak['memory_kb'], _private_kb())
+                await asyncio.sleep(0.05)
+
+        async def download(n):
+            nonlocal streams
+            await asyncio.sleep(options['ramp'] * n / options['clients'])
+            aborts = every and n % every == every - 1
+            disconnected = asyncio.Event()
+            requested = False
+            state = {'status': None, 'bytes': 0, 'ttfb': None}
+            started = time.perf_counter()
+
+            async def receive():
+                nonlocal requested
+                if not requested:
+                    requested = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                nonlocal streams
+                if message['type'] == 'http.response.start':
+                    state['status'] = message['status']
+                    state['ttfb'] = time.perf_counter() - started
+                    streams += 1
+                    peak['streams'] = max(peak['streams'], streams)
+                elif message['type'] == 'http.response.body':
+                    received = len(message.get('body', b''))
+                    state['bytes'] += received
+                    if aborts and state['bytes'] >= size // 2:
+                        disconnected.set()
+                    # A slow client: the next chunk is taken once this one has been read.
+                    await asyncio.sleep(received / rate)
+
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': url, 'raw_path': url.encode(), 'query_string': b'', 'root_path': '',
+                'headers': [(b'host', b'testserver'), (b'cookie', cookie.encode())],
+                'client': ('127.0.0.1', 40000 + n % 20000), 'server': ('testserver', 80),
+            }
+            await app(scope, receive, send)
+            if state['status'] is not None:
+                streams -= 1
+            results.append((state['status'], state['bytes'], state['ttfb'], time.perf_counter() - started, aborts))
+
+        sampler = asyncio.create_task(sample())
+        started = time.perf_counter()
+        await asyncio.gather(*(download(n) for n in range(options['clients'])))
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+        # Let aborted streams finish closing their files.
+        await asyncio.sleep(0.2)
+
+        complete = [r for r in results if not r[4] and r[0] == 200 and r[1] == size]
+        return {
+            'processes': 1,
+            'clients': len(results),
+            'completed': len(complete),
+            'aborted': sum(1 for r in results if r[4]),
+            'status': {str(k): v for k, v in sorted(Counter(r[0] for r in results).items(), key=lambda i: str(i[0]))},
+            'seconds': round(elapsed, 3),
+            'downloads_per_sec': round(len(complete) / elapsed, 1) if elapsed else None,
+            'ttfb_ms': percentiles([r[2] for r in results if r[2] is not None]),
+            'download_ms': percentiles([r[3] for r in complete]),
+            'peak_concurrent_downloads': peak['streams'],
+            'peak_threads': peak['threads'],
+            'peak_memory_mb_over_start': None if memory_before is None else round((peak['memory_kb'] - memory_before) / 1024, 1),
+            'open_files_after': None if files_before is None else _open_files(media) - files_before,
+        }
+
+    def _wsgi(self, url, cookie, options):
+        app = get_wsgi_application()
+        rate = options['rate']
+        workers = max(1, options['sync_workers'])
+        remaining = iter(range(options['sync_clients']))
+        lock = threading.Lock()
+        results = []  # (status, bytes, seconds)
+
+        def worker():
+            # One gunicorn sync worker: busy for the whole of each transfer.
+            try:
+                while True:
+                    with lock:
+                        if next(remaining, None) is None:
+                            return
+                    environ = RequestFactory().get(url, HTTP_COOKIE=cookie).environ
+                    status = []
+                    started = time.perf_counter()
+                    response = app(environ, lambda s, headers, exc_info=None: status.append(int(s.split()[0])))
+                    received = 0
+                    try:
+                        for chunk in response:
+                            received += len(chunk)
+                            time.sleep(len(chunk) / rate)
+                    finally:
+                        response.close()
+                    with lock:
+                        results.append((status[0], received, time.perf_counter() - started))
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        complete = [r for r in results if r[0] == 200 and r[1] == options['file_size']]
+        return {
+            'workers': workers,
+            'clients': len(results),
+            'completed': len(complete),
+            'seconds': round(elapsed, 3),
+            'downloads_per_sec': round(len(complete) / elapsed, 1) if elapsed else None,
+            'download_ms': percentiles([r[2] for r in complete]),
+        }
@@ -0,0 +1,86 @@
+import json
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.test.utils import override_settings
+
+from files import counters
+from files.benchmarking import percentiles, temporary_database
+from files.models import FileUpload
+
+
+class Command(BaseCommand):
+    help = 'Compare download counting throughput: one UPDATE per download vs the write-behind buffer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=50, help='Uploads to spread downloads over (default 50).')
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent downloaders (default 8).')
+        parser.add_argument('--downloads', type=int, default=4000, help='Downloads per mode (default 4000).')
+        parser.add_argument('--flush-interval', type=float, default=1.0, help='Buffer flush interval for the buffered run (default 1s).')
+
+    def handle(self, *args, **options):
+        with temporary_database():
+            FileUpload.objects.bulk_create([
+                FileUpload(title=f'Bench {i}', file=f'uploads/bench_{i}.pdf', content_type='application/pdf')
+                for i in range(options['files'])
+            ])
+            pks = list(FileUpload.objects.values_list('pk', flat=True))
+            report = {
+                'direct': self._run(pks, options, interval=0),
+                'buffered': self._run(pks, options, interval=options['flush_interval']),
+            }
+        if report['direct']['downloads_per_sec']:
+            report['speedup'] = round(report['buffered']['downloads_per_sec'] / report['direct']['downloads_per_sec'], 2)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def _run(self, pks, options, interval):
+        FileUpload.objects.update(download_count=0)
+        threads = max(1, options['threads'])
+        per_thread = max(1, options['downloads'] // threads)
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def worker():
+            rng = random.Random()
+            local, failed = [], 0
+            try:
+                for _ in range(per_thread):
+                    start = time.perf_counter()
+                    try:
+                        counters.record_download(rng.choice(pks))
+                    except OperationalError:
+                        # e.g. "database is locked" once the busy timeout expires
+                        failed += 1
+                    local.append(time.perf_counter() - start)
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(local)
+                errors.append(failed)
+
+        with override_settings(DOWNLOAD_COUNT_FLUSH_INTERVAL=interval):
+            started = time.perf_counter()
+            workers = [threading.Thread(target=worker) for _ in range(threads)]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            elapsed = time.perf_counter() - started
+            counters.flush()
+
+        attempted = per_thread * threads
+        failed = sum(errors)
+        stored = sum(FileUpload.objects.values_list('download_count', flat=True))
+        return {
+            'flush_interval': interval,
+            'downloads': attempted,
+            'errors': failed,
+            'stored': stored,
+            'lost': attempted - failed - stored,
+            'seconds': round(elapsed, 3),
+            'downloads_per_sec': round(attempted / elapsed, 1) if elapsed else None,
+            'latency_ms': percentiles(latencies),
+        }
@@ -0,0 +1,86 @@
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail import send_mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from files import passwords
+from files.benchmarking import temporary_database
+
+
+class SimulatedSMTPBackend(EmailBackend):
+    """locmem backend that sleeps on connect, like an SMTP handshake + login."""
+    connect_seconds = 0.05
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._open = False
+
+    def open(self):
+        if self._open:
+            return False
+        time.sleep(self.connect_seconds)
+        self._open = True
+        return True
+
+    def close(self):
+        self._open = False
+
+    def send_messages(self, messages):
+        # Like the SMTP backend: connect if needed, and close again if we opened.
+        new_connection = self.open()
+        try:
+            return super().send_messages(messages)
+        finally:
+            if new_connection:
+                self.close()
+
+
+class Command(BaseCommand):
+    help = 'Compare users/sec for the old per-user password reset loop and the pooled bulk reset.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='Users to reset (default 100).')
+        parser.add_argument('--workers', type=int, default=0, help='Hashing processes (default: one per CPU).')
+        parser.add_argument('--connect-ms', type=float, default=50.0, help='Simulated mail connection setup time (default 50ms).')
+
+    def handle(self, *args, **options):
+        SimulatedSMTPBackend.connect_seconds = options['connect_ms'] / 1000
+        backend = f'{__name__}.SimulatedSMTPBackend'
+        with override_settings(EMAIL_BACKEND=backend), temporary_database():
+            User.objects.bulk_create([
+                User(username=f'bench{i}', email=f'bench{i}@example.com') for i in range(options['users'])
+            ])
+            report = {
+                'users': options['users'],
+                'workers': options['workers'] or passwords.default_workers(),
+                'per_user_loop': self._timed(self._legacy),
+                'bulk': self._timed(lambda: passwords.reset_passwords(User.objects.all(), workers=options['workers'] or None)),
+            }
+        if report['per_user_loop']['users_per_sec']:
+            report['speedup'] = round(report['bulk']['users_per_sec'] / report['per_user_loop']['users_per_sec'], 2)
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def _legacy(self):
+        # What UserAdmin.reset_passwords used to do for each user.
+        for user in User.objects.all():
+            pwd = passwords.generate_password()
+            user.set_password(pwd)
+            user.save()
+            send_mail('Your password has been reset', f'Temporary password: {pwd}', None, [user.email])
+
+    def _timed(self, func):
+        mail.outbox = []
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        count = User.objects.count()
+        return {
+            'seconds': round(elapsed, 3),
+            'users_per_sec': round(count / elapsed, 1) if elapsed else None,
+            'emails': len(mail.outbox),
+        }
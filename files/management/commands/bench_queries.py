@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from files.benchmarking import percentiles, seed_uploads, temporary_database
+from files.storage import SignedFileSystemStorage
+from files.views import _catalog_queryset, _encode_cursor
+
+BENCH_FILE = 'uploads/bench.txt'
+
+
+class Command(BaseCommand):
+    help = 'Seed a throwaway database and report query plans and latency for each URL in files/urls.py.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='FileUpload rows to seed (default 100000).')
+        parser.add_argument('--repeat', type=int, default=20, help='Requests per URL (default 20).')
+        parser.add_argument('--fail-on-scan', action='store_true', help='Exit with an error if any query fully scans files_fileupload.')
+
+    def handle(self, *args, **options):
+        media = tempfile.mkdtemp(prefix='bench-media-')
+        try:
+            os.makedirs(os.path.join(media, 'uploads'))
+            with open(os.path.join(media, BENCH_FILE), 'w') as fh:
+                fh.write('benchmark file\n' * 64)
+            # Catalog page cache off so every request runs the list query; the
+            # filter counts stay cached as in production (their plan is
+            # captured on the first request).
+            with override_settings(
+                MEDIA_ROOT=media,
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'bench-queries'}},
+                CATALOG_CACHE_TTL=0,
+                DOWNLOAD_COUNT_FLUSH_INTERVAL=0,
+                DB_BACKUP_IN_PROCESS=False,
+            ), temporary_database():
+                started = time.perf_counter()
+                seed_uploads(options['rows'], file_name=BENCH_FILE)
+                seeded = time.perf_counter() - started
+                report = {
+                    'vendor': connection.vendor,
+                    'rows': options['rows'],
+                    'seed_seconds': round(seeded, 2),
+                    'urls': self._run(media, options),
+                }
+        finally:
+            shutil.rmtree(media, ignore_errors=True)
+
+        self.stdout.write(json.dumps(report, indent=2))
+        scans = [r['name'] for r in report['urls'] if r['full_scans']]
+        if scans and options['fail_on_scan']:
+            raise CommandError(f'Full table scans of files_fileupload in: {", ".join(scans)}')
+
+    def _cases(self, media):
+        # One entry per URL pattern (plus a deep page of the home list).
+        visible = _catalog_queryset()
+        newest = visible.first()
+        middle = visible[visible.count() // 2]
+        token = SignedFileSystemStorage(location=media).signed_url(BENCH_FILE, expires_in=3600).rstrip('/').rsplit('/', 1)[-1]
+        return [
+            ('home', reverse('files:home')),
+            ('home (deep page)', reverse('files:home') + f'?after={_encode_cursor(middle)}'),
+            ('level', reverse('files:level', args=[2])),
+            ('category', reverse('files:category', args=['past_papers'])),
+            ('semester', reverse('files:semester', args=[2])),
+            ('home (level+category+semester)', reverse('files:home') + '?level=3&category=notes&semester=1'),
+            ('search', reverse('files:search') + '?q=bench'),
+            ('download', reverse('files:download', args=[newest.pk])),
+            ('preview', reverse('files:preview', args=[newest.pk])),
+            ('preview_page', reverse('files:preview_page', args=[newest.pk])),
+            ('facets', reverse('files:facets') + '?level=2'),
+            ('thumbnail', reverse('files:thumbnail', args=[newest.pk])),
+            ('signed_media', reverse('files:signed_media', args=[token])),
+            ('register', reverse('files:register')),
+            ('login', reverse('files:login')),
+        ]
+
+    def _run(self, media, options):
+        # Expected 404s (e.g. no thumbnail for text files) would be logged on every request.
+        logging.getLogger('django.request').setLevel(logging.ERROR)
+        User.objects.create_user('bench', password='bench')
+        client = Client()
+        client.login(username='bench', password='bench')
+        results = []
+        for name, url in self._cases(media):
+            connection.queries_log.clear()
+            with CaptureQueriesContext(connection) as captured:
+                response = client.get(url)
+                self._drain(response)
+            queries = list(captured.captured_queries)
+            plans = [self._explain(q['sql']) for q in queries if q['sql'].lstrip().upper().startswith('SELECT')]
+            timings = []
+            for _ in range(max(1, options['repeat'])):
+                started = time.perf_counter()
+                self._drain(client.get(url))
+                timings.append(time.perf_counter() - started)
+            results.append({
+                'name': name,
+                'url': url,
+                'status': response.status_code,
+                'queries': len(queries),
+                'latency_ms': percentiles(timings),
+                'full_scans': sum(p['full_scan'] for p in plans),
+                'plans': plans,
+            })
+        return results
+
+    def _drain(self, response):
+        # Streamed bodies only do their work when read.
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        response.close()
+
+    def _explain(self, sql):
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql)
+            rows = cursor.fetchall()
+        # SQLite rows are (id, parent, notused, detail); others return one text column.
+        details = [str(row[-1]) for row in rows]
+        return {
+            'sql': sql if len(sql) <= 200 else sql[:197] + '...',
+            'plan': details,
+            'full_scan': any(
+                d.startswith('SCAN files_fileupload') and 'USING' not in d for d in details
+            ),
+        }
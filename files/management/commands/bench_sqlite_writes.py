@@ -0,0 +1,79 @@
+import json
+import multiprocessing
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from files.benchmarking import percentiles, seed_uploads, sqlite_write_worker, temporary_database
+
+# SQLite's own defaults as Django uses them: rollback journal, deferred
+# transactions and the sqlite3 module's 5 second busy timeout.
+DEFAULT_OPTIONS = {}
+
+
+class Command(BaseCommand):
+    help = 'Run concurrent writer processes against a scratch SQLite file with default and with the configured DATABASES OPTIONS.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=4, help='Writer processes (default 4).')
+        parser.add_argument('--ops', type=int, default=300, help='Writes per process (default 300).')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('This benchmark is for the SQLite backend.')
+        tuned = settings.DATABASES['default'].get('OPTIONS', {})
+        with temporary_database():
+            db_path = str(connection.settings_dict['NAME'])
+            seed_uploads(200)
+            connection.close()
+            report = {
+                'processes': options['processes'],
+                'ops_per_process': options['ops'],
+                'default': self._run(db_path, DEFAULT_OPTIONS, options, journal_mode='DELETE'),
+                'tuned': dict(self._run(db_path, tuned, options), options=tuned),
+            }
+        base, new = report['default']['writes_per_sec'], report['tuned']['writes_per_sec']
+        if base and new:
+            report['speedup'] = round(new / base, 2)
+        self.stdout.write(json.dumps(report, indent=2, default=str))
+
+    def _run(self, db_path, db_options, options, journal_mode=None):
+        if journal_mode:
+            # WAL is a property of the file, so switch it back for the baseline.
+            connection.cursor().execute(f'PRAGMA journal_mode={journal_mode}')
+            connection.close()
+        # spawn: each writer is a fresh process with its own connection, as
+        # with separate gunicorn workers.
+        context = multiprocessing.get_context('spawn')
+        processes = max(1, options['processes'])
+        barrier = context.Barrier(processes)
+        results = context.Queue()
+        workers = [
+            context.Process(target=sqlite_write_worker, args=(db_path, db_options, options['ops'], seed, barrier, results))
+            for seed in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        collected = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        attempted = processes * options['ops']
+        errors = sum(r['errors'] for r in collected)
+        elapsed = max(r['seconds'] for r in collected)
+        # A bare connection (no init_command) sees the mode the writers left.
+        raw = sqlite3.connect(db_path)
+        try:
+            mode = raw.execute('PRAGMA journal_mode').fetchone()[0]
+        finally:
+            raw.close()
+        return {
+            'journal_mode': mode,
+            'writes': attempted,
+            'lock_errors': errors,
+            'seconds': round(elapsed, 3),
+            'writes_per_sec': round((attempted - errors) / elapsed, 1) if elapsed else None,
+            'latency_ms': percentiles([s for r in collected for s in r['latencies']]),
+        }
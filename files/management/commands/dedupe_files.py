@@ -0,0 +1,81 @@
+import json
+import os
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from files.models import Blob, FileUpload, compute_checksum
+
+
+class Command(BaseCommand):
+    help = 'Point uploads with identical contents at one stored file, delete the copies and record blob reference counts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be reclaimed without changing anything.')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        computed = self._fill_checksums(dry_run)
+
+        # checksum -> {storage name: [pks]}, oldest name first
+        groups = defaultdict(dict)
+        sizes = {}
+        rows = FileUpload.objects.exclude(file='').order_by('pk').values_list('pk', 'file', 'checksum', 'size')
+        for pk, name, checksum, size in rows.iterator():
+            checksum, size = computed.get(pk, (checksum, size))
+            if not checksum:
+                continue  # unreadable; reported above
+            groups[checksum].setdefault(name, []).append(pk)
+            sizes[checksum] = size
+        existing = dict(Blob.objects.values_list('sha256', 'name'))
+
+        removed = reclaimed = 0
+        for checksum, names in groups.items():
+            keep = existing.get(checksum)
+            if keep not in names:
+                keep = next(iter(names))
+            copies = [n for n in names if n != keep]
+            removed += len(copies)
+            reclaimed += sizes[checksum] * len(copies)
+            if dry_run:
+                continue
+            storage = FileUpload._meta.get_field('file').storage
+            with transaction.atomic():
+                for name in copies:
+                    # Keep each upload's own filename for downloads before repointing it.
+                    FileUpload.objects.filter(file=name, original_name='').update(original_name=os.path.basename(name)[:255])
+                if copies:
+                    FileUpload.objects.filter(file__in=copies).update(file=keep)
+                refcount = sum(len(pks) for pks in names.values())
+                Blob.objects.update_or_create(
+                    sha256=checksum, defaults={'name': keep, 'size': sizes[checksum], 'refcount': refcount},
+                )
+            for name in copies:
+                # Only after the rows point elsewhere; a leftover file is harmless.
+                try:
+                    storage.delete(name)
+                except Exception as exc:
+                    self.stderr.write(f'Could not delete {name}: {exc}')
+
+        self.stdout.write(json.dumps({
+            'dry_run': dry_run,
+            'unique_files': len(groups),
+            'duplicate_files_removed': removed,
+            'bytes_reclaimed': reclaimed,
+        }, indent=2))
+
+    def _fill_checksums(self, dry_run):
+        # Rows saved before checksums were stored (or by the backfill without
+        # --checksum). Returns {pk: (checksum, size)} for the rows filled in.
+        computed = {}
+        for obj in FileUpload.objects.exclude(file='').filter(checksum='').order_by('pk'):
+            try:
+                computed[obj.pk] = (compute_checksum(obj.file), obj.size or obj.file.size)
+            except Exception as exc:
+                self.stderr.write(f'#{obj.pk} {obj.file.name}: {exc}')
+                continue
+            if not dry_run:
+                checksum, size = computed[obj.pk]
+                FileUpload.objects.filter(pk=obj.pk).update(checksum=checksum, size=size)
+        return computed
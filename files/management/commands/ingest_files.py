@@ -0,0 +1,58 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from files import ingest
+
+
+class Command(BaseCommand):
+    help = 'Bulk-add files from a directory or ZIP, described by a metadata CSV (filename,title,level,category,semester).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Directory or .zip containing the files.')
+        parser.add_argument('metadata', help='CSV with filename,title,level,category,semester columns.')
+        parser.add_argument('--manifest', help='Progress manifest (default: <source>.ingest.jsonl). Re-run with it to resume.')
+        parser.add_argument('--workers', type=int, default=ingest.DEFAULT_WORKERS, help=f'Parallel uploads (default {ingest.DEFAULT_WORKERS}).')
+        parser.add_argument('--uploaded-by', help='Username recorded as the uploader.')
+        parser.add_argument('--no-notify', action='store_true', help='Do not queue the summary notification email.')
+
+    def handle(self, *args, **options):
+        uploaded_by = None
+        if options['uploaded_by']:
+            uploaded_by = User.objects.filter(username=options['uploaded_by']).first()
+            if uploaded_by is None:
+                raise CommandError(f"No user named {options['uploaded_by']!r}")
+        try:
+            with open(options['metadata'], newline='', encoding='utf-8-sig') as fh:
+                rows = ingest.read_metadata(fh)
+        except OSError as exc:
+            raise CommandError(f'Could not read metadata CSV: {exc}')
+        except ingest.IngestError as exc:
+            raise CommandError(str(exc))
+
+        manifest = options['manifest'] or f"{str(options['source']).rstrip('/')}.ingest.jsonl"
+        try:
+            result = ingest.ingest(
+                options['source'], rows,
+                manifest_path=manifest,
+                workers=options['workers'],
+                uploaded_by=uploaded_by,
+                notify=not options['no_notify'],
+                progress=self.stdout.write,
+            )
+        except ingest.IngestError as exc:
+            raise CommandError(str(exc))
+
+        self.stdout.write(json.dumps({
+            'created': len(result.created),
+            'skipped': result.skipped,
+            'recovered': len(result.recovered),
+            'failed': len(result.failed),
+            'seconds': round(result.seconds, 2),
+            'files_per_sec': result.files_per_sec,
+            'mb_per_sec': result.mb_per_sec,
+            'manifest': manifest,
+        }, indent=2))
+        for filename, error in result.failed:
+            self.stderr.write(f'{filename}: {error}')
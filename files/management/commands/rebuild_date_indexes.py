@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from files.checks import date_indexes
+from files.models import FileUpload
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the catalog date indexes for the current TIME_ZONE (run after changing it).'
+
+    def handle(self, *args, **options):
+        indexes = date_indexes()
+        with connection.schema_editor() as editor:
+            for index in indexes:
+                editor.remove_index(FileUpload, index)
+                editor.add_index(FileUpload, index)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {len(indexes)} index(es).'))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from files import search
+from files.models import FileUpload
+
+
+class Command(BaseCommand):
+    help = 'Re-extract document text and rebuild the full-text search index for every upload.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Uploads indexed per transaction (default 100).')
+
+    def handle(self, *args, **options):
+        if not search.fts_enabled():
+            self.stdout.write('Full-text index requires SQLite; nothing to do.')
+            return
+        batch_size = max(1, options['batch_size'])
+        pks = list(FileUpload.objects.order_by('pk').values_list('pk', flat=True))
+        with transaction.atomic():
+            search.clear_index()
+        for start in range(0, len(pks), batch_size):
+            with transaction.atomic():
+                for obj in FileUpload.objects.filter(pk__in=pks[start:start + batch_size]):
+                    search.index_file(obj)
+            self.stdout.write(f'{min(start + batch_size, len(pks))}/{len(pks)} indexed')
+        search.optimize_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {len(pks)} upload(s).'))
@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from files import counters, rollups
+
+
+class Command(BaseCommand):
+    help = 'Aggregate download events into daily per-file and per-level summaries, then prune old raw events.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep running every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=300.0, help='Seconds between runs with --loop (default 300).')
+        parser.add_argument('--retention-days', type=int, default=None,
+                            help='Keep raw events this many days (default DOWNLOAD_EVENT_RETENTION_DAYS).')
+        parser.add_argument('--no-prune', action='store_true', help='Only roll up; keep every raw event.')
+
+    def handle(self, *args, **options):
+        while True:
+            self.run_once(options)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def run_once(self, options):
+        # Include anything still buffered in this process.
+        counters.flush()
+        days = rollups.rollup()
+        message = f'Rolled up {len(days)} day(s)'
+        if days:
+            message += f' ({days[0]:%Y-%m-%d} to {days[-1]:%Y-%m-%d})'
+        if not options['no_prune']:
+            message += f', pruned {rollups.prune(options["retention_days"])} old event(s)'
+        self.stdout.write(message + '.')
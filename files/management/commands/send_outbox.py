@@ -0,0 +1,163 @@
+import datetime
+import time
+
+from django.contrib.auth.models import User
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from files.models import EmailLog, EmailOutbox
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued emails from the outbox over a single SMTP connection.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep polling the outbox instead of exiting when it is empty.')
+        parser.add_argument('--interval', type=float, default=10.0, help='Seconds between polls with --loop (default 10).')
+        parser.add_argument('--batch', type=int, default=20, help='Outbox rows handled per poll (default 20).')
+        parser.add_argument('--chunk-size', type=int, default=50, help='Recipients per message (default 50).')
+        parser.add_argument('--retries', type=int, default=3, help='Immediate retries per chunk before giving up for now (default 3).')
+        parser.add_argument('--backoff', type=float, default=2.0, help='Base delay in seconds between chunk retries (default 2).')
+        parser.add_argument('--max-attempts', type=int, default=5, help='Runs after which a message is marked failed (default 5).')
+        parser.add_argument('--lease', type=float, default=600.0,
+                            help='Seconds a claimed message stays with this worker before another may take it over (default 600).')
+
+    def handle(self, *args, **options):
+        while True:
+            sent = self.drain(options)
+            if not options['loop']:
+                break
+            if not sent:
+                time.sleep(options['interval'])
+
+    def drain(self, options):
+        # Pending rows, plus rows whose worker died mid-send and let its lease run out.
+        candidates = list(
+            EmailOutbox.objects.filter(
+                status__in=[EmailOutbox.STATUS_PENDING, EmailOutbox.STATUS_SENDING],
+                next_attempt_at__lte=timezone.now(),
+            ).order_by('next_attempt_at', 'pk')[:options['batch']]
+        )
+        due = [message for message in candidates if self.claim(message, options)]
+        if not due:
+            return 0
+        # One connection for the whole batch instead of one per send_mail call.
+        connection = get_connection(fail_silently=False)
+        try:
+            for message in due:
+                self.deliver(message, connection, options)
+        finally:
+            try:
+                connection.close()
+            except Exception:
+                pass
+        return len(due)
+
+    def claim(self, message, options):
+        """Take `message` for this worker; False if another worker got it first.
+
+        The update only matches while the row still has the status and
+        next_attempt_at we read, so of several workers (or a cron run next to
+        a --loop worker) exactly one wins.
+        """
+        lease_until = timezone.now() + datetime.timedelta(seconds=options['lease'])
+        claimed = EmailOutbox.objects.filter(
+            pk=message.pk, status=message.status, next_attempt_at=message.next_attempt_at,
+        ).update(status=EmailOutbox.STATUS_SENDING, next_attempt_at=lease_until)
+        if claimed:
+            message.status = EmailOutbox.STATUS_SENDING
+            message.next_attempt_at = lease_until
+        return bool(claimed)
+
+    def deliver(self, message, connection, options):
+        if message.broadcast and not message.recipients:
+            # Resolve "all active users" once, then keep the list so retries
+            # resume at the same position.
+            emails = User.objects.filter(is_active=True).exclude(email='').values_list('email', flat=True)
+            message.recipients = ','.join(emails)
+            message.save(update_fields=['recipients'])
+        recipients = [r for r in message.recipients.split(',') if r]
+        chunk_size = max(1, options['chunk_size'])
+        logs = []
+        error = ''
+        while message.sent_upto < len(recipients):
+            chunk = recipients[message.sent_upto:message.sent_upto + chunk_size]
+            error = self.send_chunk(message, chunk, connection, options)
+            logs.append(EmailLog(
+                subject=message.subject,
+                body=message.body,
+                from_email=message.from_email,
+                recipients=','.join(chunk),
+                sent=not error,
+                error=error,
+            ))
+            if error:
+                break
+            message.sent_upto += len(chunk)
+            if not self.checkpoint(message, options):
+                # The lease ran out and another worker took the message over;
+                # it resumes from the last saved position, so stop here.
+                EmailLog.objects.bulk_create(logs)
+                self.stdout.write(f'#{message.pk} {message.subject!r}: lease lost at {message.sent_upto}/{len(recipients)}')
+                return
+
+        if not error:
+            message.status = EmailOutbox.STATUS_SENT
+            message.sent_at = timezone.now()
+            message.last_error = ''
+        else:
+            message.attempts += 1
+            message.last_error = error
+            if message.attempts >= options['max_attempts']:
+                message.status = EmailOutbox.STATUS_FAILED
+            else:
+                message.status = EmailOutbox.STATUS_PENDING
+                # Exponential backoff between runs: 1, 2, 4, 8... minutes.
+                delay = datetime.timedelta(minutes=2 ** (message.attempts - 1))
+                message.next_attempt_at = timezone.now() + delay
+        message.save(update_fields=['sent_upto', 'status', 'sent_at', 'attempts', 'last_error', 'next_attempt_at'])
+        EmailLog.objects.bulk_create(logs)
+        self.stdout.write(f'#{message.pk} {message.subject!r}: {message.sent_upto}/{len(recipients)} recipient(s), {message.status}')
+
+    def checkpoint(self, message, options):
+        """Record progress after a chunk and extend the lease.
+
+        Done in one UPDATE that only matches while this worker still holds
+        the lease, so a crash after a chunk resends at most that chunk and a
+        long broadcast is not taken over while it is still progressing.
+        """
+        lease_until = timezone.now() + datetime.timedelta(seconds=options['lease'])
+        saved = EmailOutbox.objects.filter(
+            pk=message.pk, status=EmailOutbox.STATUS_SENDING, next_attempt_at=message.next_attempt_at,
+        ).update(sent_upto=message.sent_upto, next_attempt_at=lease_until)
+        if saved:
+            message.next_attempt_at = lease_until
+        return bool(saved)
+
+    def send_chunk(self, message, chunk, connection, options):
+        # Return '' on success or the last error message after all retries.
+        email = EmailMessage(
+            subject=message.subject,
+            body=message.body,
+            from_email=message.from_email,
+            bcc=chunk,  # recipients don't see each other's addresses
+            connection=connection,
+        )
+        error = ''
+        attempts = max(1, options['retries'])
+        for attempt in range(attempts):
+            try:
+                if email.send(fail_silently=False):
+                    return ''
+                error = 'no message sent'
+            except Exception as exc:
+                error = str(exc) or exc.__class__.__name__
+                # The SMTP session may be broken; reconnect on the next try.
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            if attempt + 1 < attempts:
+                time.sleep(options['backoff'] * (2 ** attempt))
+        return error
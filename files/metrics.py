@@ -0,0 +1,317 @@
+"""In-process request metrics, exposed at /metrics in Prometheus text format.
+
+MetricsMiddleware times every request and labels it with its URL name
+(`files:home`, `admin:files_fileupload_changelist`, ...). For each name it
+keeps:
+
+* a latency histogram (time until the response is returned; the body of a
+  streamed download is sent afterwards and not included),
+* SQL query count and time, measured with `connection.execute_wrapper`,
+* storage backend calls and time per operation (`size`, `open`, `url`, ...),
+  through an InstrumentedStorage put in front of the upload fields' storage
+  (the storage classes themselves are left alone),
+* bytes sent by streaming responses (FileResponse and ranged downloads), as
+  the server actually takes them; a download the client abandons counts only
+  what it received. Counting means reading the body through Python, so a
+  proxied FileResponse is not handed to the server's wsgi.file_wrapper;
+  FILE_DELIVERY = 'sendfile' is the way to offload large files.
+
+Background jobs can report their duration with `observe_task()` (database
+snapshots do).
+
+Each request does a few counter updates under one lock, so the middleware can
+stay on in production. It works under WSGI and ASGI alike. Numbers are per process: with several gunicorn
+workers each scrape sees the worker that answered it. Set METRICS_ENABLED =
+False to remove the middleware entirely.
+"""
+import bisect
+import contextvars
+import functools
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+PREFIX = 'portal'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STORAGE_METHODS = ('open', 'save', 'delete', 'exists', 'size', 'url', 'listdir', 'get_modified_time')
+
+_lock = threading.Lock()
+_current = contextvars.ContextVar('metrics_request', default=None)
+
+
+class _Histogram:
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _ViewStats:
+    __slots__ = ('duration', 'statuses', 'sql_queries', 'sql_seconds', 'storage_calls', 'storage_seconds', 'streamed_bytes')
+
+    def __init__(self):
+        self.duration = _Histogram()
+        self.statuses = defaultdict(int)  # '2xx' -> requests
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.storage_calls = defaultdict(int)  # operation -> calls
+        self.storage_seconds = defaultdict(float)
+        self.streamed_bytes = 0
+
+
+class _RequestState:
+    __slots__ = ('sql_queries', 'sql_seconds', 'storage')
+
+    def __init__(self):
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.storage = {}  # operation -> [calls, seconds]
+
+
+_views = defaultdict(_ViewStats)
+_tasks = defaultdict(_Histogram)
+
+
+def enabled():
+    return bool(getattr(settings, 'METRICS_ENABLED', True))
+
+
+def _sql_timer(execute, sql, params, many, context):
+    state = _current.get()
+    if state is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        state.sql_queries += 1
+        state.sql_seconds += time.perf_counter() - started
+
+
+def _add_sql_timer(sender, connection, **kwargs):
+    # Under ASGI queries run on sync_to_async threads, each with its own
+    # connection, so the timer goes on every connection; the request's state
+    # reaches those threads through the copied context.
+    if _sql_timer not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_sql_timer)
+
+
+def _timed_storage(operation, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        state = _current.get()
+        if state is None:
+            return method(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            entry = state.storage.setdefault(operation, [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.perf_counter() - started
+    return wrapper
+
+
+class InstrumentedStorage:
+    """Times the backend calls (STORAGE_METHODS) made through it.
+
+    Everything else is passed to the wrapped storage, and isinstance() sees
+    the wrapped class (as with django's lazy default_storage), so checks such
+    as "is this a FileSystemStorage?" are unaffected. Calls a storage makes
+    on itself (save() calling exists()) don't pass through the wrapper and
+    aren't timed twice.
+    """
+
+    def __init__(self, storage):
+        self._wrapped = storage
+
+    @property
+    def __class__(self):
+        return self._wrapped.__class__
+
+    def __getattr__(self, name):
+        value = getattr(self._wrapped, name)
+        if name in STORAGE_METHODS:
+            return _timed_storage(name, value)
+        return value
+
+    def __repr__(self):
+        return f'<InstrumentedStorage {self._wrapped!r}>'
+
+
+def instrument_field(field):
+    """Put an InstrumentedStorage in front of a FileField's storage (once)."""
+    if type(field.storage) is not InstrumentedStorage:
+        field.storage = InstrumentedStorage(field.storage)
+
+
+def _record(view, status, seconds, state):
+    with _lock:
+        stats = _views[view]
+        stats.duration.observe(seconds)
+        stats.statuses[f'{status // 100}xx'] += 1
+        stats.sql_queries += state.sql_queries
+        stats.sql_seconds += state.sql_seconds
+        for operation, (calls, spent) in state.storage.items():
+            stats.storage_calls[operation] += calls
+            stats.storage_seconds[operation] += spent
+
+
+def _add_streamed(view, count):
+    with _lock:
+        _views[view].streamed_bytes += count
+
+
+def _counting(iterable, view):
+    sent = 0
+    try:
+        for chunk in iterable:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        _add_streamed(view, sent)
+
+
+async def _acounting(iterable, view):
+    sent = 0
+    try:
+        async for chunk in iterable:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        _add_streamed(view, sent)
+
+
+def _count_streamed(response, view):
+    counting = _acounting if response.is_async else _counting
+    response.streaming_content = counting(response.streaming_content, view)
+
+
+def observe_task(name, seconds):
+    """Record how long a background job (`name`) took."""
+    with _lock:
+        _tasks[name].observe(seconds)
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+            connection_created.connect(_add_sql_timer, dispatch_uid='metrics_sql_timer')
+        from .models import FileUpload
+        for name in ('file', 'thumbnail'):
+            instrument_field(FileUpload._meta.get_field(name))
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        state = _RequestState()
+        token = _current.set(state)
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(_sql_timer):
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._finish(request, response, started, state)
+        return response
+
+    async def __acall__(self, request):
+        state = _RequestState()
+        token = _current.set(state)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._finish(request, response, started, state)
+        return response
+
+    def _finish(self, request, response, started, state):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unmatched'
+        _record(view, response.status_code, time.perf_counter() - started, state)
+        if response.streaming:
+            _count_streamed(response, view)
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _histogram_lines(name, histogram, labels):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS + ('+Inf',), histogram.buckets):
+        cumulative += count
+        lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {cumulative}')
+    lines.append(f'{name}_sum{_labels(**labels)} {histogram.sum:.6f}')
+    lines.append(f'{name}_count{_labels(**labels)} {histogram.count}')
+    return lines
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        views = sorted(_views.items())
+        tasks = sorted(_tasks.items())
+        out = []
+
+        def family(name, kind, help_text, lines):
+            out.append(f'# HELP {PREFIX}_{name} {help_text}')
+            out.append(f'# TYPE {PREFIX}_{name} {kind}')
+            out.extend(lines)
+
+        family('http_request_duration_seconds', 'histogram', 'Time to produce the response, by URL name.', [
+            line for view, s in views
+            for line in _histogram_lines(f'{PREFIX}_http_request_duration_seconds', s.duration, {'view': view})
+        ])
+        family('http_requests_total', 'counter', 'Responses by URL name and status class.', [
+            f'{PREFIX}_http_requests_total{_labels(view=view, status=status)} {n}'
+            for view, s in views for status, n in sorted(s.statuses.items())
+        ])
+        family('db_queries_total', 'counter', 'SQL queries run while handling requests.', [
+            f'{PREFIX}_db_queries_total{_labels(view=view)} {s.sql_queries}' for view, s in views
+        ])
+        family('db_query_seconds_total', 'counter', 'Time spent in SQL queries.', [
+            f'{PREFIX}_db_query_seconds_total{_labels(view=view)} {s.sql_seconds:.6f}' for view, s in views
+        ])
+        family('storage_calls_total', 'counter', 'File storage backend calls by operation.', [
+            f'{PREFIX}_storage_calls_total{_labels(view=view, operation=op)} {n}'
+            for view, s in views for op, n in sorted(s.storage_calls.items())
+        ])
+        family('storage_seconds_total', 'counter', 'Time spent in file storage backend calls.', [
+            f'{PREFIX}_storage_seconds_total{_labels(view=view, operation=op)} {t:.6f}'
+            for view, s in views for op, t in sorted(s.storage_seconds.items())
+        ])
+        family('streamed_bytes_total', 'counter', 'Bytes sent by streaming responses.', [
+            f'{PREFIX}_streamed_bytes_total{_labels(view=view)} {s.streamed_bytes}'
+            for view, s in views if s.streamed_bytes
+        ])
+        family('task_duration_seconds', 'histogram', 'Duration of background jobs.', [
+            line for name, h in tasks
+            for line in _histogram_lines(f'{PREFIX}_task_duration_seconds', h, {'task': name})
+        ])
+    return '\n'.join(out) + '\n'
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.10 on 2026-10-18 06:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0008_emaillog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileupload',
+            name='checksum',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='fileupload',
+            name='content_type',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='fileupload',
+            name='extension',
+            field=models.CharField(blank=True, editable=False, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='fileupload',
+            name='size',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
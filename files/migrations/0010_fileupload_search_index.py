@@ -0,0 +1,35 @@
+# Full-text search index for FileUpload (SQLite FTS5).
+
+from django.db import migrations
+
+
+def create_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS files_fileupload_fts USING fts5("
+        "title, body, tokenize = 'porter unicode61 remove_diacritics 2')"
+    )
+    # Seed titles for existing uploads; document text is added by
+    # `manage.py rebuild_search_index`.
+    schema_editor.execute(
+        "INSERT INTO files_fileupload_fts (rowid, title, body) "
+        "SELECT id, title, '' FROM files_fileupload"
+    )
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS files_fileupload_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0009_fileupload_file_metadata'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 06:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0011_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileupload',
+            name='thumbnail',
+            field=models.FileField(blank=True, editable=False, upload_to='uploads/thumbs/'),
+        ),
+    ]
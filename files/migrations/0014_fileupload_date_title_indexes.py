@@ -0,0 +1,37 @@
+# Generated by Django 5.2.10 on 2026-10-18 07:48
+
+import django.db.models.functions.text
+import files.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0013_catalogversion'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='fileupload',
+            index=models.Index(models.OrderBy(files.models.LocalDate('uploaded_at'), descending=True), django.db.models.functions.text.Lower('title'), models.F('id'), condition=models.Q(('archived', False)), name='file_visible_date_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileupload',
+            index=models.Index(models.F('level'), models.OrderBy(files.models.LocalDate('uploaded_at'), descending=True), django.db.models.functions.text.Lower('title'), models.F('id'), condition=models.Q(('archived', False)), name='file_level_date_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileupload',
+            index=models.Index(models.F('category'), models.OrderBy(files.models.LocalDate('uploaded_at'), descending=True), django.db.models.functions.text.Lower('title'), models.F('id'), condition=models.Q(('archived', False)), name='file_category_date_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileupload',
+            index=models.Index(models.F('semester'), models.OrderBy(files.models.LocalDate('uploaded_at'), descending=True), django.db.models.functions.text.Lower('title'), models.F('id'), condition=models.Q(('archived', False)), name='file_semester_date_title_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='fileupload',
+            index=models.Index(models.F('level'), models.F('category'), models.F('semester'), models.OrderBy(files.models.LocalDate('uploaded_at'), descending=True), django.db.models.functions.text.Lower('title'), models.F('id'), condition=models.Q(('archived', False)), name='file_facet_date_title_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.10 on 2026-10-18 07:45
+
+from django.db import migrations, models
+
+
+def mark_broadcasts(apps, schema_editor):
+    # Before this migration a blank recipient list meant "every active user".
+    EmailOutbox = apps.get_model('files', 'EmailOutbox')
+    EmailOutbox.objects.filter(recipients='').update(broadcast=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0019_download_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailoutbox',
+            name='broadcast',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_broadcasts, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='emailoutbox',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+    ]
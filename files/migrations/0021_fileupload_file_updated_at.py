@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 07:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0020_emailoutbox_broadcast_claim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileupload',
+            name='file_updated_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 07:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0021_fileupload_file_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileupload',
+            name='original_name',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+    ]
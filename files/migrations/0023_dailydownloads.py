@@ -0,0 +1,49 @@
+# Generated by Django 5.2.10 on 2026-10-18 07:55
+
+import datetime
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+
+def fill_daily_downloads(apps, schema_editor):
+    # Rebuild the totals of days already rolled up from the events still kept;
+    # days whose events were pruned keep only their per-level rows.
+    DailyDownloads = apps.get_model('files', 'DailyDownloads')
+    DailyLevelDownloads = apps.get_model('files', 'DailyLevelDownloads')
+    DownloadEvent = apps.get_model('files', 'DownloadEvent')
+    DownloadRollupState = apps.get_model('files', 'DownloadRollupState')
+    state = DownloadRollupState.objects.filter(pk=1).first()
+    if state is None:
+        return
+    tz = timezone.get_default_timezone()
+    for day in DailyLevelDownloads.objects.values_list('day', flat=True).distinct().order_by():
+        start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min), tz)
+        end = timezone.make_aware(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min), tz)
+        totals = DownloadEvent.objects.filter(
+            created_at__gte=start, created_at__lt=end, pk__lte=state.last_event_id,
+        ).aggregate(downloads=Count('pk'), users=Count('user_id', distinct=True), bytes_served=Sum('bytes_served'))
+        if totals['downloads']:
+            DailyDownloads.objects.create(day=day, **totals)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0022_fileupload_original_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyDownloads',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('downloads', models.PositiveIntegerField(default=0)),
+                ('users', models.PositiveIntegerField(default=0)),
+                ('bytes_served', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(fill_daily_downloads, migrations.RunPython.noop),
+    ]
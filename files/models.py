@@ -1,5 +1,12 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Lower, TruncDate
+from django.utils import timezone
 import os
+import hashlib
+import mimetypes
+import uuid
+import zoneinfo
+from functools import cache
 # Import Django's model base and field types.
 from django.contrib.auth.models import User
 # Import the built-in User model to attach a student profile.
@@ -28,6 +35,39 @@ SEMESTER_CHOICES = [
 ]
 
 
+class LocalDate(TruncDate):
+    """TruncDate that SQLite can match against an expression index.
+
+    SQLite only uses an expression index when a query repeats the indexed
+    expression exactly, and the time zone names Django normally passes as
+    query parameters never match the literals in the index definition. When
+    no conversion is needed (TIME_ZONE is the connection's zone, e.g. UTC)
+    this compiles to SQLite's own date(), which also keeps the table
+    writable from tools without Django's functions (such as dbshell);
+    otherwise the zone names are inlined. Only known IANA zone names are
+    inlined; anything else stays a query parameter.
+
+    The index is built for the TIME_ZONE in force when it was created; after
+    changing it run `manage.py rebuild_date_indexes` (files.W001 warns).
+    """
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        tzname = self.get_tzname()
+        if tzname is None or tzname == connection.timezone_name:
+            sql, params = compiler.compile(self.lhs)
+            return f'date({sql})', params
+        sql, params = self.as_sql(compiler, connection, **extra_context)
+        if params and all(isinstance(p, str) and p in _zone_names() for p in params):
+            # Zone names are letters, digits and /_+- only.
+            return sql % tuple(f"'{p}'" for p in params), ()
+        return sql, params
+
+
+@cache
+def _zone_names():
+    return zoneinfo.available_timezones() | {'UTC'}
+
+
 class FileUpload(models.Model):
     # Model representing an uploaded file with a title, level, category and timestamp.
     title = models.CharField(max_length=255)
@@ -36,10 +76,14 @@ class FileUpload(models.Model):
     # PositiveSmallIntegerField stores small integers; choices restrict values to 1-5.
     file = models.FileField(upload_to='uploads/')
     # FileField stores the uploaded file and saves it under MEDIA_ROOT/uploads/.
+    original_name = models.CharField(max_length=255, blank=True, editable=False)
+    # Filename as uploaded; `file` may point at a shared copy stored under another name.
     category = models.CharField(max_length=20, choices=CATEGORY_CHOICES, default='notes')
     # CharField with choices to restrict category values and display readable labels.
     uploaded_at = models.DateTimeField(auto_now_add=True)
     # Timestamp automatically set when the object is first created.
+    file_updated_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # When the file contents last changed (null: not since uploaded_at). Sent as Last-Modified.
     semester = models.PositiveSmallIntegerField(choices=SEMESTER_CHOICES, default=1)
     # Semester of the uploaded file (1 or 2).
     uploaded_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
@@ -48,27 +92,177 @@ class FileUpload(models.Model):
     # Mark item archived instead of deleting.
     download_count = models.PositiveIntegerField(default=0)
     # Track how many times this file has been downloaded.
+    size = models.PositiveBigIntegerField(default=0, editable=False)
+    # File size in bytes, recorded on save so listings never ask the storage backend.
+    content_type = models.CharField(max_length=100, blank=True, editable=False)
+    # MIME type guessed from the filename when the file is saved.
+    extension = models.CharField(max_length=16, blank=True, editable=False)
+    # Lowercase extension without the dot (e.g. 'pdf').
+    checksum = models.CharField(max_length=64, blank=True, editable=False)
+    # SHA-256 hex digest of the file contents (blank until computed).
+    thumbnail = models.FileField(upload_to='uploads/thumbs/', blank=True, editable=False)
+    # Small WebP preview for the home page cards (see files/thumbnails.py).
+
+    class Meta:
+        # Partial indexes over visible files, matching the home page queries:
+        # local upload date (newest first) then lowercased title, optionally
+        # filtered by level, category and/or semester. The last one also covers
+        # the grouped filter counts. See files.views._catalog_queryset.
+        indexes = [
+            models.Index(
+                LocalDate('uploaded_at').desc(), Lower('title'), 'id',
+                condition=models.Q(archived=False), name='file_visible_date_title_idx',
+            ),
+            models.Index(
+                'level', LocalDate('uploaded_at').desc(), Lower('title'), 'id',
+                condition=models.Q(archived=False), name='file_level_date_title_idx',
+            ),
+            models.Index(
+                'category', LocalDate('uploaded_at').desc(), Lower('title'), 'id',
+                condition=models.Q(archived=False), name='file_category_date_title_idx',
+            ),
+            models.Index(
+                'semester', LocalDate('uploaded_at').desc(), Lower('title'), 'id',
+                condition=models.Q(archived=False), name='file_semester_date_title_idx',
+            ),
+            models.Index(
+                'level', 'category', 'semester', LocalDate('uploaded_at').desc(), Lower('title'), 'id',
+                condition=models.Q(archived=False), name='file_facet_date_title_idx',
+            ),
+        ]
 
     def __str__(self):
         # Human-readable display of the object, used in admin listings.
         return f"{self.title} - Level {self.level} ({self.uploaded_at:%Y-%m-%d %H:%M})"
 
+    def save(self, *args, **kwargs):
+        # Record size/type/checksum whenever a new file is attached (or the row
+        # has never been filled in) so reads can use the stored columns.
+        # Remember whether new file contents arrived so post_save receivers
+        # (e.g. the search index) know to re-read the file.
+        self._file_changed = bool(self.file) and not getattr(self.file, '_committed', True)
+        previous_name = previous_thumbnail = None
+        if self._file_changed and self.pk:
+            previous_name, previous_thumbnail = (
+                type(self).objects.filter(pk=self.pk).values_list('file', 'thumbnail').first() or (None, None)
+            )
+        if kwargs.get('update_fields') is None and self.file:
+            if self._file_changed:
+                self.original_name = os.path.basename(self.file.name)[:255]
+            if self._file_changed or not self.content_type:
+                self.populate_file_metadata()
+            if self._file_changed:
+                if self.pk:
+                    self.file_updated_at = timezone.now()
+                # The old thumbnail shows the previous file; a new one is generated.
+                self.thumbnail = ''
+        upload, upload_name, stored_name = self.file, None, None
+        try:
+            # The blob reference, the row and the release of the replaced file
+            # are committed together; nothing is counted for a failed save.
+            with transaction.atomic(using=kwargs.get('using')):
+                if self._file_changed and kwargs.get('update_fields') is None:
+                    upload_name = self.file.name
+                    stored_name = self._store_file()
+                super().save(*args, **kwargs)
+                if previous_name and previous_name != self.file.name:
+                    # The replaced contents may still be shared with other uploads.
+                    from .blobs import release
+                    release(self.file.storage, previous_name)
+        except Exception:
+            if stored_name:
+                # Stored for this save only; its blob row was rolled back with it.
+                upload.storage.delete(stored_name)
+            if upload_name is not None:
+                # Leave the upload unsaved so the instance can be saved again.
+                upload.name, upload._committed = upload_name, False
+                self.file = upload
+            raise
+        if previous_thumbnail:
+            # Thumbnails are never shared; drop the stale one once the save is final.
+            storage = self.thumbnail.storage
+            transaction.on_commit(lambda: storage.delete(previous_thumbnail), robust=True)
+
+    def _store_file(self):
+        # Identical contents are stored once: reuse the existing blob if there
+        # is one, otherwise save the upload now (FileField.pre_save then sees
+        # a committed file and leaves it alone). Returns the name of a newly
+        # stored file, or None when an existing one was reused.
+        from .blobs import claim
+
+        def store():
+            self.file.save(self.file.name, self.file.file, save=False)
+            return self.file.name
+
+        name, reused = claim(self.file.storage, self.checksum, self.size, store)
+        if reused:
+            # Extension and type stay those of the uploaded name (original_name).
+            self.file.name = name
+            self.file._committed = True
+            return None
+        return name
+
+    def populate_file_metadata(self, with_checksum=True):
+        """Fill size, content_type, extension and (optionally) checksum from the file."""
+        name = self.original_name or self.file.name or ''
+        self.extension = os.path.splitext(name)[1].lstrip('.').lower()[:16]
+        self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        try:
+            # For a fresh upload this is the in-memory/temporary file's size; for an
+            # already stored file it is a single storage call (used by the backfill).
+            self.size = self.file.size or 0
+        except Exception:
+            self.size = 0
+        if with_checksum:
+            try:
+                self.checksum = compute_checksum(self.file)
+            except Exception:
+                self.checksum = ''
+
     @property
     def file_type(self):
         """Return the file extension (e.g. 'pdf', 'jpg') in lowercase without the dot."""
+        if self.extension:
+            return self.extension
         try:
-            return os.path.splitext(self.file.name)[1].lstrip('.').lower()
+            return os.path.splitext(self.download_name)[1].lstrip('.').lower()
         except Exception:
             return ''
 
     @property
     def file_size(self):
         """Return the file size in bytes (0 if unavailable)."""
+        if self.size or self.content_type:
+            return self.size
+        # Rows saved before metadata was stored: fall back to the storage backend
+        # until `manage.py backfill_file_metadata` has been run.
         try:
             return self.file.size or 0
         except Exception:
             return 0
 
+    @property
+    def thumbnail_supported(self):
+        """True when a thumbnail can be shown for this file type."""
+        from .thumbnails import is_supported
+        return is_supported(self)
+
+    @property
+    def download_name(self):
+        """Filename offered to the browser: the uploaded name, not the storage one."""
+        return self.original_name or os.path.basename(self.file.name or '')
+
+    @property
+    def file_modified_at(self):
+        """When the current file contents were stored."""
+        return self.file_updated_at or self.uploaded_at
+
+    def get_content_type(self):
+        """Return the stored MIME type, guessing from the filename for old rows."""
+        if self.content_type:
+            return self.content_type
+        return mimetypes.guess_type(self.download_name)[0] or 'application/octet-stream'
+
     @property
     def file_size_display(self):
         """Return a human-readable file size string (KB/MB)."""
@@ -82,18 +276,147 @@ class FileUpload(models.Model):
             size = size / 1024.0
         return f"{self.file_size} bytes"
 
-    def increment_downloads(self):
-        """Increment download_count safely and save the model."""
-        try:
-            self.download_count = (self.download_count or 0) + 1
-            # Use update to avoid race when multiple downloads occur.
-            type(self).objects.filter(pk=self.pk).update(download_count=self.download_count)
-        except Exception:
-            # Fallback: attempt a normal save
-            try:
-                self.save(update_fields=['download_count'])
-            except Exception:
-                pass
+    def increment_downloads(self, user=None, bytes_served=0):
+        """Count one download; buffered in memory and written in batches (see files.counters)."""
+        from .counters import record_download
+        record_download(self.pk, user_id=getattr(user, 'pk', None), level=self.level, bytes_served=bytes_served)
+
+    async def aincrement_downloads(self, user=None, bytes_served=0):
+        """increment_downloads for async views."""
+        from .counters import arecord_download
+        await arecord_download(self.pk, user_id=getattr(user, 'pk', None), level=self.level, bytes_served=bytes_served)
+
+
+def compute_checksum(field_file, chunk_size=64 * 1024):
+    """Return the SHA-256 hex digest of a file, reading it in chunks."""
+    committed = getattr(field_file, '_committed', True)
+    # Uploads received through files.uploadhandlers were hashed while streaming in.
+    precomputed = getattr(getattr(field_file, 'file', None), 'sha256', None) if not committed else None
+    if precomputed:
+        return precomputed
+    digest = hashlib.sha256()
+    if committed:
+        # Stored file: open it through the storage backend and close it afterwards.
+        field_file.open('rb')
+    try:
+        field_file.seek(0)
+        for chunk in field_file.chunks(chunk_size):
+            digest.update(chunk)
+    finally:
+        if committed:
+            field_file.close()
+        else:
+            # Rewind the pending upload so storage saves the whole file.
+            field_file.seek(0)
+    return digest.hexdigest()
+
+
+class Blob(models.Model):
+    """One stored copy of some file contents, shared by every upload with that SHA-256.
+
+    `refcount` is the number of FileUpload rows pointing at `name`; the stored
+    file is deleted when it drops to zero (see files/blobs.py).
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, unique=True)  # storage name, as in FileUpload.file
+    size = models.PositiveBigIntegerField(default=0)
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} reference(s))"
+
+
+class UploadSession(models.Model):
+    """A resumable chunked upload from the admin (see files/chunked.py).
+
+    Chunks are written to a local part file; the FileUpload is created once
+    `received` reaches `size`.
+    """
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    received = models.PositiveBigIntegerField(default=0)  # bytes written, always a whole number of chunks
+    created_by = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size} bytes)"
+
+    @property
+    def complete(self):
+        return self.received >= self.size
+
+
+class DownloadEvent(models.Model):
+    """One counted download, appended in batches by files/counters.py.
+
+    Raw events are kept for DOWNLOAD_EVENT_RETENTION_DAYS; reports read the
+    daily rollups below (see files/rollups.py). No foreign key constraints,
+    so deleting a file or user never touches this table.
+    """
+    file = models.ForeignKey(FileUpload, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    level = models.PositiveSmallIntegerField()  # the file's level at download time
+    bytes_served = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"File {self.file_id} by user {self.user_id} at {self.created_at:%Y-%m-%d %H:%M}"
+
+
+class DailyFileDownloads(models.Model):
+    """Downloads of one file on one (local) day, built by `manage.py rollup_downloads`."""
+    day = models.DateField()
+    file = models.ForeignKey(FileUpload, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    level = models.PositiveSmallIntegerField()
+    downloads = models.PositiveIntegerField(default=0)
+    users = models.PositiveIntegerField(default=0)  # distinct signed-in users
+    bytes_served = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['day', 'file'], name='daily_file_downloads_day_file')]
+        indexes = [models.Index(fields=['level', 'day'])]
+
+    def __str__(self):
+        return f"{self.day}: file {self.file_id} x{self.downloads}"
+
+
+class DailyDownloads(models.Model):
+    """All downloads on one (local) day; `users` counts each user once across levels."""
+    day = models.DateField(unique=True)
+    downloads = models.PositiveIntegerField(default=0)
+    users = models.PositiveIntegerField(default=0)  # distinct signed-in users
+    bytes_served = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.day}: x{self.downloads}"
+
+
+class DailyLevelDownloads(models.Model):
+    """Downloads of one level's files on one (local) day."""
+    day = models.DateField()
+    level = models.PositiveSmallIntegerField(choices=LEVEL_CHOICES)
+    downloads = models.PositiveIntegerField(default=0)
+    users = models.PositiveIntegerField(default=0)  # distinct signed-in users
+    bytes_served = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['day', 'level'], name='daily_level_downloads_day_level')]
+
+    def __str__(self):
+        return f"{self.day}: level {self.level} x{self.downloads}"
+
+
+class DownloadRollupState(models.Model):
+    """Single row: the last DownloadEvent included in the rollups."""
+    last_event_id = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Rolled up to event {self.last_event_id}"
 
 
 class StudentProfile(models.Model):
@@ -101,8 +424,8 @@ class StudentProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     # Middle name is optional per your request.
     middle_name = models.CharField(max_length=150, blank=True)
-    # Level should match the FileUpload levels (1-5).
-    level = models.PositiveSmallIntegerField(choices=LEVEL_CHOICES, default=1)
+    # Level should match the FileUpload levels (1-5). Indexed for the admin level filter.
+    level = models.PositiveSmallIntegerField(choices=LEVEL_CHOICES, default=1, db_index=True)
 
     def __str__(self):
         # Display the username and level for easy admin reading.
@@ -124,3 +447,48 @@ class EmailLog(models.Model):
 
     def __str__(self):
         return f"{self.subject} -> {self.recipients} ({'sent' if self.sent else 'failed'})"
+
+
+class EmailOutbox(models.Model):
+    """Email queued for delivery by `manage.py send_outbox`."""
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENDING, 'Sending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=255, blank=True)
+    recipients = models.TextField(blank=True)  # comma-separated
+    broadcast = models.BooleanField(default=False)  # send to every active user with an email
+    sent_upto = models.PositiveIntegerField(default=0)  # recipients already delivered, so retries resume
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)  # while sending: when the worker's lease runs out
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('created_at',)
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f"{self.subject} ({self.status})"
+
+
+class CatalogVersion(models.Model):
+    """Single-row counter bumped whenever the public file list changes.
+
+    Cached catalog pages are keyed by it (see files/catalog.py).
+    """
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Catalog version {self.version}"
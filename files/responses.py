@@ -0,0 +1,356 @@
+"""Build download/preview responses with validators and byte-range support.
+
+`serve_file` answers conditional requests (If-None-Match / If-Modified-Since)
+with 304 before the file is opened, honours a single `Range` (guarded by
+`If-Range`) with 206 Partial Content, and otherwise streams the whole file.
+
+With FILE_DELIVERY = 'sendfile' and local (FileSystemStorage) files, Django
+still does auth, counting and headers but hands the transfer to the front
+web server: `X-Accel-Redirect` for nginx, `X-Sendfile` for Apache
+(mod_xsendfile) and lighttpd. The front server then handles Range itself.
+
+With FILE_DELIVERY = 'redirect', the download is recorded and the client is
+sent (302) to a signed, expiring URL from the storage backend (Cloudinary in
+production; see files/storage.py). URLs are cached per file until shortly
+before they expire.
+
+`aserve_file` is the same for the async views used under ASGI.
+"""
+import asyncio
+import re
+from urllib.parse import quote
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.db import close_old_connections
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.encoding import smart_str
+from django.utils.http import http_date, parse_http_date_safe
+
+from .storage import signed_url
+
+# Size of each read when streaming a byte range.
+CHUNK_SIZE = 64 * 1024
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def file_etag(obj):
+    """Strong ETag: the stored checksum, or size + upload time for older rows."""
+    if obj.checksum:
+        return f'"{obj.checksum}"'
+    return f'"{obj.file_size:x}-{_last_modified(obj):x}"'
+
+
+def _last_modified(obj):
+    # Changes when the file is replaced, not just when the row was created.
+    return int(obj.file_modified_at.timestamp())
+
+
+def parse_range(header, size):
+    """Return (start, end) inclusive for a single-range header, 'unsatisfiable', or None.
+
+    None means "ignore the header and send the whole file" (absent, malformed
+    or multi-range requests, which we don't serve as multipart).
+    """
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if first == '' and last == '':
+        return None
+    if first == '':
+        # Suffix range: the final N bytes.
+        length = int(last)
+        if length == 0:
+            return 'unsatisfiable'
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        return 'unsatisfiable'
+    return start, min(end, size - 1)
+
+
+def _if_range_matches(request, etag, last_modified):
+    # A Range request only applies if the client's copy is still current.
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def _iter_range(file_handle, start, length):
+    try:
+        file_handle.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = file_handle.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        file_handle.close()
+
+
+def _set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Accept-Ranges'] = 'bytes'
+    # Authenticated content: browsers may keep it but must revalidate (cheap 304).
+    response['Cache-Control'] = 'private, no-cache'
+
+
+def _sendfile_response(obj):
+    # Empty response whose body the front web server fills in from disk.
+    response = HttpResponse()
+    server = getattr(settings, 'SENDFILE_SERVER', 'nginx')
+    if server == 'nginx':
+        prefix = getattr(settings, 'SENDFILE_URL_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = quote(prefix.rstrip('/') + '/' + obj.file.name)
+    elif server in ('apache', 'lighttpd'):
+        response['X-Sendfile'] = obj.file.path
+    else:
+        raise ValueError(f'Unknown SENDFILE_SERVER {server!r}')
+    return response
+
+
+def _cached_signed_url(obj, as_attachment, filename):
+    # Reuse a signed URL until SIGNED_URL_REFRESH_MARGIN seconds before it expires.
+    ttl = int(getattr(settings, 'SIGNED_URL_TTL', 600))
+    margin = int(getattr(settings, 'SIGNED_URL_REFRESH_MARGIN', 60))
+    # Keyed by the ETag so a replaced file (or an old row without a checksum)
+    # never gets another file's cached URL.
+    version = file_etag(obj).strip('"')
+    key = f'signed-url:{obj.pk}:{"a" if as_attachment else "i"}:{version}'
+    url = cache.get(key)
+    if url is None:
+        url = signed_url(
+            obj.file.storage, obj.file.name, ttl,
+            attachment=as_attachment, filename=filename, extension=obj.extension,
+        )
+        if url and ttl - margin > 0:
+            cache.set(key, url, ttl - margin)
+    return url
+
+
+def _use_sendfile(obj):
+    return (
+        getattr(settings, 'FILE_DELIVERY', 'proxy') == 'sendfile'
+        and isinstance(obj.file.storage, FileSystemStorage)
+    )
+
+
+def _not_modified(request, etag, last_modified):
+    # 304 or 412, answered from the database row alone.
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        _set_validators(response, etag, last_modified)
+    return response
+
+
+def _requested_range(request, size, etag, last_modified):
+    """(start, end) to send, None for the whole file, or a 416 response."""
+    byte_range = None
+    if request.method in ('GET', 'HEAD') and _if_range_matches(request, etag, last_modified):
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if byte_range == 'unsatisfiable':
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        _set_validators(response, etag, last_modified)
+        return response
+    return byte_range
+
+
+def _counted_bytes(byte_range, size):
+    # Bytes to record for a counted download; None when the body doesn't
+    # start at byte 0 (a resumed or seeking request, not a new download).
+    if byte_range is None:
+        return size
+    if byte_range[0] == 0:
+        return byte_range[1] - byte_range[0] + 1
+    return None
+
+
+def _redirect(url):
+    response = HttpResponseRedirect(url)
+    # The signed URL expires, so the redirect itself must not be cached.
+    response['Cache-Control'] = 'private, no-store'
+    return response
+
+
+def serve_file(request, obj, as_attachment, count_download=False):
+    """Return a 200/206/304/416 response for `obj`'s file.
+
+    With `count_download`, a download is counted when the body starts at
+    byte 0 (full transfers and the first piece of a ranged one), so resumed
+    or seeking requests aren't counted again.
+    """
+    etag = file_etag(obj)
+    last_modified = _last_modified(obj)
+    not_modified = _not_modified(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    filename = smart_str(obj.download_name)
+    disposition = f'{"attachment" if as_attachment else "inline"}; filename="{filename}"'
+
+    if getattr(settings, 'FILE_DELIVERY', 'proxy') == 'redirect':
+        url = _cached_signed_url(obj, as_attachment, filename)
+        if url:
+            if count_download:
+                try:
+                    obj.increment_downloads(request.user, bytes_served=obj.file_size)
+                except Exception:
+                    pass
+            return _redirect(url)
+        # Storage without signed URLs: fall back to proxying the bytes.
+    content_type = obj.get_content_type()
+    size = obj.file_size
+
+    byte_range = _requested_range(request, size, etag, last_modified)
+    if isinstance(byte_range, HttpResponse):
+        return byte_range
+
+    served = _counted_bytes(byte_range, size)
+    if count_download and served is not None:
+        try:
+            obj.increment_downloads(request.user, bytes_served=served)
+        except Exception:
+            pass
+
+    if _use_sendfile(obj):
+        response = _sendfile_response(obj)
+        response['Content-Type'] = content_type
+        response['Content-Disposition'] = disposition
+        _set_validators(response, etag, last_modified)
+        return response
+
+    file_handle = obj.file.open('rb')
+    if byte_range is None:
+        response = FileResponse(file_handle, content_type=content_type)
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(_iter_range(file_handle, start, length), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(length)
+    response['Content-Disposition'] = disposition
+    _set_validators(response, etag, last_modified)
+    return response
+
+
+class _AsyncFileStream:
+    """Async iterator over `length` bytes of an open file, from `start`.
+
+    Reads are CHUNK_SIZE at a time and each runs in the default thread pool,
+    so the event loop never waits on the disk (or a remote storage backend)
+    and a slow client holds at most a chunk or two in memory: the ASGI
+    server's send() only returns once the previous chunk has been taken.
+
+    When the client goes away Django cancels the response; the file is then
+    closed by the generator's `finally` or by response.close(), whichever
+    comes first. close() is also what StreamingHttpResponse calls for a body
+    that was never iterated.
+    """
+
+    def __init__(self, file_handle, start, length):
+        self.file_handle = file_handle
+        self.start = start
+        self.length = length
+
+    async def __aiter__(self):
+        try:
+            if self.start:
+                await asyncio.to_thread(self.file_handle.seek, self.start)
+            remaining = self.length
+            while remaining > 0:
+                data = await asyncio.to_thread(self.file_handle.read, min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            self.close()
+
+    def close(self):
+        self.file_handle.close()
+
+
+async def aserve_file(request, obj, as_attachment, count_download=False):
+    """serve_file for async views (see sitefiles/asgi.py).
+
+    Same validators, ranges and delivery modes, but the user comes from
+    `request.auser()`, the download is counted through the async counter,
+    and proxied bodies are streamed by _AsyncFileStream instead of
+    FileResponse, which under ASGI would be read into memory whole before
+    the first byte is sent.
+    """
+    etag = file_etag(obj)
+    last_modified = _last_modified(obj)
+    not_modified = _not_modified(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    filename = smart_str(obj.download_name)
+    disposition = f'{"attachment" if as_attachment else "inline"}; filename="{filename}"'
+
+    if getattr(settings, 'FILE_DELIVERY', 'proxy') == 'redirect':
+        # Cache lookups and signing may touch disk or the network.
+        url = await sync_to_async(_cached_signed_url, thread_sensitive=False)(obj, as_attachment, filename)
+        if url:
+            if count_download:
+                try:
+                    await obj.aincrement_downloads(await request.auser(), bytes_served=obj.file_size)
+                except Exception:
+                    pass
+            return _redirect(url)
+    content_type = obj.get_content_type()
+    size = obj.file_size
+
+    byte_range = _requested_range(request, size, etag, last_modified)
+    if isinstance(byte_range, HttpResponse):
+        return byte_range
+
+    served = _counted_bytes(byte_range, size)
+    if count_download and served is not None:
+        try:
+            await obj.aincrement_downloads(await request.auser(), bytes_served=served)
+        except Exception:
+            pass
+
+    if _use_sendfile(obj):
+        response = _sendfile_response(obj)
+        response['Content-Type'] = content_type
+        response['Content-Disposition'] = disposition
+        _set_validators(response, etag, last_modified)
+        return response
+
+    # Opened before the response starts, so a missing file is still a 500
+    # rather than a 200 that breaks off.
+    storage = obj.file.storage
+    file_handle = await asyncio.to_thread(storage.open, obj.file.name, 'rb')
+    # The database is done with; don't keep a connection open for as long as
+    # a slow client takes to read the body.
+    await sync_to_async(close_old_connections)()
+    start, end = byte_range if byte_range is not None else (0, size - 1)
+    length = end - start + 1
+    response = StreamingHttpResponse(
+        _AsyncFileStream(file_handle, start, length),
+        status=200 if byte_range is None else 206, content_type=content_type,
+    )
+    if byte_range is not None:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = str(length)
+    response['Content-Disposition'] = disposition
+    _set_validators(response, etag, last_modified)
+    return response
@@ -0,0 +1,116 @@
+"""Daily download summaries built from the DownloadEvent log.
+
+`rollup()` finds the local days touched by events added since the last run
+(DownloadRollupState.last_event_id) and rebuilds those days of
+DailyFileDownloads, DailyLevelDownloads and DailyDownloads from the raw
+events. Whole days
+are recomputed so distinct-user counts stay exact and re-running is
+harmless. Each day is read through the `created_at` index.
+
+`prune()` deletes raw events older than DOWNLOAD_EVENT_RETENTION_DAYS that
+have already been rolled up, in batches so SQLite's write lock is never held
+for long. The admin dashboard reads only the summary tables.
+"""
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from .models import DailyDownloads, DailyFileDownloads, DailyLevelDownloads, DownloadEvent, DownloadRollupState, LocalDate
+
+PRUNE_BATCH_SIZE = 10000
+
+
+def retention_days():
+    return int(getattr(settings, 'DOWNLOAD_EVENT_RETENTION_DAYS', 90))
+
+
+def _state():
+    state, _ = DownloadRollupState.objects.get_or_create(pk=1)
+    return state
+
+
+def _day_bounds(day, tz):
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min), tz)
+    end = timezone.make_aware(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min), tz)
+    return start, end
+
+
+def _rollup_day(day, upto, tz):
+    start, end = _day_bounds(day, tz)
+    events = DownloadEvent.objects.filter(created_at__gte=start, created_at__lt=end, pk__lte=upto)
+    totals = dict(downloads=Count('pk'), users=Count('user_id', distinct=True), bytes_served=Sum('bytes_served'))
+    per_file = events.values('file_id').annotate(level=Max('level'), **totals).order_by()
+    per_level = events.values('level').annotate(**totals).order_by()
+    # Its own row: a user who downloads from two levels is one user that day.
+    whole_day = events.aggregate(**totals)
+    with transaction.atomic():
+        DailyFileDownloads.objects.filter(day=day).delete()
+        DailyLevelDownloads.objects.filter(day=day).delete()
+        DailyDownloads.objects.update_or_create(day=day, defaults=whole_day)
+        DailyFileDownloads.objects.bulk_create(
+            [DailyFileDownloads(day=day, **row) for row in per_file], batch_size=500,
+        )
+        DailyLevelDownloads.objects.bulk_create([DailyLevelDownloads(day=day, **row) for row in per_level])
+
+
+def rollup():
+    """Bring the daily summaries up to date; return the days rebuilt."""
+    state = _state()
+    upto = DownloadEvent.objects.aggregate(last=Max('pk'))['last']
+    if upto is None or upto <= state.last_event_id:
+        return []
+    tz = timezone.get_current_timezone()
+    new_events = DownloadEvent.objects.filter(pk__gt=state.last_event_id, pk__lte=upto)
+    days = sorted(
+        new_events.annotate(day=LocalDate('created_at', tzinfo=tz))
+        .values_list('day', flat=True).distinct().order_by()
+    )
+    for day in days:
+        _rollup_day(day, upto, tz)
+    state.last_event_id = upto
+    state.save()
+    return days
+
+
+def prune(days=None, batch_size=PRUNE_BATCH_SIZE):
+    """Delete rolled-up events older than `days`; return how many were deleted."""
+    days = retention_days() if days is None else days
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    old = DownloadEvent.objects.filter(created_at__lt=cutoff, pk__lte=_state().last_event_id)
+    deleted = 0
+    while True:
+        # Delete up to the batch_size-th oldest id, one short transaction each.
+        edge = list(old.order_by('pk').values_list('pk', flat=True)[batch_size - 1:batch_size])
+        batch = old.filter(pk__lte=edge[0]) if edge else old
+        count, _ = batch.delete()
+        deleted += count
+        if not edge or not count:
+            return deleted
+
+
+def dashboard(days=30, level=None):
+    """Summary tables for the admin dashboard, read from the rollups only."""
+    since = timezone.localdate() - datetime.timedelta(days=days - 1)
+    by_level = DailyLevelDownloads.objects.filter(day__gte=since)
+    by_file = DailyFileDownloads.objects.filter(day__gte=since)
+    if level is not None:
+        by_level = by_level.filter(level=level)
+        by_file = by_file.filter(level=level)
+    sums = dict(downloads=Sum('downloads'), bytes_served=Sum('bytes_served'))
+    # Per-level rows already are per day; across levels only DailyDownloads
+    # has the distinct user count.
+    daily = by_level if level is not None else DailyDownloads.objects.filter(day__gte=since)
+    daily = list(daily.values('day', 'downloads', 'users', 'bytes_served').order_by('-day'))
+    levels = list(by_level.values('level').annotate(**sums).order_by('level'))
+    top_files = list(by_file.values('file_id').annotate(**sums).order_by('-downloads', 'file_id')[:20])
+    return {
+        'since': since,
+        'daily': daily,
+        'levels': levels,
+        'top_files': top_files,
+        'total': by_level.aggregate(**sums),
+        'state': DownloadRollupState.objects.filter(pk=1).first(),
+    }
@@ -0,0 +1,198 @@
+"""Full-text search over upload titles and document text using SQLite FTS5.
+
+The index lives in the `files_fileupload_fts` virtual table (created by
+migration 0010) whose rowid is the FileUpload primary key. It is kept in
+sync by the receivers in `files/signals.py`; `manage.py rebuild_search_index`
+repopulates it from scratch. Reading a document's text can take a while, so
+new file contents are indexed in a background thread after the save commits.
+"""
+import codecs
+import logging
+import re
+import threading
+
+from django.db import close_old_connections, connection, transaction
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import FileUpload
+
+# pypdf is optional; without it PDFs are indexed by title only.
+try:
+    from pypdf import PdfReader
+    PYPDF_AVAILABLE = True
+except Exception:
+    PdfReader = None
+    PYPDF_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'files_fileupload_fts'
+# Cap on extracted text per document so one huge file can't bloat the index.
+MAX_TEXT_CHARS = 200_000
+# Title matches weigh more than matches in the document body.
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+# Private-use markers wrapped around snippet matches, swapped for <mark> after escaping.
+_HL_START, _HL_END = '\ue000', '\ue001'
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def fts_enabled():
+    """Return True when the database supports the FTS5 index."""
+    return connection.vendor == 'sqlite'
+
+
+def iter_text(field_file, content_type, limit=MAX_TEXT_CHARS):
+    """Yield text pieces from a stored file without loading it whole, up to `limit` chars."""
+    remaining = limit
+    if content_type.startswith('text/'):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        field_file.open('rb')
+        try:
+            for chunk in field_file.chunks():
+                piece = decoder.decode(chunk)[:remaining]
+                remaining -= len(piece)
+                yield piece
+                if remaining <= 0:
+                    return
+        finally:
+            field_file.close()
+    elif content_type == 'application/pdf' and PYPDF_AVAILABLE:
+        field_file.open('rb')
+        try:
+            # pypdf parses pages lazily, so only the pages we read are decoded.
+            for page in PdfReader(field_file).pages:
+                piece = (page.extract_text() or '')[:remaining]
+                remaining -= len(piece)
+                yield piece
+                if remaining <= 0:
+                    return
+        finally:
+            field_file.close()
+
+
+def extract_text(obj):
+    """Return the searchable body text of an upload ('' when unsupported or unreadable)."""
+    if not obj.file:
+        return ''
+    try:
+        return '\n'.join(iter_text(obj.file, obj.get_content_type()))
+    except Exception:
+        logger.warning('Could not extract text from %s', obj.file.name, exc_info=True)
+        return ''
+
+
+def index_file(obj, with_body=True):
+    """Add or replace an upload in the search index."""
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        if not with_body:
+            # Title-only refresh keeps the previously extracted body.
+            cursor.execute(f'UPDATE {FTS_TABLE} SET title = %s WHERE rowid = %s', [obj.title, obj.pk])
+            if cursor.rowcount:
+                return
+        body = extract_text(obj)
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [obj.pk])
+        cursor.execute(f'INSERT INTO {FTS_TABLE} (rowid, title, body) VALUES (%s, %s, %s)', [obj.pk, obj.title, body])
+
+
+def _index_in_background(pk):
+    try:
+        obj = FileUpload.objects.filter(pk=pk).first()
+        if obj is not None:
+            index_file(obj)
+    except Exception:
+        logger.exception('Could not index upload %s for search', pk)
+    finally:
+        close_old_connections()
+
+
+def schedule(obj):
+    """Extract and index the upload's text in a background thread once the save has committed."""
+    if not fts_enabled():
+        return
+    pk = obj.pk
+    transaction.on_commit(
+        lambda: threading.Thread(target=_index_in_background, args=(pk,), name='search-index', daemon=True).start()
+    )
+
+
+def remove_file(pk):
+    """Drop an upload from the search index."""
+    if not fts_enabled():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [pk])
+
+
+def build_match_query(text):
+    """Turn free text into an FTS5 query: every word must match, as a prefix."""
+    tokens = _TOKEN_RE.findall(text or '')[:12]
+    # Quoting each token stops user input from being parsed as FTS5 syntax.
+    return ' '.join(f'"{t}"*' for t in tokens)
+
+
+def _highlight(snippet):
+    return mark_safe(escape(snippet).replace(_HL_START, '<mark>').replace(_HL_END, '</mark>'))
+
+
+def search(text, level=None, category=None, semester=None, page=1, per_page=20):
+    """Return (results, has_next) for one page of ranked, non-archived matches.
+
+    Each result is a FileUpload with a `search_snippet` attribute holding an
+    HTML-safe excerpt around the match.
+    """
+    match = build_match_query(text)
+    if not match:
+        return [], False
+    offset = (max(page, 1) - 1) * per_page
+    filters = {'level': level, 'category': category, 'semester': semester}
+
+    if not fts_enabled():
+        # Other databases: plain title match, newest first.
+        qs = FileUpload.objects.filter(archived=False, title__icontains=text.strip())
+        qs = qs.filter(**{k: v for k, v in filters.items() if v is not None})
+        rows = list(qs.select_related('uploaded_by').order_by('-uploaded_at')[offset:offset + per_page + 1])
+        for obj in rows:
+            obj.search_snippet = ''
+        return rows[:per_page], len(rows) > per_page
+
+    where = ['s.' + FTS_TABLE + ' MATCH %s', 'f.archived = %s']
+    params = [match, False]
+    for column, value in filters.items():
+        if value is not None:
+            where.append(f'f.{column} = %s')
+            params.append(value)
+    sql = (
+        f"SELECT f.id, snippet({FTS_TABLE}, 1, %s, %s, '…', 16) "
+        f'FROM {FTS_TABLE} s JOIN files_fileupload f ON f.id = s.rowid '
+        f'WHERE {" AND ".join(where)} '
+        f'ORDER BY bm25({FTS_TABLE}, %s, %s) LIMIT %s OFFSET %s'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [_HL_START, _HL_END] + params + [TITLE_WEIGHT, BODY_WEIGHT, per_page + 1, offset])
+        hits = cursor.fetchall()
+    has_next = len(hits) > per_page
+    hits = hits[:per_page]
+    objs = FileUpload.objects.select_related('uploaded_by').in_bulk([pk for pk, _ in hits])
+    results = []
+    for pk, snippet in hits:
+        obj = objs.get(pk)
+        if obj is not None:
+            obj.search_snippet = _highlight(snippet or '')
+            results.append(obj)
+    return results, has_next
+
+
+def clear_index():
+    """Remove every row from the search index."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+
+
+def optimize_index():
+    """Merge FTS5 index segments after a bulk rebuild."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
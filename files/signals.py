@@ -1,23 +1,29 @@
-from django.db.models.signals import post_save
+import logging
+
+from django.core.signals import request_started
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from django.conf import settings
-from django.core.mail import send_mail
-from django.contrib.auth.models import User
-from .models import EmailLog
 from .models import FileUpload
+from .utils import queue_email
+from . import backup
+from . import blobs
+from . import catalog
+from . import search
+from . import thumbnails
+
+logger = logging.getLogger(__name__)
 
 @receiver(post_save, sender=FileUpload)
 def file_uploaded_notify(sender, instance, created, **kwargs):
+    # Queue the notification; `manage.py send_outbox` resolves the recipients
+    # (all active users with an email) and delivers it off the request path.
     if not created:
         return
-    # Prepare recipients: all active users with an email
-    recipients = list(User.objects.filter(is_active=True).exclude(email='').values_list('email', flat=True))
-    if not recipients:
-        return
     subject = f'New file uploaded: {instance.title}'
     uploaded_by = getattr(instance.uploaded_by, 'username', 'Unknown')
     body = (
-        f'Filename: {getattr(instance.file, "name", "")}\n'
+        f'Filename: {instance.download_name}\n'
         f'Title: {instance.title}\n'
         f'Level: {instance.level}\n'
         f'Category: {instance.category}\n'
@@ -26,12 +32,83 @@ def file_uploaded_notify(sender, instance, created, **kwargs):
         f'Upload date: {instance.uploaded_at}\n'
     )
     try:
-        res = send_mail(subject, body, settings.DEFAULT_FROM_EMAIL, recipients, fail_silently=False)
-        EmailLog.objects.create(subject=subject, body=body, from_email=settings.DEFAULT_FROM_EMAIL, recipients=','.join(recipients), sent=bool(res))
+        queue_email(subject, body)
     except Exception:
-        # fail silently to avoid admin crash
-        # fail silently to avoid admin crash but record the error
+        # never let the notification break the admin save
+        logger.exception('Could not queue upload notification for %s', instance.pk)
+
+
+@receiver(post_save, sender=FileUpload)
+def file_search_index(sender, instance, created, update_fields=None, **kwargs):
+    # Keep the full-text index in step with the upload. Saves that only touch
+    # other columns (e.g. download_count) leave it alone.
+    if update_fields is not None and 'title' not in update_fields:
+        return
+    try:
+        if created or getattr(instance, '_file_changed', False):
+            # Text extraction (e.g. a large PDF) runs off the request path.
+            search.schedule(instance)
+        else:
+            search.index_file(instance, with_body=False)
+    except Exception:
+        logger.exception('Could not index upload %s for search', instance.pk)
+
+
+@receiver(post_delete, sender=FileUpload)
+def file_search_unindex(sender, instance, **kwargs):
+    try:
+        search.remove_file(instance.pk)
+    except Exception:
+        logger.exception('Could not remove upload %s from the search index', instance.pk)
+
+
+@receiver(post_save, sender=FileUpload)
+def file_thumbnail(sender, instance, created, **kwargs):
+    # Render the card thumbnail off the request path for new file contents.
+    if created or getattr(instance, '_file_changed', False):
         try:
-            EmailLog.objects.create(subject=subject, body=body, from_email=settings.DEFAULT_FROM_EMAIL, recipients=','.join(recipients), sent=False, error='send failed')
+            thumbnails.schedule(instance)
         except Exception:
-            pass
+            logger.exception('Could not schedule thumbnail for upload %s', instance.pk)
+
+
+@receiver(post_save, sender=FileUpload)
+def file_catalog_changed(sender, instance, created, update_fields=None, **kwargs):
+    # Cached home page fragments are keyed by the catalog version. A new
+    # upload adjusts the cached filter counts; edits recompute them.
+    if update_fields is not None and not catalog.CATALOG_FIELDS.intersection(update_fields):
+        return
+    version = catalog.bump_version()
+    if created and not instance.archived:
+        catalog.apply_delta(version, {(instance.level, instance.category, instance.semester): 1})
+
+
+@receiver(post_delete, sender=FileUpload)
+def file_catalog_removed(sender, instance, **kwargs):
+    version = catalog.bump_version()
+    if not instance.archived:
+        catalog.apply_delta(version, {(instance.level, instance.category, instance.semester): -1})
+
+
+@receiver(post_delete, sender=FileUpload)
+def file_release_blob(sender, instance, **kwargs):
+    # Shared contents stay until the last upload pointing at them is deleted.
+    try:
+        blobs.release(instance.file.storage, instance.file.name)
+    except Exception:
+        logger.exception('Could not release the file of upload %s', instance.pk)
+
+
+@receiver(post_delete, sender=FileUpload)
+def file_delete_thumbnail(sender, instance, **kwargs):
+    # Thumbnails belong to one row; remove the file with it.
+    if instance.thumbnail:
+        storage, name = instance.thumbnail.storage, instance.thumbnail.name
+        transaction.on_commit(lambda: storage.delete(name), robust=True)
+
+
+@receiver(request_started)
+def start_backup_scheduler(sender, **kwargs):
+    # Threads don't survive a fork, so each worker starts its own scheduler
+    # with its first request; later calls are a pid comparison.
+    backup.start()
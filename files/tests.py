@@ -0,0 +1,1213 @@
+import contextlib
+import datetime
+import gzip
+import hashlib
+import io
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+import zoneinfo
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from unittest import mock
+from urllib.parse import parse_qs, quote, urlparse
+
+from asgiref.sync import sync_to_async
+from django.conf import global_settings
+from django.contrib.auth.hashers import check_password
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.http import http_date
+
+from . import backup, catalog, chunked, counters, exports, ingest, metrics, passwords, responses, rollups, thumbnails, views
+from .checks import check_date_indexes
+from .management.commands.send_outbox import Command as SendOutbox
+from .models import Blob, DownloadEvent, EmailOutbox, FileUpload, LocalDate, StudentProfile, UploadSession
+from .storage import SignedFileSystemStorage, signed_url
+from .utils import queue_email
+
+MEDIA_ROOT = tempfile.mkdtemp(prefix='portal-tests-')
+
+
+portal_settings = override_settings(
+    MEDIA_ROOT=MEDIA_ROOT,
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}},
+    DB_BACKUP_IN_PROCESS=False,
+    DOWNLOAD_COUNT_FLUSH_INTERVAL=0,
+    FILE_DELIVERY='proxy',
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+
+
+class InlineThread:
+    """Stands in for threading.Thread: runs the target when started."""
+
+    def __init__(self, target, args=(), **kwargs):
+        self.target, self.args = target, args
+
+    def start(self):
+        self.target(*self.args)
+
+
+@portal_settings
+class PortalTestCase(TestCase):
+    """Uploads go to a throwaway MEDIA_ROOT and download counts are written straight through.
+
+    Background work started from on_commit callbacks (search indexing,
+    thumbnails) runs inline, inside the test transaction.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        for target in ('files.search.threading', 'files.thumbnails.threading'):
+            patcher = mock.patch(target, SimpleNamespace(Thread=InlineThread))
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    def login(self):
+        user = User.objects.create_user('student', 'student@example.com', 'pw')
+        self.client.force_login(user)
+        return user
+
+    def upload(self, content=b'0123456789' * 10, name='notes.txt', **fields):
+        fields.setdefault('title', name)
+        return FileUpload.objects.create(file=SimpleUploadedFile(name, content), **fields)
+
+
+@override_settings(DOWNLOAD_COUNT_FLUSH_INTERVAL=60, DOWNLOAD_COUNT_MAX_PENDING=3)
+class CounterTests(PortalTestCase):
+    def setUp(self):
+        self.obj = self.upload()
+        # No flusher thread: the tests flush explicitly.
+        patcher = mock.patch.object(counters, '_ensure_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(counters.flush)
+
+    def count(self):
+        return FileUpload.objects.values_list('download_count', flat=True).get(pk=self.obj.pk)
+
+    def test_buffered_until_flush(self):
+        counters.record_download(self.obj.pk, user_id=None, level=1, bytes_served=10)
+        counters.record_download(self.obj.pk, level=1, bytes_served=10)
+        self.assertEqual((self.count(), counters.pending_count(self.obj.pk)), (0, 2))
+        self.assertFalse(DownloadEvent.objects.exists())
+        self.assertEqual(counters.flush(), 2)
+        self.assertEqual((self.count(), counters.pending_count(self.obj.pk)), (2, 0))
+        self.assertEqual(DownloadEvent.objects.count(), 2)
+
+    def test_flushes_when_full(self):
+        for _ in range(3):
+            counters.record_download(self.obj.pk)
+        self.assertEqual(self.count(), 3)
+
+    def test_failed_write_is_retried(self):
+        counters.record_download(self.obj.pk, level=1)
+        with mock.patch.object(counters, '_write', side_effect=IntegrityError('locked')):
+            self.assertEqual(counters.flush(), 0)
+        self.assertEqual(counters.pending_count(self.obj.pk), 1)
+        self.assertEqual(counters.flush(), 1)
+        self.assertEqual((self.count(), DownloadEvent.objects.count()), (1, 1))
+
+    def test_flushed_at_exit(self):
+        counters.record_download(self.obj.pk)
+        counters._flush_on_shutdown()
+        self.assertEqual(self.count(), 1)
+
+    async def test_async_path(self):
+        await counters.arecord_download(self.obj.pk, level=1)
+        self.assertEqual(counters.pending_count(self.obj.pk), 1)
+        with override_settings(DOWNLOAD_COUNT_FLUSH_INTERVAL=0):
+            await counters.arecord_download(self.obj.pk, level=1)
+        await counters.sync_to_async(counters.flush)()
+        obj = await FileUpload.objects.aget(pk=self.obj.pk)
+        self.assertEqual(obj.download_count, 2)
+        self.assertEqual(await DownloadEvent.objects.acount(), 2)
+
+
+class OutboxTests(PortalTestCase):
+    options = {'batch': 20, 'chunk_size': 50, 'retries': 1, 'backoff': 0, 'max_attempts': 5, 'lease': 600}
+
+    def send(self):
+        call_command('send_outbox', backoff=0, stdout=io.StringIO())
+
+    def test_empty_recipient_list_queues_nothing(self):
+        User.objects.create_user('a', 'a@example.com')
+        self.assertIsNone(queue_email('Hi', 'body', []))
+        self.send()
+        self.assertEqual(EmailOutbox.objects.count(), 0)
+        self.assertEqual(mail.outbox, [])
+
+    def test_none_broadcasts_to_active_users(self):
+        User.objects.create_user('a', 'a@example.com')
+        User.objects.create_user('b', 'b@example.com', is_active=False)
+        message = queue_email('Hi', 'body')
+        self.assertTrue(message.broadcast)
+        self.send()
+        self.assertEqual([m.bcc for m in mail.outbox], [['a@example.com']])
+        message.refresh_from_db()
+        self.assertEqual(message.status, EmailOutbox.STATUS_SENT)
+
+    def test_message_is_claimed_once(self):
+        queue_email('Hi', 'body', ['x@example.com'])
+        first = EmailOutbox.objects.get()
+        second = EmailOutbox.objects.get()  # another worker's stale read
+        self.assertTrue(SendOutbox().claim(first, self.options))
+        self.assertFalse(SendOutbox().claim(second, self.options))
+        # The claimed row is leased, so an overlapping run leaves it alone.
+        self.send()
+        self.assertEqual(mail.outbox, [])
+
+    def test_expired_lease_is_taken_over(self):
+        queue_email('Hi', 'body', ['x@example.com'])
+        EmailOutbox.objects.update(
+            status=EmailOutbox.STATUS_SENDING, next_attempt_at=timezone.now() - datetime.timedelta(seconds=1),
+        )
+        self.send()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(EmailOutbox.objects.get().status, EmailOutbox.STATUS_SENT)
+
+    def failing_send(self, failures):
+        # EmailMessage.send that raises `failures[n]` on the nth call, if set.
+        calls = []
+
+        def send(email, fail_silently=False):
+            calls.append(email.bcc)
+            failure = failures.get(len(calls))
+            if failure:
+                raise failure
+            return 1
+        return mock.patch('django.core.mail.EmailMessage.send', autospec=True, side_effect=send), calls
+
+    def test_failed_chunk_is_retried_from_where_it_stopped(self):
+        queue_email('Hi', 'body', ['a@example.com', 'b@example.com', 'c@example.com'])
+        patch, calls = self.failing_send({2: OSError('connection reset')})
+        with patch, mock.patch('files.management.commands.send_outbox.time.sleep') as sleep:
+            call_command('send_outbox', chunk_size=1, retries=1, stdout=io.StringIO())
+        # No pointless wait after the last attempt.
+        sleep.assert_not_called()
+        message = EmailOutbox.objects.get()
+        self.assertEqual((message.sent_upto, message.status), (1, EmailOutbox.STATUS_PENDING))
+        EmailOutbox.objects.update(next_attempt_at=timezone.now())
+        call_command('send_outbox', chunk_size=1, stdout=io.StringIO())
+        self.assertEqual([m.bcc for m in mail.outbox], [['b@example.com'], ['c@example.com']])
+
+    def test_progress_survives_a_worker_crash(self):
+        queue_email('Hi', 'body', ['a@example.com', 'b@example.com', 'c@example.com'])
+        patch, calls = self.failing_send({2: SystemExit()})
+        with patch, self.assertRaises(SystemExit):
+            call_command('send_outbox', chunk_size=1, stdout=io.StringIO())
+        self.assertEqual(calls, [['a@example.com'], ['b@example.com']])
+        # Chunk 1 was recorded as it went out, so the takeover starts at chunk 2.
+        message = EmailOutbox.objects.get()
+        self.assertEqual((message.sent_upto, message.status), (1, EmailOutbox.STATUS_SENDING))
+        EmailOutbox.objects.update(next_attempt_at=timezone.now())
+        call_command('send_outbox', chunk_size=1, stdout=io.StringIO())
+        self.assertEqual([m.bcc for m in mail.outbox], [['b@example.com'], ['c@example.com']])
+        self.assertEqual(EmailOutbox.objects.get().status, EmailOutbox.STATUS_SENT)
+
+    def test_lost_lease_stops_delivery(self):
+        queue_email('Hi', 'body', ['a@example.com', 'b@example.com'])
+        message = EmailOutbox.objects.get()
+        command = SendOutbox(stdout=io.StringIO())
+        self.assertTrue(command.claim(message, self.options))
+        # Another worker takes the message over (e.g. after a long stall).
+        EmailOutbox.objects.update(next_attempt_at=timezone.now() + datetime.timedelta(minutes=5))
+        command.deliver(message, mail.get_connection(), dict(self.options, chunk_size=1))
+        self.assertEqual([m.bcc for m in mail.outbox], [['a@example.com']])
+        self.assertEqual(EmailOutbox.objects.get().status, EmailOutbox.STATUS_SENDING)
+
+
+
+class BackupTests(PortalTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='portal-backup-')
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.db_path = os.path.join(self.directory, 'live.sqlite3')
+        self.execute('CREATE TABLE t (x INTEGER)', 'INSERT INTO t VALUES (1)')
+        patcher = mock.patch('files.backup.database_path', return_value=self.db_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        settings = override_settings(DB_BACKUP_DIR=os.path.join(self.directory, 'backups'), DB_BACKUP_KEEP=2)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def execute(self, *statements):
+        db = sqlite3.connect(self.db_path)
+        with db:
+            for statement in statements:
+                db.execute(statement)
+        db.close()
+
+    def restore(self, path):
+        copy = os.path.join(self.directory, 'restored.sqlite3')
+        with gzip.open(path) as src, open(copy, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        db = sqlite3.connect(copy)
+        try:
+            return db.execute('SELECT x FROM t ORDER BY x').fetchall()
+        finally:
+            db.close()
+
+    def test_snapshot_is_a_compressed_copy(self):
+        path = backup.snapshot()
+        self.assertTrue(path.name.endswith('.sqlite3.gz'))
+        self.assertEqual(self.restore(path), [(1,)])
+        # Unchanged database: nothing new.
+        self.assertIsNone(backup.snapshot())
+        self.execute('INSERT INTO t VALUES (2)')
+        self.assertEqual(self.restore(backup.snapshot()), [(1,), (2,)])
+
+    def test_old_snapshots_are_pruned(self):
+        paths = [backup.snapshot(force=True) for _ in range(3)]
+        self.assertEqual(sorted(backup.backup_dir().glob('db_snapshot_*')), paths[1:])
+
+    @override_settings(DB_BACKUP_LOCK_STALE=30)
+    def test_lock(self):
+        lock = backup.backup_dir() / '.snapshot.lock'
+        lock.parent.mkdir()
+        lock.touch()
+        # Another process is mid-snapshot.
+        self.assertIsNone(backup.snapshot())
+        # Its lock went untouched for longer than DB_BACKUP_LOCK_STALE: it crashed.
+        stale = time.time() - 60
+        os.utime(lock, (stale, stale))
+        self.assertIsNotNone(backup.snapshot())
+        self.assertFalse(lock.exists())
+
+    def test_lock_is_refreshed_while_copying(self):
+        lock = str(backup.backup_dir() / '.snapshot.lock')
+        with mock.patch('files.backup._LOCK_REFRESH_SECONDS', 0), \
+                mock.patch('files.backup.os.utime', wraps=os.utime) as utime:
+            backup.snapshot()
+        self.assertIn(lock, [str(call.args[0]) for call in utime.call_args_list])
+
+    @override_settings(DB_BACKUP_IN_PROCESS=True)
+    def test_scheduler_starts_with_the_first_request(self):
+        with mock.patch('files.backup._ensure_scheduler') as ensure:
+            self.client.get('/')
+        ensure.assert_called()
+
+class DownloadResponseTests(PortalTestCase):
+    def setUp(self):
+        self.login()
+        self.obj = self.upload()
+        self.url = reverse('files:download', args=[self.obj.pk])
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_full_download(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), b'0123456789' * 10)
+        self.assertEqual(response['ETag'], f'"{self.obj.checksum}"')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_range(self):
+        response = self.client.get(self.url, headers={'range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+        self.assertEqual(self.body(response), b'0123456789')
+        response = self.client.get(self.url, headers={'range': 'bytes=-5'})
+        self.assertEqual(response['Content-Range'], 'bytes 95-99/100')
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, headers={'range': 'bytes=500-'})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertEqual(self.client.get(self.url, headers={'if-none-match': etag}).status_code, 304)
+        last_modified = self.client.get(self.url)['Last-Modified']
+        self.assertEqual(self.client.get(self.url, headers={'if-modified-since': last_modified}).status_code, 304)
+
+    def test_replaced_file_is_modified(self):
+        FileUpload.objects.filter(pk=self.obj.pk).update(uploaded_at=timezone.now() - datetime.timedelta(hours=1))
+        self.obj.refresh_from_db()
+        old_last_modified = http_date(self.obj.uploaded_at.timestamp())
+        self.obj.file = SimpleUploadedFile('notes.txt', b'new contents')
+        self.obj.save()
+        response = self.client.get(self.url, headers={'if-modified-since': old_last_modified})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), b'new contents')
+        self.assertNotEqual(response['Last-Modified'], old_last_modified)
+
+
+
+# The async views are only routed under ASGI (ASYNC_FILE_VIEWS); these tests
+# mount them directly.
+class AsyncFileURLs:
+    urlpatterns = [
+        path('download/<int:pk>/', views.adownload_file, name='adownload'),
+        path('preview/<int:pk>/', views.apreview_file, name='apreview'),
+    ]
+
+
+@override_settings(ROOT_URLCONF=AsyncFileURLs)
+class AsyncDownloadTests(PortalTestCase):
+    content = bytes(range(256)) * 1024  # 256 KiB: several CHUNK_SIZE reads
+
+    def setUp(self):
+        self.user = self.login()
+        self.obj = self.upload(self.content, name='survey.bin')
+        self.url = reverse('adownload', args=[self.obj.pk])
+        self.handles = []
+        open_file = FileSystemStorage.open
+
+        def spy(storage, name, mode='rb'):
+            handle = open_file(storage, name, mode)
+            self.handles.append(handle)
+            return handle
+        patcher = mock.patch.object(FileSystemStorage, 'open', autospec=True, side_effect=spy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def get(self, **headers):
+        await self.async_client.aforce_login(self.user)
+        return await self.async_client.get(self.url, headers=headers)
+
+    async def body(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    async def download_count(self):
+        return (await FileUpload.objects.aget(pk=self.obj.pk)).download_count
+
+    async def test_full_body(self):
+        response = await self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(await self.body(response), self.content)
+        self.assertTrue(self.handles[0].closed)
+        self.assertEqual(await self.download_count(), 1)
+
+    async def test_range(self):
+        response = await self.get(range='bytes=70000-70009')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 70000-70009/{len(self.content)}')
+        self.assertEqual(await self.body(response), self.content[70000:70010])
+        # Not from byte 0: a seek within an earlier download, not counted again.
+        self.assertEqual(await self.download_count(), 0)
+
+    async def test_not_modified(self):
+        etag = (await self.get())['ETag']
+        self.handles.clear()
+        response = await self.get(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        # Answered from the row; the file is never opened.
+        self.assertEqual(self.handles, [])
+
+    async def test_handle_closed_on_client_disconnect(self):
+        # What django's ASGIHandler does when the client goes away after the
+        # first chunk: the send is cancelled (leaving the iterator through
+        # aclosing) and the response is closed.
+        response = await self.get()
+        async with contextlib.aclosing(aiter(response)) as content:
+            async for chunk in content:
+                self.assertEqual(len(chunk), responses.CHUNK_SIZE)
+                break
+        await sync_to_async(response.close)()
+        self.assertTrue(self.handles[0].closed)
+        # Likewise for a body that was never started.
+        response = await self.get()
+        await sync_to_async(response.close)()
+        self.assertTrue(self.handles[1].closed)
+
+class RemoteStorage(Storage):
+    """Stands in for a remote backend: readable, but not a FileSystemStorage."""
+
+    def __init__(self):
+        self.local = FileSystemStorage(location=MEDIA_ROOT)
+
+    def _open(self, name, mode='rb'):
+        return self.local.open(name, mode)
+
+    def exists(self, name):
+        return self.local.exists(name)
+
+    def size(self, name):
+        return self.local.size(name)
+
+    def url(self, name):
+        return self.local.url(name)
+
+
+@override_settings(FILE_DELIVERY='sendfile', SENDFILE_URL_PREFIX='/protected-media/')
+class SendfileTests(PortalTestCase):
+    def setUp(self):
+        self.user = self.login()
+        self.obj = self.upload(name='rock samples.txt')
+        self.url = reverse('files:download', args=[self.obj.pk])
+
+    def test_nginx_accel_redirect(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], quote('/protected-media/' + self.obj.file.name))
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="rock samples.txt"')
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.obj.refresh_from_db()
+        self.assertEqual(self.obj.download_count, 1)
+        self.assertEqual(DownloadEvent.objects.get().user, self.user)
+
+    @override_settings(SENDFILE_SERVER='apache')
+    def test_apache_x_sendfile(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], self.obj.file.path)
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(response.content, b'')
+        self.assertTrue(response['Content-Disposition'].startswith('attachment; '))
+
+    def test_worker_never_reads_the_file(self):
+        # The worker is released as soon as the headers are built: the file is
+        # never opened, so the transfer time is the front server's alone. A
+        # Range request is left to the front server too.
+        with mock.patch.object(FileSystemStorage, 'open', side_effect=AssertionError('file opened')) as opened:
+            response = self.client.get(self.url, headers={'range': 'bytes=10-19'})
+        opened.assert_not_called()
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Range', response)
+        self.assertEqual(response.content, b'')
+
+    def test_remote_storage_is_proxied(self):
+        with mock.patch.object(FileUpload._meta.get_field('file'), 'storage', RemoteStorage()):
+            response = self.client.get(self.url)
+            self.assertNotIn('X-Accel-Redirect', response)
+            self.assertEqual(b''.join(response.streaming_content), b'0123456789' * 10)
+        self.obj.refresh_from_db()
+        self.assertEqual(self.obj.download_count, 1)
+
+
+
+@override_settings(FILE_DELIVERY='redirect')
+class RedirectTests(PortalTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(FileUpload._meta.get_field('file'), 'storage', SignedFileSystemStorage())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Rolled-back rows reuse primary keys, so URLs cached by another test could match.
+        cache.clear()
+        self.user = self.login()
+        self.obj = self.upload(name='rock samples.txt')
+        self.url = reverse('files:download', args=[self.obj.pk])
+
+    def test_redirect_to_signed_url(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Cache-Control'], 'private, no-store')
+        self.obj.refresh_from_db()
+        self.assertEqual(self.obj.download_count, 1)
+        # The signature, not the session, grants access, and fetching the
+        # signed URL doesn't count the download a second time.
+        self.client.logout()
+        media = self.client.get(response['Location'])
+        self.assertEqual(b''.join(media.streaming_content), b'0123456789' * 10)
+        self.assertEqual(media['Content-Disposition'], 'attachment; filename="rock samples.txt"')
+        self.obj.refresh_from_db()
+        self.assertEqual(self.obj.download_count, 1)
+        self.assertEqual(DownloadEvent.objects.count(), 1)
+
+    def test_signed_url_is_cached_per_file_version(self):
+        with mock.patch('files.responses.signed_url', side_effect=['/first/', '/second/']):
+            self.assertEqual(self.client.get(self.url)['Location'], '/first/')
+            self.assertEqual(self.client.get(self.url)['Location'], '/first/')
+            # The ETag changes (here to the size/mtime form used for rows
+            # without a checksum), so the cached URL is not reused.
+            FileUpload.objects.filter(pk=self.obj.pk).update(checksum='')
+            self.assertEqual(self.client.get(self.url)['Location'], '/second/')
+
+    def test_cloudinary_url_names_the_attachment(self):
+        import cloudinary
+        from cloudinary_storage.storage import MediaCloudinaryStorage
+
+        config = dict(cloud_name='demo', api_key='key', api_secret='secret', auth_token=None)
+        with mock.patch.multiple(cloudinary.config(), create=True, **config):
+            url = signed_url(MediaCloudinaryStorage(), 'media/rock_abc', 600, filename='Rock samples.pdf', extension='pdf')
+            inline = signed_url(MediaCloudinaryStorage(), 'media/rock_abc', 600, attachment=False, extension='pdf')
+        self.assertRegex(url, r'^https://res\.cloudinary\.com/demo/image/upload/s--[\w-]+--/fl_attachment:Rock_samples/')
+        self.assertTrue(url.endswith('/media/rock_abc.pdf'))
+        self.assertNotIn('fl_attachment', inline)
+
+    def test_expired_or_tampered_link(self):
+        storage = FileUpload._meta.get_field('file').storage
+        url = storage.signed_url(self.obj.file.name, expires_in=60)
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 200)
+        token = url.rstrip('/').rsplit('/', 1)[1]
+        tampered = reverse('files:signed_media', args=[token[:-1] + ('A' if token[-1] != 'A' else 'B')])
+        self.assertEqual(self.client.get(tampered).status_code, 404)
+        with mock.patch('files.storage.time.time', return_value=time.time() + 61):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+class ThumbnailTests(PortalTestCase):
+    def setUp(self):
+        self.login()
+        self.obj = self.upload()
+        self.url = reverse('files:thumbnail', args=[self.obj.pk])
+
+    def add_thumbnail(self, data=b'webp'):
+        self.obj.thumbnail.save('notes.webp', ContentFile(data), save=False)
+        FileUpload.objects.filter(pk=self.obj.pk).update(thumbnail=self.obj.thumbnail.name)
+        return self.obj.thumbnail.name
+
+    def test_revalidated_not_cached(self):
+        self.add_thumbnail()
+        response = self.client.get(self.url)
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.url, headers={'if-none-match': etag}).status_code, 304)
+
+        self.obj.file = SimpleUploadedFile('notes.txt', b'new contents')
+        self.obj.save()
+        self.add_thumbnail(b'new webp')
+        response = self.client.get(self.url, headers={'if-none-match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'new webp')
+
+    def test_replacing_file_deletes_old_thumbnail(self):
+        name = self.add_thumbnail()
+        storage = self.obj.thumbnail.storage
+        self.obj.file = SimpleUploadedFile('notes.txt', b'new contents')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.obj.save()
+        self.assertFalse(self.obj.thumbnail)
+        self.assertFalse(storage.exists(name))
+
+    def test_deleting_upload_deletes_thumbnail(self):
+        name = self.add_thumbnail()
+        storage = self.obj.thumbnail.storage
+        with self.captureOnCommitCallbacks(execute=True):
+            self.obj.delete()
+        self.assertFalse(storage.exists(name))
+
+
+    def image(self, size=(800, 400), fmt='PNG'):
+        from PIL import Image
+
+        out = io.BytesIO()
+        Image.new('RGB', size, 'orange').save(out, fmt)
+        return out.getvalue()
+
+    def test_webp_thumbnail_generated_after_upload_and_removed_with_it(self):
+        from PIL import Image
+
+        with self.captureOnCommitCallbacks(execute=True):
+            obj = self.upload(self.image(), name='outcrop.png')
+        obj.refresh_from_db()
+        self.assertTrue(obj.thumbnail.name.endswith('outcrop.webp'))
+        with obj.thumbnail.open('rb') as fh, Image.open(fh) as thumb:
+            self.assertEqual(thumb.format, 'WEBP')
+            self.assertEqual(thumb.size, (320, 160))
+        response = self.client.get(reverse('files:thumbnail', args=[obj.pk]))
+        self.assertEqual(response['Content-Type'], 'image/webp')
+
+        storage, name = obj.thumbnail.storage, obj.thumbnail.name
+        with self.captureOnCommitCallbacks(execute=True):
+            obj.delete()
+        self.assertFalse(storage.exists(name))
+
+    def test_pdf_is_rendered_from_its_path(self):
+        obj = self.upload(b'%PDF-1.4 ...', name='map.pdf')
+        page = mock.Mock(rect=SimpleNamespace(width=640))
+        page.get_pixmap.return_value.tobytes.return_value = self.image((640, 900))
+        doc = mock.MagicMock()
+        doc.__enter__.return_value = doc
+        doc.__getitem__.return_value = page
+        with mock.patch('files.thumbnails.fitz') as fitz:
+            fitz.open.return_value = doc
+            self.assertTrue(thumbnails.generate(obj))
+        # PyMuPDF reads the file itself; its bytes are never loaded here.
+        fitz.open.assert_called_once_with(obj.file.path, filetype='pdf')
+        fitz.Matrix.assert_called_once_with(0.5, 0.5)
+
+class LocalDateTests(TestCase):
+    def sql(self, tzinfo):
+        queryset = FileUpload.objects.annotate(day=LocalDate('uploaded_at', tzinfo=tzinfo)).values('day')
+        compiler = queryset.query.get_compiler(connection=connection)
+        return compiler.as_sql()
+
+    def test_zone_names_are_inlined(self):
+        sql, params = self.sql(zoneinfo.ZoneInfo('Africa/Johannesburg'))
+        self.assertIn("'Africa/Johannesburg'", sql)
+        self.assertEqual(params, ())
+
+    def test_other_names_are_parameters(self):
+        sql, params = self.sql(datetime.timezone(datetime.timedelta(hours=2), "x'); DROP TABLE files_fileupload; --"))
+        self.assertNotIn('DROP TABLE', sql)
+        self.assertIn("x'); DROP TABLE files_fileupload; --", params)
+
+
+class DateIndexTests(TransactionTestCase):
+    def test_time_zone_change_needs_rebuild(self):
+        self.assertEqual(check_date_indexes(None, databases=['default']), [])
+        with override_settings(TIME_ZONE='Africa/Johannesburg'):
+            warnings = check_date_indexes(None, databases=['default'])
+            self.assertEqual({w.id for w in warnings}, {'files.W001'})
+            call_command('rebuild_date_indexes', stdout=io.StringIO())
+            self.assertEqual(check_date_indexes(None, databases=['default']), [])
+        call_command('rebuild_date_indexes', stdout=io.StringIO())
+
+
+class UserChangelistTests(PortalTestCase):
+    url = '/admin/auth/user/'
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(self.admin)
+
+    def add_students(self, count):
+        start = User.objects.count()
+        for n in range(start, start + count):
+            user = User.objects.create_user(f'student{n:03}', f's{n}@example.com')
+            StudentProfile.objects.create(user=user, middle_name=f'M{n}', level=n % 5 + 1)
+
+    def changelist(self, **params):
+        cache.clear()  # the cached row count is keyed on the query
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.context['cl'].result_list
+
+    def test_query_count_does_not_grow_with_users(self):
+        self.add_students(5)
+        with CaptureQueriesContext(connection) as queries:
+            self.changelist()
+        self.add_students(10)
+        with self.assertNumQueries(len(queries)):
+            self.assertEqual(len(self.changelist()), 16)
+
+    def test_sort_by_level(self):
+        self.add_students(6)
+        levels = [user.profile_level for user in self.changelist(o='-6')]
+        self.assertEqual(levels[:-1], sorted(levels[:-1], reverse=True))
+        self.assertIsNone(levels[-1])  # the admin has no profile
+
+    def test_level_filter(self):
+        self.add_students(10)
+        users = self.changelist(studentprofile__level__exact='3')
+        self.assertEqual(len(users), 2)
+        self.assertEqual({user.studentprofile.level for user in users}, {3})
+
+
+
+class UserExportTests(PortalTestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        self.ada = User.objects.create_user('ada', 'ada@example.com', first_name='Ada', last_name='Byron')
+        StudentProfile.objects.create(user=self.ada, middle_name='King')
+        self.bob = User.objects.create_user('bob', '', is_active=False)
+
+    def export(self, action):
+        return self.client.post('/admin/auth/user/', {
+            'action': action, '_selected_action': [self.ada.pk, self.bob.pk],
+        })
+
+    def test_csv_is_streamed(self):
+        response = self.export('export_selected_users_csv')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=users_export.csv')
+        chunks = iter(response.streaming_content)
+        # Nothing is queried until the client reads past the header...
+        with self.assertNumQueries(0):
+            self.assertEqual(next(chunks), b'id,username,email,first_name,middle_name,last_name,is_active,is_staff\r\n')
+        # ...and then each row is sent as it is read.
+        self.assertEqual(list(chunks), [
+            f'{self.ada.pk},ada,ada@example.com,Ada,King,Byron,yes,no\r\n'.encode(),
+            f'{self.bob.pk},bob,,,,,no,no\r\n'.encode(),
+        ])
+
+    def test_xlsx_is_written_in_write_only_mode(self):
+        from openpyxl import Workbook, load_workbook
+
+        with mock.patch('files.exports.Workbook', wraps=Workbook) as workbook:
+            response = self.export('export_selected_users_excel')
+        workbook.assert_called_once_with(write_only=True)
+        self.assertEqual(response['Content-Type'], exports.CONTENT_TYPES['xlsx'])
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="users_export.xlsx"')
+        sheet = load_workbook(io.BytesIO(b''.join(response.streaming_content)))['Users']
+        self.assertEqual([[cell.value for cell in row] for row in sheet.iter_rows()], [
+            exports.HEADERS,
+            [self.ada.pk, 'ada', 'ada@example.com', 'Ada', 'King', 'Byron', 'yes', 'no'],
+            [self.bob.pk, 'bob', None, None, None, None, 'no', 'no'],
+        ])
+        # Widths come from the longest value (or the header) plus padding.
+        self.assertEqual(sheet.column_dimensions['C'].width, len('ada@example.com') + 2)
+
+    @override_settings(EXPORT_ASYNC_THRESHOLD=1, EXPORT_DIR=os.path.join(MEDIA_ROOT, 'exports'))
+    def test_large_selection_is_exported_in_the_background(self):
+        with mock.patch('files.exports.threading', SimpleNamespace(Thread=InlineThread)):
+            response = self.export('export_selected_users_csv')
+        self.assertEqual(response.status_code, 302)
+        message = str(list(response.wsgi_request._messages)[0])
+        url = re.search(r'href="([^"]+)"', message).group(1)
+        download = self.client.get(url)
+        self.assertEqual(download['Content-Disposition'], 'attachment; filename="users_export.csv"')
+        self.assertEqual(len(b''.join(download.streaming_content).splitlines()), 3)
+
+
+class PasswordHashingTests(PortalTestCase):
+    plain = [f'secret-{n}' for n in range(passwords.MIN_POOL_USERS)]
+
+    @override_settings(PASSWORD_HASHERS=global_settings.PASSWORD_HASHERS)
+    def test_spawn_pool_round_trip(self):
+        # The spawned children load the project's settings and hash with PBKDF2.
+        with mock.patch('files.passwords.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as pool:
+            hashes = passwords.hash_passwords(self.plain, workers=2)
+        pool.assert_called_once()
+        self.assertEqual(pool.call_args.kwargs['mp_context'].get_start_method(), 'spawn')
+        self.assertEqual(len(hashes), len(self.plain))
+        self.assertTrue(all(encoded.startswith('pbkdf2_sha256$') for encoded in hashes))
+        # Verifying is as slow as hashing: the ends are enough to show the order is kept.
+        for n in (0, -1):
+            self.assertTrue(check_password(self.plain[n], hashes[n]))
+        self.assertFalse(check_password(self.plain[0], hashes[-1]))
+
+    def test_falls_back_when_pool_is_unavailable(self):
+        for error in (OSError('no /dev/shm'), BrokenProcessPool()):
+            with self.subTest(error=error), \
+                    mock.patch('files.passwords.ProcessPoolExecutor', side_effect=error), \
+                    self.assertLogs('files.passwords', 'WARNING'):
+                hashes = passwords.hash_passwords(self.plain, workers=2)
+            self.assertTrue(all(check_password(p, h) for p, h in zip(self.plain, hashes, strict=True)))
+
+
+class SharedBlobTests(PortalTestCase):
+    def setUp(self):
+        self.login()
+
+    def test_reused_blob_keeps_upload_name_and_type(self):
+        first = self.upload(name='notes.txt')
+        second = self.upload(name='Rock Notes.md')
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertEqual((second.extension, second.content_type), ('md', 'text/markdown'))
+        response = self.client.get(reverse('files:download', args=[second.pk]))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="Rock Notes.md"')
+        self.assertEqual(response['Content-Type'], 'text/markdown')
+
+    def test_dedupe_keeps_upload_names(self):
+        storage = FileUpload._meta.get_field('file').storage
+        names = [storage.save(f'uploads/{n}', ContentFile(b'same bytes')) for n in ('a.txt', 'b.txt')]
+        FileUpload.objects.bulk_create([FileUpload(title=n, file=n) for n in names])
+        call_command('dedupe_files', stdout=io.StringIO())
+        rows = FileUpload.objects.order_by('pk')
+        self.assertEqual({obj.file.name for obj in rows}, {names[0]})
+        self.assertEqual([obj.download_name for obj in rows], [os.path.basename(n) for n in names])
+        self.assertEqual(Blob.objects.get().refcount, 2)
+        self.assertFalse(storage.exists(names[1]))
+
+
+class BlobRefcountTests(PortalTestCase):
+    def setUp(self):
+        self.storage = FileUpload._meta.get_field('file').storage
+
+    def refcounts(self):
+        return dict(Blob.objects.values_list('name', 'refcount'))
+
+    def test_save_replace_delete(self):
+        first = self.upload(b'shared')
+        second = self.upload(b'shared', name='copy.txt')
+        self.assertEqual(self.refcounts(), {first.file.name: 2})
+
+        shared = first.file.name
+        second.file = SimpleUploadedFile('copy.txt', b'changed')
+        with self.captureOnCommitCallbacks(execute=True):
+            second.save()
+        self.assertEqual(self.refcounts(), {shared: 1, second.file.name: 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(self.refcounts(), {second.file.name: 1})
+        self.assertFalse(self.storage.exists(shared))
+
+    def test_failed_insert_takes_no_reference(self):
+        existing = self.upload(b'shared')
+        before = set(self.storage.listdir('uploads')[1])
+        for content in (b'shared', b'new contents'):
+            obj = FileUpload(title=None, file=SimpleUploadedFile('broken.txt', content))
+            with self.assertRaises(IntegrityError):
+                obj.save()
+            self.assertEqual(obj.file.name, 'broken.txt')
+        self.assertEqual(self.refcounts(), {existing.file.name: 1})
+        self.assertEqual(set(self.storage.listdir('uploads')[1]), before)
+
+
+@override_settings(CHUNKED_UPLOAD_DIR=os.path.join(MEDIA_ROOT, 'chunks'), CHUNKED_UPLOAD_CHUNK_SIZE=4)
+class ChunkedUploadTests(PortalTestCase):
+    data = b'0123456789'
+    form = {'title': 'Core log', 'level': 2, 'category': 'notes', 'semester': 1, 'download_count': 0}
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        response = self.client.post(reverse('admin:files_fileupload_chunked_start'), {'filename': 'core.txt', 'size': 10})
+        self.assertEqual(response.status_code, 201)
+        self.session = response.json()
+
+    def put(self, offset, data, **headers):
+        return self.client.put(
+            self.session['url'], data, content_type='application/octet-stream',
+            headers={'x-chunk-offset': str(offset), **headers},
+        )
+
+    def send_all(self):
+        for offset in range(0, len(self.data), 4):
+            self.assertEqual(self.put(offset, self.data[offset:offset + 4]).status_code, 200)
+
+    def complete(self):
+        return self.client.post(self.session['url'] + 'complete/', self.form)
+
+    def test_offsets(self):
+        self.assertEqual(self.put(0, b'0123').json()['offset'], 4)
+        # A chunk at the wrong offset is refused with where to resume.
+        response = self.put(8, b'89')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 4)
+        response = self.put(4, b'4567', **{'x-chunk-sha256': hashlib.sha256(b'wrong').hexdigest()})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(self.session['url']).json()['offset'], 4)
+        self.assertEqual(self.put(4, b'4567').json()['offset'], 8)
+        self.assertEqual(self.complete().status_code, 409)  # not all bytes yet
+
+    def test_complete(self):
+        self.send_all()
+        response = self.complete()
+        self.assertEqual(response.status_code, 201)
+        obj = FileUpload.objects.get(pk=response.json()['id'])
+        self.assertEqual((obj.title, obj.original_name, obj.size), ('Core log', 'core.txt', 10))
+        self.assertEqual(obj.file.read(), self.data)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_invalid_form_keeps_session(self):
+        self.send_all()
+        response = self.client.post(self.session['url'] + 'complete/', {**self.form, 'level': 99})
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(UploadSession.objects.exists())
+        self.assertEqual(self.complete().status_code, 201)
+
+    def test_completed_once(self):
+        self.send_all()
+        assembled_file = chunked.assembled_file
+
+        def completed_meanwhile(session):
+            # Another request completes the same upload after this one looked it up.
+            upload = assembled_file(session)
+            UploadSession.objects.filter(pk=session.pk).delete()
+            return upload
+
+        with mock.patch.object(chunked, 'assembled_file', completed_meanwhile):
+            response = self.complete()
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(FileUpload.objects.exists())
+
+
+class RollupTests(PortalTestCase):
+    def test_daily_users_are_distinct_across_levels(self):
+        alice, bob = User.objects.create_user('alice'), User.objects.create_user('bob')
+        level1, level2 = self.upload(level=1), self.upload(b'other', level=2)
+        for user, obj in ((alice, level1), (alice, level2), (bob, level1), (bob, level1)):
+            DownloadEvent.objects.create(file=obj, user=user, level=obj.level, bytes_served=100)
+
+        self.assertEqual(rollups.rollup(), [timezone.localdate()])
+        self.assertEqual(rollups.rollup(), [])  # nothing new
+        daily = rollups.dashboard()['daily']
+        self.assertEqual(
+            [(row['downloads'], row['users'], row['bytes_served']) for row in daily], [(4, 2, 400)],
+        )
+        self.assertEqual(rollups.dashboard(level=1)['daily'][0]['users'], 2)
+        self.assertEqual(rollups.dashboard(level=2)['daily'][0]['users'], 1)
+        top = rollups.dashboard()['top_files']
+        self.assertEqual([(row['file_id'], row['downloads']) for row in top], [(level1.pk, 3), (level2.pk, 1)])
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        response = self.client.get(reverse('admin:files_fileupload_downloads'))
+        self.assertContains(response, '<th>Users</th>', html=True)
+
+
+@portal_settings
+class IngestTests(TransactionTestCase):
+    # The upload threads need their own connections, outside a test transaction.
+    def test_blobs_are_claimed_with_the_insert(self):
+        existing = FileUpload.objects.create(title='shared', file=SimpleUploadedFile('notes.txt', b'shared'))
+        source = tempfile.mkdtemp(prefix='portal-ingest-')
+        self.addCleanup(shutil.rmtree, source, ignore_errors=True)
+        for name, content in (('a.txt', b'shared'), ('b.txt', b'fresh')):
+            with open(os.path.join(source, name), 'wb') as fh:
+                fh.write(content)
+        rows = [{'filename': n, 'title': n, 'level': 1, 'category': 'notes', 'semester': 1} for n in ('a.txt', 'b.txt')]
+        manifest = os.path.join(source, 'manifest.jsonl')
+
+        with mock.patch.object(FileUpload.objects, 'bulk_create', side_effect=IntegrityError('boom')):
+            with self.assertRaises(IntegrityError):
+                ingest.ingest(source, rows, manifest_path=manifest, notify=False)
+        self.assertEqual(dict(Blob.objects.values_list('name', 'refcount')), {existing.file.name: 1})
+
+        result = ingest.ingest(source, rows, manifest_path=manifest, notify=False)
+        self.assertEqual(len(result.created), 2)
+        fresh = FileUpload.objects.get(original_name='b.txt').file.name
+        self.assertEqual(dict(Blob.objects.values_list('name', 'refcount')), {existing.file.name: 2, fresh: 1})
+        self.assertEqual(FileUpload.objects.get(original_name='a.txt').file.name, existing.file.name)
+
+    def source(self, files):
+        source = tempfile.mkdtemp(prefix='portal-ingest-')
+        self.addCleanup(shutil.rmtree, source, ignore_errors=True)
+        for name, content in files.items():
+            with open(os.path.join(source, name), 'wb') as fh:
+                fh.write(content)
+        rows = [{'filename': n, 'title': n, 'level': 1, 'category': 'notes', 'semester': 1} for n in files]
+        return source, rows
+
+    def test_resume_skips_rows_committed_before_the_manifest(self):
+        source, rows = self.source({'a.txt': b'alpha', 'b.txt': b'beta'})
+        manifest = os.path.join(source, 'manifest.jsonl')
+        # The batch commits, then the process dies before recording it.
+        with mock.patch.object(ingest.Manifest, 'record_created', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                ingest.ingest(source, rows, manifest_path=manifest, notify=False)
+        self.assertEqual(FileUpload.objects.count(), 2)
+
+        result = ingest.ingest(source, rows, manifest_path=manifest, notify=False)
+        self.assertEqual((result.created, len(result.recovered)), ([], 2))
+        self.assertEqual(FileUpload.objects.count(), 2)
+        self.assertEqual(list(Blob.objects.values_list('refcount', flat=True)), [1, 1])
+        # Now recorded: a third run has nothing to do.
+        self.assertEqual(ingest.ingest(source, rows, manifest_path=manifest, notify=False).skipped, 2)
+
+    def test_zip_members_are_streamed(self):
+        directory = tempfile.mkdtemp(prefix='portal-ingest-')
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        archive = os.path.join(directory, 'upload.zip')
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('maps/a.txt', b'alpha' * 1000)
+            zf.writestr('b.txt', b'beta')
+        rows = [{'filename': n, 'title': n, 'level': 1, 'category': 'notes', 'semester': 1} for n in ('maps/a.txt', 'b.txt')]
+        # Members are never read into memory whole.
+        with mock.patch.object(zipfile.ZipFile, 'read', side_effect=AssertionError('read() called')):
+            result = ingest.ingest(archive, rows, notify=False)
+        self.assertEqual(result.failed, [])
+        obj = FileUpload.objects.get(original_name='a.txt')
+        with obj.file.open('rb') as fh:
+            self.assertEqual(fh.read(), b'alpha' * 1000)
+        self.assertEqual(obj.checksum, hashlib.sha256(b'alpha' * 1000).hexdigest())
+
+
+
+
+@override_settings(METRICS_TOKEN='scrape-me')
+class MetricsTests(PortalTestCase):
+    def setUp(self):
+        self.login()
+        self.obj = self.upload(b'x' * 20000, name='core.txt')
+        self.url = reverse('files:download', args=[self.obj.pk])
+
+    def metric(self, name, **labels):
+        # Current value of one sample, 0 if it isn't there yet.
+        wanted = ','.join(f'{k}="{v}"' for k, v in labels.items())
+        for line in metrics.render().splitlines():
+            if line.startswith(f'portal_{name}{{{wanted}}} '):
+                return float(line.rsplit(' ', 1)[1])
+        return 0
+
+    def test_download_is_measured(self):
+        view = 'files:download'
+        before = {
+            'requests': self.metric('http_requests_total', view=view, status='2xx'),
+            'queries': self.metric('db_queries_total', view=view),
+            'opens': self.metric('storage_calls_total', view=view, operation='open'),
+            'bytes': self.metric('streamed_bytes_total', view=view),
+        }
+        response = self.client.get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), b'x' * 20000)
+        response.close()
+        self.assertEqual(self.metric('http_requests_total', view=view, status='2xx'), before['requests'] + 1)
+        self.assertGreater(self.metric('db_queries_total', view=view), before['queries'])
+        self.assertEqual(self.metric('storage_calls_total', view=view, operation='open'), before['opens'] + 1)
+        self.assertEqual(self.metric('streamed_bytes_total', view=view), before['bytes'] + 20000)
+
+    def test_abandoned_download_counts_bytes_sent(self):
+        before = self.metric('streamed_bytes_total', view='files:download')
+        response = self.client.get(self.url)
+        first = next(iter(response.streaming_content))
+        response.close()  # the client went away after one block
+        self.assertLess(len(first), 20000)
+        self.assertEqual(self.metric('streamed_bytes_total', view='files:download'), before + len(first))
+
+    def test_storage_classes_are_left_alone(self):
+        self.client.get(reverse('files:home'))
+        storage = FileUpload._meta.get_field('file').storage
+        self.assertIs(type(storage), metrics.InstrumentedStorage)
+        self.assertIsInstance(storage, FileSystemStorage)
+        # Nothing is patched onto the classes (functools.wraps would leave __wrapped__).
+        for operation in metrics.STORAGE_METHODS:
+            self.assertFalse(hasattr(getattr(FileSystemStorage, operation), '__wrapped__'), operation)
+
+    def test_endpoint_access(self):
+        url = reverse('files:metrics')
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, headers={'authorization': 'Bearer wrong'}).status_code, 403)
+        response = self.client.get(url, headers={'authorization': 'Bearer scrape-me'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        self.assertIn('# TYPE portal_http_request_duration_seconds histogram', response.content.decode())
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+class CatalogCacheTests(PortalTestCase):
+    def setUp(self):
+        cache.clear()
+        self.login()
+        self.obj = self.upload(title='Granite', level=2, category='notes', semester=1)
+
+    def home(self):
+        return self.client.get(reverse('files:home')).content.decode()
+
+    def counts(self):
+        # Served from the cache when it is current: no aggregate query.
+        with self.assertNumQueries(1):  # the version lookup
+            return catalog.combination_counts(catalog.current_version())
+
+    def test_page_cache_invalidated_by_bump_version(self):
+        self.assertIn('Granite', self.home())
+        # update() sends no signals: the cached page is still served...
+        FileUpload.objects.filter(pk=self.obj.pk).update(title='Basalt')
+        self.assertIn('Granite', self.home())
+        # ...until the catalog version moves on.
+        catalog.bump_version()
+        self.assertIn('Basalt', self.home())
+
+    def test_counts_follow_create_delete_and_archive(self):
+        catalog.combination_counts(catalog.current_version())
+        key = (2, 'notes', 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            other = self.upload(title='Basalt', level=2, category='notes', semester=1)
+        self.assertEqual(self.counts(), {key: 2})
+        with self.captureOnCommitCallbacks(execute=True):
+            other.delete()
+        self.assertEqual(self.counts(), {key: 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            catalog.archive_files(FileUpload.objects.filter(pk=self.obj.pk))
+        self.assertEqual(self.counts(), {})
+
+    def test_only_catalog_fields_bump_the_version(self):
+        version = catalog.current_version()
+        self.obj.download_count += 1
+        self.obj.save(update_fields=['download_count'])
+        self.assertEqual(catalog.current_version(), version)
+        self.obj.title = 'Basalt'
+        self.obj.save(update_fields=['title'])
+        self.assertEqual(catalog.current_version(), version + 1)
+
+class CatalogCursorTests(PortalTestCase):
+    def test_cursor_round_trip(self):
+        obj = views._catalog_queryset().get(pk=self.upload(name='x.txt', title='Rock-Mechanics ü').pk)
+        self.assertEqual(
+            views._decode_cursor(views._encode_cursor(obj)), (obj.upload_date, 'rock-mechanics ü', obj.pk),
+        )
+        for garbage in ('', 'nonsense', '2024-1', '20240101-x-YQ', '20241301-1-YQ'):
+            self.assertIsNone(views._decode_cursor(garbage))
+
+    def test_pages_list_every_file_once_in_order(self):
+        # Equal and differently cased titles on the same day exercise every
+        # tie-break in the keyset condition.
+        titles = ['beta', 'Alpha', 'alpha', 'gamma']
+        now = timezone.now()
+        for n in range(views.PAGE_SIZE * 2 + 3):
+            obj = self.upload(title=titles[n % len(titles)])
+            FileUpload.objects.filter(pk=obj.pk).update(uploaded_at=now - datetime.timedelta(days=n % 3))
+        self.upload(title='hidden', archived=True)
+
+        seen, cursor, pages = [], None, 0
+        while True:
+            page = views._catalog_page(None, None, None, cursor)
+            seen += [f.pk for group in page['files_groups'].values() for f in group]
+            pages += 1
+            if not page['next_url']:
+                break
+            cursor = views._decode_cursor(parse_qs(urlparse(page['next_url']).query)['after'][0])
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen, list(views._catalog_queryset().values_list('pk', flat=True)))
+        self.assertEqual(len(set(seen)), views.PAGE_SIZE * 2 + 3)
+
+    def test_next_page_over_http(self):
+        self.login()
+        for n in range(views.PAGE_SIZE + 1):
+            self.upload(title=f'file {n:02}')
+        xhr = {'x-requested-with': 'XMLHttpRequest'}
+        first = self.client.get(reverse('files:home'), headers=xhr).content.decode()
+        next_url = re.search(r'data-next-url="([^"]+)"', first).group(1).replace('&amp;', '&')
+        second = self.client.get(next_url, headers=xhr)
+        self.assertContains(second, 'file 30')
+        self.assertNotContains(second, 'file 29')
+        self.assertNotContains(second, 'data-next-url')
+
+
+class SearchTests(PortalTestCase):
+    def upload(self, *args, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return super().upload(*args, **kwargs)
+
+    def setUp(self):
+        self.login()
+        self.igneous = self.upload(b'Granite and basalt cool from magma.', name='igneous.txt', title='Igneous rocks')
+        self.sediment = self.upload(b'Sandstone, shale and some basalt pebbles.', name='sed.txt', title='Sedimentary rocks', level=2)
+
+    def search(self, **params):
+        response = self.client.get(reverse('files:search'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.context['results']
+
+    def test_prefix_match_ranks_titles_first(self):
+        self.assertEqual([r.pk for r in self.search(q='sedim')], [self.sediment.pk])
+        mention = self.upload(b'Unlike igneous rocks, these formed under pressure.', name='meta.txt', title='Metamorphic')
+        self.assertEqual([r.pk for r in self.search(q='igneous')], [self.igneous.pk, mention.pk])
+        results = self.search(q='rocks sand')
+        self.assertEqual([r.pk for r in results], [self.sediment.pk])
+        self.assertIn('<mark>Sandstone</mark>', results[0].search_snippet)
+
+    def test_filters_archive_and_updates(self):
+        self.assertEqual([r.pk for r in self.search(q='basalt', level=2)], [self.sediment.pk])
+        FileUpload.objects.filter(pk=self.sediment.pk).update(archived=True)
+        self.assertEqual([r.pk for r in self.search(q='basalt')], [self.igneous.pk])
+        self.igneous.title = 'Volcanic rocks'
+        self.igneous.save()
+        self.assertEqual([r.pk for r in self.search(q='volcanic')], [self.igneous.pk])
+        self.igneous.delete()
+        self.assertEqual(self.search(q='basalt'), [])
+
+    def test_text_is_extracted_after_commit(self):
+        with mock.patch('files.search.extract_text', return_value='') as extract:
+            with self.captureOnCommitCallbacks() as callbacks:
+                obj = super().upload(b'Quartz veins.', name='quartz.txt', title='Quartz')
+            extract.assert_not_called()  # not inside the save
+        self.assertEqual(self.search(q='quartz'), [])
+        for callback in callbacks:
+            callback()
+        self.assertEqual([r.pk for r in self.search(q='quartz veins')], [obj.pk])
+
+    def test_query_syntax_is_literal(self):
+        self.assertEqual(self.search(q='" OR * NEAR('), [])
+        self.assertEqual(self.search(q=''), [])
@@ -0,0 +1,157 @@
+"""Small WebP thumbnails for the home page cards.
+
+Images are downscaled with Pillow; PDFs get their first page rendered with
+PyMuPDF or, failing that, poppler's `pdftoppm`. Thumbnails are stored under
+`uploads/thumbs/` next to the originals. They are generated in the
+background after an upload is saved, and `files:thumbnail` generates
+(and stores) any that are missing the first time a card asks for one.
+"""
+import io
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+
+# Pillow is optional; without it no thumbnails are produced.
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except Exception:
+    Image = None
+    PIL_AVAILABLE = False
+
+# PyMuPDF is optional; pdftoppm is used for PDFs when it isn't installed.
+try:
+    import fitz
+except Exception:
+    fitz = None
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = (320, 320)
+WEBP_QUALITY = 75
+# Don't retry a file that failed to render on every card view.
+FAILURE_CACHE_SECONDS = 3600
+
+
+def is_supported(obj):
+    """Return True if a thumbnail can be made for this upload's type."""
+    content_type = obj.get_content_type()
+    return PIL_AVAILABLE and (content_type.startswith('image/') or content_type == 'application/pdf')
+
+
+def _to_webp(image):
+    image.thumbnail(THUMBNAIL_SIZE)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+    out = io.BytesIO()
+    image.save(out, 'WEBP', quality=WEBP_QUALITY, method=4)
+    return out.getvalue()
+
+
+def _render_image(field_file):
+    field_file.open('rb')
+    try:
+        image = Image.open(field_file)
+        # JPEG can decode at a reduced scale directly, which is much cheaper.
+        image.draft('RGB', THUMBNAIL_SIZE)
+        return _to_webp(image)
+    finally:
+        field_file.close()
+
+
+def _local_path(field_file, tmp):
+    # A path on local disk for the file: its own for FileSystemStorage, or a
+    # copy in `tmp` streamed from remote storage a chunk at a time, so a large
+    # PDF is never held in memory.
+    try:
+        src = field_file.path
+    except NotImplementedError:
+        src = os.path.join(tmp, 'source.pdf')
+        field_file.open('rb')
+        try:
+            with open(src, 'wb') as fh:
+                for chunk in field_file.chunks():
+                    fh.write(chunk)
+        finally:
+            field_file.close()
+    return src
+
+
+def _render_pdf(field_file):
+    if fitz is None and not shutil.which('pdftoppm'):
+        return None
+    with tempfile.TemporaryDirectory() as tmp:
+        src = _local_path(field_file, tmp)
+        if fitz is not None:
+            # Opened from the path, PyMuPDF only reads the pages it renders.
+            with fitz.open(src, filetype='pdf') as doc:
+                page = doc[0]
+                zoom = THUMBNAIL_SIZE[0] / max(page.rect.width, 1)
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+            return _to_webp(Image.open(io.BytesIO(pix.tobytes('png'))))
+
+        out = os.path.join(tmp, 'page')
+        subprocess.run(
+            ['pdftoppm', '-f', '1', '-l', '1', '-singlefile', '-scale-to', str(THUMBNAIL_SIZE[0]), '-png', src, out],
+            check=True, capture_output=True, timeout=30,
+        )
+        with Image.open(out + '.png') as image:
+            return _to_webp(image)
+
+
+def render(obj):
+    """Return WebP thumbnail bytes for an upload, or None if not possible."""
+    if not obj.file or not is_supported(obj):
+        return None
+    if obj.get_content_type() == 'application/pdf':
+        return _render_pdf(obj.file)
+    return _render_image(obj.file)
+
+
+def generate(obj):
+    """Render and store the thumbnail for `obj`; return True on success."""
+    failure_key = f'thumbnail-failed:{obj.pk}:{obj.checksum[:16]}'
+    if cache.get(failure_key):
+        return False
+    try:
+        data = render(obj)
+    except Exception:
+        logger.warning('Could not render thumbnail for %s', obj.file.name, exc_info=True)
+        data = None
+    if not data:
+        cache.set(failure_key, True, FAILURE_CACHE_SECONDS)
+        return False
+    stem = os.path.splitext(os.path.basename(obj.file.name))[0]
+    obj.thumbnail.save(f'{stem}.webp', ContentFile(data), save=False)
+    # update() rather than save(): no post_save signals for a derived file.
+    type(obj).objects.filter(pk=obj.pk).update(thumbnail=obj.thumbnail.name)
+    return True
+
+
+def _generate_in_background(pk):
+    from .models import FileUpload
+    try:
+        obj = FileUpload.objects.filter(pk=pk).first()
+        if obj is not None:
+            generate(obj)
+    except Exception:
+        logger.exception('Thumbnail generation failed for upload %s', pk)
+    finally:
+        close_old_connections()
+
+
+def schedule(obj):
+    """Generate the thumbnail in a background thread once the save has committed."""
+    if not is_supported(obj):
+        return
+    pk = obj.pk
+    transaction.on_commit(
+        lambda: threading.Thread(target=_generate_in_background, args=(pk,), name='thumbnail', daemon=True).start()
+    )
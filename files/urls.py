@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns # new
 # path is used to map URL patterns to view callables.
@@ -18,9 +19,20 @@ urlpatterns = [
     path('category/<slug:category>/', views.index, name='category'),
     path('semester/<int:semester>/', views.index, name='semester'),
     # Home page filtered by category (notes, past_papers, assignments).
-    path('download/<int:pk>/', views.download_file, name='download'),
-    path('preview/<int:pk>/', views.preview_file, name='preview'),
+    path('search/', views.search, name='search'),
+    # Ranked full-text search over titles and document contents.
+    path('download/<int:pk>/', views.adownload_file if settings.ASYNC_FILE_VIEWS else views.download_file, name='download'),
+    path('preview/<int:pk>/', views.apreview_file if settings.ASYNC_FILE_VIEWS else views.preview_file, name='preview'),
+    # Under ASGI (ASYNC_FILE_VIEWS) downloads and previews are served by async views.
     path('preview-page/<int:pk>/', views.preview_page, name='preview_page'),
+    path('facets/', views.facet_counts, name='facets'),
+    # File counts per level/category/semester as JSON.
+    path('thumbnail/<int:pk>/', views.thumbnail, name='thumbnail'),
+    # Small WebP preview image shown on the file cards.
+    path('metrics', views.metrics, name='metrics'),
+    # Per-URL request metrics in Prometheus format (staff or METRICS_TOKEN).
+    path('signed-media/<str:token>/', views.signed_media, name='signed_media'),
+    # Expiring links issued by SignedFileSystemStorage (FILE_DELIVERY = 'redirect').
     # Download URL for a specific file by its primary key.
     path('register/', views.register, name='register'),
     # Student registration page (also available at root).
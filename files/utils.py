@@ -1,6 +1,6 @@
 from django.core.mail import send_mail
 from django.conf import settings
-from .models import EmailLog
+from .models import EmailLog, EmailOutbox
 
 
 def send_email_and_log(subject, body, from_email, recipient_list):
@@ -16,3 +16,20 @@ def send_email_and_log(subject, body, from_email, recipient_list):
         log.error = str(exc)
         log.save(update_fields=['sent', 'error'])
         return False
+
+
+def queue_email(subject, body, recipient_list=None, from_email=None):
+    """Queue an email for the outbox worker.
+
+    `recipient_list=None` sends it to all active users; an empty list queues
+    nothing and returns None.
+    """
+    if recipient_list is not None and not recipient_list:
+        return None
+    return EmailOutbox.objects.create(
+        subject=subject,
+        body=body,
+        from_email=from_email or settings.DEFAULT_FROM_EMAIL,
+        recipients=','.join(recipient_list or []),
+        broadcast=recipient_list is None,
+    )
@@ -1,14 +1,21 @@
-from django.shortcuts import render, get_object_or_404, redirect
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect
 # render helps render templates; get_object_or_404 fetches objects or returns 404.
-from django.http import FileResponse
-# FileResponse streams files efficiently for downloads.
+from .models import FileUpload, LocalDate, CATEGORY_CHOICES, SEMESTER_CHOICES
+from django.db.models import Q
+from django.db.models.functions import Lower
+from . import search as fts
+from . import backup
+from .responses import aserve_file, serve_file
+from .storage import load_signed_token
+from . import thumbnails
+from django.utils.cache import get_conditional_response
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from urllib.parse import urlencode
+from . import catalog
+from . import metrics as perf_metrics
 import os
-# os is used to manipulate file path components (basename, etc.).
-import mimetypes
-# mimetypes helps guess the correct Content-Type for the downloaded file.
-from django.utils.encoding import smart_str
-# smart_str helps ensure filenames are encoded safely for HTTP headers.
-from .models import FileUpload, CATEGORY_CHOICES, SEMESTER_CHOICES
 from .forms import StudentRegistrationForm
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
@@ -17,86 +24,185 @@ from django.urls import reverse
 from django.conf import settings
 from collections import OrderedDict
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 # messages can show feedback to users on registration/login.
-import shutil
+import base64
+import binascii
 import datetime
 
 
-def index(request, level=None, category=None, semester=None):
-    # View for the home page that lists uploaded files.
-    # If `level` and/or `category` provided, filter files accordingly.
-    # Only show non-archived files on the public home page
-    files_qs = FileUpload.objects.filter(archived=False).order_by('-uploaded_at')
-    # Build a simple level list for the template (1..5) and category list from model choices.
-    levels = [1, 2, 3, 4, 5]
-    current_level = None
-    # Build categories list from model-level choices so template can iterate labels and keys.
-    categories = [{'key': k, 'label': v} for k, v in CATEGORY_CHOICES]
-    current_category = None
-    # Semesters for the template
-    semesters = [{'key': k, 'label': v} for k, v in SEMESTER_CHOICES]
-    current_semester = None
+# Number of file cards rendered per page (the home page loads more on scroll).
+PAGE_SIZE = 30
+# Number of ranked results per search page.
+SEARCH_PAGE_SIZE = 20
+# Levels offered by the filters (1..5).
+LEVELS = [1, 2, 3, 4, 5]
+
+
+def _catalog_queryset():
+    # Visible files with their local upload date and sort title computed in SQL,
+    # in display order: newest date first, then title A-Z within each date.
+    # The partial expression indexes on FileUpload match this ordering.
+    return (
+        FileUpload.objects.filter(archived=False)
+        .annotate(
+            upload_date=LocalDate('uploaded_at', tzinfo=timezone.get_current_timezone()),
+            title_key=Lower('title'),
+        )
+        .order_by('-upload_date', 'title_key', 'pk')
+    )
+
 
-    # Apply level filter if provided and valid.
+def _encode_cursor(f):
+    # Cursor for the row after which the next page starts:
+    # "<YYYYMMDD>-<pk>-<base64 lowercased title>".
+    title = base64.urlsafe_b64encode(f.title_key.encode()).decode().rstrip('=')
+    return f'{f.upload_date:%Y%m%d}-{f.pk}-{title}'
+
+
+def _decode_cursor(value):
+    # Return (upload_date, title_key, pk) from a cursor string, or None if it is malformed.
+    try:
+        day, pk, title = value.split('-', 2)
+        title_key = base64.urlsafe_b64decode(title + '=' * (-len(title) % 4)).decode()
+        return datetime.datetime.strptime(day, '%Y%m%d').date(), title_key, int(pk)
+    except (AttributeError, TypeError, ValueError, binascii.Error):
+        return None
+
+
+def _parse_filters(level, category, semester):
+    # Validate raw level/category/semester values; invalid ones are ignored (None).
+    current_level = current_category = current_semester = None
+
+    # Accept the level if provided and valid.
     if level:
         try:
             level_int = int(level)
-            if level_int in levels:
-                files_qs = files_qs.filter(level=level_int)
+            if level_int in LEVELS:
                 current_level = level_int
         except (TypeError, ValueError):
             current_level = None
 
-    # Apply category filter if provided and valid.
+    # Accept the category key (notes, past_papers, assignments) if valid.
     if category:
-        # Accept either the key (notes, past_papers, assignments) or a display label.
         valid_keys = [k for k, _ in CATEGORY_CHOICES]
         if category in valid_keys:
-            files_qs = files_qs.filter(category=category)
             current_category = category
 
-    # Apply semester filter if provided
+    # Accept the semester if provided and valid.
     if semester:
         try:
             sem_int = int(semester)
             valid_semesters = [k for k, _ in SEMESTER_CHOICES]
             if sem_int in valid_semesters:
-                files_qs = files_qs.filter(semester=sem_int)
                 current_semester = sem_int
         except (TypeError, ValueError):
             current_semester = None
-
-    # followed by the files uploaded on that date. Make handling robust
-    # for naive vs aware datetimes so uploads on different dates separate correctly.
+    return current_level, current_category, current_semester
+
+
+def _catalog_page(current_level, current_category, current_semester, cursor):
+    # Context for one page of date-grouped cards after `cursor` (or the first page).
+    # Only show non-archived files on the public home page. `uploaded_by` is
+    # joined in so the cards don't query it one by one.
+    files_qs = _catalog_queryset().select_related('uploaded_by')
+    filters = {}
+    if current_level is not None:
+        files_qs = files_qs.filter(level=current_level)
+        filters['level'] = current_level
+    if current_category is not None:
+        files_qs = files_qs.filter(category=current_category)
+        filters['category'] = current_category
+    if current_semester is not None:
+        files_qs = files_qs.filter(semester=current_semester)
+        filters['semester'] = current_semester
+
+    # Keyset pagination: continue strictly after the cursor row so every page
+    # costs the same regardless of how many files exist. The leading
+    # upload_date <= day lets the database seek straight to the cursor.
+    continued_key = None
+    if cursor is not None:
+        after_day, after_title, after_pk = cursor
+        files_qs = files_qs.filter(upload_date__lte=after_day).filter(
+            Q(upload_date__lt=after_day)
+            | Q(title_key__gt=after_title)
+            | Q(title_key=after_title, pk__gt=after_pk)
+        )
+        # A date group may straddle the page boundary; the client merges a group
+        # with this key into the heading it already shows.
+        continued_key = after_day.strftime('%Y-%m-%d')
+    page = list(files_qs[:PAGE_SIZE + 1])
+    has_more = len(page) > PAGE_SIZE
+    page = page[:PAGE_SIZE]
+
+    # Rows arrive grouped and sorted; just split them at each new date.
     groups = OrderedDict()
-    for f in files_qs:
-        dt = f.uploaded_at
-        try:
-            if timezone.is_naive(dt):
-                aware = timezone.make_aware(dt, timezone.get_default_timezone())
-            else:
-                aware = dt
-            d = timezone.localtime(aware).date()
-        except Exception:
-            try:
-                d = dt.date()
-            except Exception:
-                d = None
-        key = d.strftime('%Y-%m-%d') if d is not None else f'unknown-{f.pk}'
-        groups.setdefault(key, []).append(f)
-
-    # Sort files in each date group alphabetically by first letter (case-insensitive),
-    # then by full title to stabilize ordering.
-    for k, lst in groups.items():
-        lst.sort(key=lambda obj: (((obj.title or '')[:1] or '').lower(), (obj.title or '').lower()))
+    for f in page:
+        groups.setdefault(f.upload_date.strftime('%Y-%m-%d'), []).append(f)
+
+    next_url = None
+    if has_more:
+        # Built from the filters alone (not the request path) so the cached page
+        # is the same for /level/2/ and /home/?level=2.
+        filters['after'] = _encode_cursor(page[-1])
+        next_url = f"{reverse('files:home')}?{urlencode(filters)}"
+
+    return {
+        'files_groups': groups,
+        'continued_key': continued_key,
+        'next_url': next_url,
+    }
+
+
+def index(request, level=None, category=None, semester=None):
+    # View for the home page that lists uploaded files.
+    # If `level` and/or `category` provided, filter files accordingly.
+    # The filter dropdowns combine filters through the query string.
+    current_level, current_category, current_semester = _parse_filters(
+        level or request.GET.get('level'),
+        category or request.GET.get('category'),
+        semester or request.GET.get('semester'),
+    )
+    cursor = _decode_cursor(request.GET.get('after'))
+    after = request.GET.get('after') if cursor is not None else None
+
+    # The rendered cards are cached per filter combination and cursor, keyed by
+    # the catalog version so uploads and archiving show up immediately.
+    version = catalog.current_version()
+    cards = catalog.get_page(version, current_level, current_category, current_semester, after)
+    if cards is None:
+        cards = render_to_string(
+            'files/_file_groups.html',
+            _catalog_page(current_level, current_category, current_semester, cursor),
+        )
+        catalog.set_page(version, current_level, current_category, current_semester, after, cards)
+
+    # Infinite scroll requests only need the next batch of cards.
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return HttpResponse(cards)
+
+    # An empty catalog renders as whitespace only.
+    context = {'catalog_html': mark_safe(cards) if cards.strip() else ''}
+
+    # Dropdown options carry how many files they would show; the counts come
+    # from the cached aggregate, so no query once warm.
+    counts = catalog.facets(
+        catalog.combination_counts(version), current_level, current_category, current_semester,
+    )
+    # Build a simple level list for the template (1..5) and category list from model choices.
+    levels = [{'key': lvl, 'count': counts['level'].get(lvl, 0)} for lvl in LEVELS]
+    # Build categories list from model-level choices so template can iterate labels and keys.
+    categories = [{'key': k, 'label': v, 'count': counts['category'].get(k, 0)} for k, v in CATEGORY_CHOICES]
+    # Semesters for the template
+    semesters = [{'key': k, 'label': v, 'count': counts['semester'].get(k, 0)} for k, v in SEMESTER_CHOICES]
+
     # Check for likely OneDrive-synced project folder which can overwrite db.sqlite3
     # and cause 'missing user' issues when files are synced across devices.
     db_path = settings.DATABASES.get('default', {}).get('NAME', '')
     if isinstance(db_path, str) and 'onedrive' in db_path.lower():
         messages.warning(request, 'Warning: project appears inside OneDrive. Database file may be overwritten by sync; consider moving the project or the DB to a stable location.')
 
-    return render(request, 'files/index.html', {
-        'files_groups': groups,
+    context.update({
         'levels': levels,
         'current_level': current_level,
         'semesters': semesters,
@@ -104,40 +210,79 @@ def index(request, level=None, category=None, semester=None):
         'categories': categories,
         'current_category': current_category,
     })
+    return render(request, 'files/index.html', context)
     # Render the template with files, available levels/categories, and current selections.
 
 
-def download_file(request, pk):
-    # View to download a file by its primary key (id).
-    obj = get_object_or_404(FileUpload, pk=pk)
-    # Fetch the object or return a 404 response if not found.
+def facet_counts(request):
+    # JSON version of the dropdown counts, for the given level/category/semester.
+    current_level, current_category, current_semester = _parse_filters(
+        request.GET.get('level'), request.GET.get('category'), request.GET.get('semester'),
+    )
+    version = catalog.current_version()
+    combinations = catalog.combination_counts(version)
+    counts = catalog.facets(combinations, current_level, current_category, current_semester)
+    return JsonResponse({
+        'version': version,
+        'total': counts['total'],
+        'level': {str(k): n for k, n in sorted(counts['level'].items())},
+        'category': dict(sorted(counts['category'].items())),
+        'semester': {str(k): n for k, n in sorted(counts['semester'].items())},
+        'combinations': [
+            {'level': l, 'category': c, 'semester': s, 'count': n}
+            for (l, c, s), n in sorted(combinations.items())
+        ],
+    })
+
 
-    # Use only the base filename (no directory components) for the download filename.
-    filename = os.path.basename(obj.file.name)
-    # Guess the MIME type (content type) from the filename extension.
-    content_type, encoding = mimetypes.guess_type(filename)
-    if not content_type:
-        # Fall back to a generic binary stream if unknown.
-        content_type = 'application/octet-stream'
+facet_counts = login_required(facet_counts)
 
-    # Open the underlying file in binary mode for streaming.
-    file_handle = obj.file.open('rb')
 
-    # Increment download counter (best-effort) before returning response.
+def search(request):
+    # Ranked full-text search over titles and document text, with the same
+    # level/category/semester filters as the home page.
+    query = request.GET.get('q', '').strip()
+    current_level, current_category, current_semester = _parse_filters(
+        request.GET.get('level'), request.GET.get('category'), request.GET.get('semester'),
+    )
     try:
-        obj.increment_downloads()
-    except Exception:
-        pass
+        page = max(1, int(request.GET.get('page', 1)))
+    except (TypeError, ValueError):
+        page = 1
+    results, has_next = fts.search(
+        query, level=current_level, category=current_category, semester=current_semester,
+        page=page, per_page=SEARCH_PAGE_SIZE,
+    )
+
+    def page_url(number):
+        params = request.GET.copy()
+        params['page'] = number
+        return f'{request.path}?{params.urlencode()}'
+
+    return render(request, 'files/search.html', {
+        'query': query,
+        'results': results,
+        'page': page,
+        'prev_url': page_url(page - 1) if page > 1 else None,
+        'next_url': page_url(page + 1) if has_next else None,
+        'levels': LEVELS,
+        'current_level': current_level,
+        'categories': [{'key': k, 'label': v} for k, v in CATEGORY_CHOICES],
+        'current_category': current_category,
+        'semesters': [{'key': k, 'label': v} for k, v in SEMESTER_CHOICES],
+        'current_semester': current_semester,
+    })
 
-    # Create a FileResponse with the guessed content type and a clean filename.
-    # `as_attachment=True` instructs browsers to download rather than display inline.
-    response = FileResponse(file_handle, as_attachment=True, filename=smart_str(filename), content_type=content_type)
 
-    # Some clients may need an explicit Content-Disposition header; FileResponse sets one,
-    # but we ensure the header uses a safe, encoded filename.
-    response['Content-Disposition'] = f'attachment; filename="{smart_str(filename)}"'
+def download_file(request, pk):
+    # View to download a file by its primary key (id).
+    obj = get_object_or_404(FileUpload, pk=pk)
+    # Fetch the object or return a 404 response if not found.
 
-    return response
+    # Stream it as an attachment with ETag/Last-Modified validators and Range
+    # support so interrupted downloads can resume; the counter is bumped only
+    # for transfers that start at the first byte.
+    return serve_file(request, obj, as_attachment=True, count_download=True)
 
 
 def register(request):
@@ -146,18 +291,9 @@ def register(request):
         form = StudentRegistrationForm(request.POST)
         if form.is_valid():
             form.save()
-            # Make a quick DB backup after a new registration to reduce risk of OneDrive overwrites
-            try:
-                db_path = settings.DATABASES.get('default', {}).get('NAME')
-                if db_path:
-                    db_file = str(db_path)
-                    if os.path.exists(db_file):
-                        backups_dir = os.path.join(settings.BASE_DIR, 'db_backups')
-                        os.makedirs(backups_dir, exist_ok=True)
-                        ts = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-                        shutil.copy2(db_file, os.path.join(backups_dir, f'db_backup_{ts}.sqlite3'))
-            except Exception:
-                pass
+            # Count the write towards the next background DB snapshot (files/backup.py)
+            # to reduce risk of OneDrive overwrites; no copying happens in the request.
+            backup.note_write()
 
             # Do not send emails on registration and avoid showing email-sent alerts.
             messages.success(request, 'Registration successful. Please log in.')
@@ -174,18 +310,9 @@ def login_view(request):
         password = request.POST.get('password')
         user = authenticate(request, username=username, password=password)
         if user is not None:
-            # On successful login, create a lightweight DB backup to reduce data loss
-            try:
-                db_path = settings.DATABASES.get('default', {}).get('NAME')
-                if db_path:
-                    db_file = str(db_path)
-                    if os.path.exists(db_file):
-                        backups_dir = os.path.join(settings.BASE_DIR, 'db_backups')
-                        os.makedirs(backups_dir, exist_ok=True)
-                        ts = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-                        shutil.copy2(db_file, os.path.join(backups_dir, f'db_login_backup_{ts}.sqlite3'))
-            except Exception:
-                pass
+            # On successful login, count the session write towards the next
+            # background DB snapshot to reduce data loss.
+            backup.note_write()
             login(request, user)
             return redirect('files:home')
         else:
@@ -195,20 +322,15 @@ def login_view(request):
 
 # Protect the main pages so only authenticated students can view and download files.
 index = login_required(index)
+search = login_required(search)
 download_file = login_required(download_file)
 
 
 def preview_file(request, pk):
     # Stream the file with an inline Content-Disposition so browsers can render it.
+    # PDF viewers fetch byte ranges, and a re-opened preview is answered with 304.
     obj = get_object_or_404(FileUpload, pk=pk)
-    filename = os.path.basename(obj.file.name)
-    content_type, encoding = mimetypes.guess_type(filename)
-    if not content_type:
-        content_type = 'application/octet-stream'
-
-    file_handle = obj.file.open('rb')
-    response = FileResponse(file_handle, content_type=content_type)
-    response['Content-Disposition'] = f'inline; filename="{smart_str(filename)}"'
+    response = serve_file(request, obj, as_attachment=False)
     # Allow same-origin embedding for previews (development only).
     response['X-Frame-Options'] = 'SAMEORIGIN'
     return response
@@ -217,16 +339,90 @@ def preview_file(request, pk):
 preview_file = login_required(preview_file)
 
 
+# Async versions of download_file and preview_file, routed instead of them
+# when ASYNC_FILE_VIEWS is on (sitefiles/asgi.py turns it on). The row and
+# the session user come from the async ORM and the file is streamed in
+# bounded non-blocking chunks, so a slow client ties up a coroutine rather
+# than a whole worker. Under WSGI keep the sync views: there an async body
+# would be read into memory before it is sent.
+
+async def adownload_file(request, pk):
+    obj = await aget_object_or_404(FileUpload, pk=pk)
+    return await aserve_file(request, obj, as_attachment=True, count_download=True)
+
+
+async def apreview_file(request, pk):
+    obj = await aget_object_or_404(FileUpload, pk=pk)
+    response = await aserve_file(request, obj, as_attachment=False)
+    response['X-Frame-Options'] = 'SAMEORIGIN'
+    return response
+
+
+# login_required awaits request.auser() for async views.
+adownload_file = login_required(adownload_file)
+apreview_file = login_required(apreview_file)
+
+
+def thumbnail(request, pk):
+    # Card thumbnail; generated and stored on first request if the background
+    # job hasn't produced it yet.
+    obj = get_object_or_404(FileUpload, pk=pk)
+    if not obj.thumbnail and not (obj.thumbnail_supported and thumbnails.generate(obj)):
+        raise Http404('No thumbnail for this file')
+    # Keyed on the file contents: a replaced file gets a new thumbnail, whose
+    # storage name may well repeat the old one's.
+    etag = f'"{obj.checksum[:16]}-{os.path.basename(obj.thumbnail.name)}"'
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+    response = FileResponse(obj.thumbnail.open('rb'), content_type='image/webp')
+    response['ETag'] = etag
+    # The URL stays the same when the file is replaced, so browsers keep the
+    # image but revalidate it (a cheap 304 while the ETag still matches).
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+thumbnail = login_required(thumbnail)
+
+
+def metrics(request):
+    # Request metrics in Prometheus text format (files/metrics.py). Staff can
+    # open it in a browser; a scraper sends `Authorization: Bearer <METRICS_TOKEN>`.
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    authorized = request.user.is_authenticated and request.user.is_staff
+    if not authorized and token:
+        authorized = constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not authorized:
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+    response = HttpResponse(perf_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+def signed_media(request, token):
+    # Serve a file for a signed URL issued by SignedFileSystemStorage (the local
+    # stand-in for CDN delivery). The signature, not the session, grants access.
+    payload = load_signed_token(token)
+    if payload is None:
+        raise Http404('Link expired or invalid')
+    storage = FileUpload._meta.get_field('file').storage
+    try:
+        file_handle = storage.open(payload['n'], 'rb')
+    except FileNotFoundError:
+        raise Http404('File not found')
+    filename = payload['f'] or os.path.basename(payload['n'])
+    return FileResponse(file_handle, as_attachment=payload['a'], filename=filename)
+
+
 def preview_page(request, pk):
     # Render a small page that embeds the media file URL in an iframe.
     obj = get_object_or_404(FileUpload, pk=pk)
     # Use the storage-provided URL so the browser can load it directly.
     file_url = obj.file.url
     preview_view_url = reverse('files:preview', args=[pk])
-    # Try to guess a MIME type for rendering decisions in the template.
-    content_type, encoding = mimetypes.guess_type(obj.file.name)
-    if not content_type:
-        content_type = 'application/octet-stream'
+    # Stored MIME type drives the rendering decisions in the template.
+    content_type = obj.get_content_type()
     # Precompute simple flags so template logic stays simple and valid.
     is_image = content_type.startswith('image')
     is_pdf = 'pdf' in content_type
@@ -0,0 +1,18 @@
+"""ASGI config for the project.
+Exposes the ASGI callable as a module-level variable named `application`.
+Run it with an ASGI server, e.g.
+`gunicorn sitefiles.asgi:application -k uvicorn_worker.UvicornWorker -w 2`.
+"""
+import os
+# os is used to set the default settings module.
+from django.core.asgi import get_asgi_application
+# get_asgi_application returns an ASGI callable for deployment.
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sitefiles.settings')
+# Ensure the settings module is set for ASGI servers.
+os.environ.setdefault('ASYNC_FILE_VIEWS', '1')
+# Route downloads and previews to the async views, which stream without
+# holding a thread per client.
+
+application = get_asgi_application()
+# The ASGI application used by deployment servers to forward requests to Django.
@@ -36,6 +36,8 @@ INSTALLED_APPS = [
 
 # Middleware processes requests/responses; keep Django defaults for now.
 MIDDLEWARE = [
+    # First, so its timings and query counts cover all other middleware.
+    'files.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -65,14 +67,37 @@ TEMPLATES = [
     },
 ]
 
-# WSGI application path for deployment servers.
+# WSGI and ASGI application paths for deployment servers.
 WSGI_APPLICATION = 'sitefiles.wsgi.application'
+ASGI_APPLICATION = 'sitefiles.asgi.application'
 
 # Database configuration: using SQLite for simplicity.
+# SQLite tuned for several gunicorn workers writing at once:
+# - WAL lets readers carry on while one connection writes, and with
+#   synchronous=NORMAL a commit no longer waits for an fsync (a power cut can
+#   lose the last commits, never corrupt the file);
+# - mmap and a larger page cache (negative = KiB) cut read syscalls;
+# - transactions start with BEGIN IMMEDIATE, so a transaction that reads and
+#   then writes queues for the write lock up front instead of failing with
+#   "database is locked" when it tries to upgrade;
+# - `timeout` is how long a connection waits for that lock before giving up.
+# `manage.py bench_sqlite_writes` compares this with SQLite's defaults.
+SQLITE_INIT_COMMAND = (
+    'PRAGMA journal_mode=WAL;'
+    'PRAGMA synchronous=NORMAL;'
+    'PRAGMA mmap_size=134217728;'
+    'PRAGMA cache_size=-20000;'
+    'PRAGMA temp_store=MEMORY'
+)
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'init_command': SQLITE_INIT_COMMAND,
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': int(os.environ.get('SQLITE_TIMEOUT', '20')),
+        },
     }
 }
 
@@ -127,3 +152,95 @@ else:
     EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
     DEFAULT_FROM_EMAIL = 'no-reply@fourahbay.example'
 
+
+# Download counts are buffered per process and written in batches (files/counters.py).
+# Set the interval to 0 to write each download straight to the database.
+DOWNLOAD_COUNT_FLUSH_INTERVAL = float(os.environ.get('DOWNLOAD_COUNT_FLUSH_INTERVAL', '5'))
+DOWNLOAD_COUNT_MAX_PENDING = int(os.environ.get('DOWNLOAD_COUNT_MAX_PENDING', '500'))
+
+# Online database snapshots (files/backup.py): compressed copies in db_backups/,
+# taken every DB_BACKUP_INTERVAL seconds or after DB_BACKUP_WRITES logins/registrations.
+# Set DB_BACKUP_IN_PROCESS to False when `manage.py backup_db --loop` runs separately.
+DB_BACKUP_DIR = BASE_DIR / 'db_backups'
+DB_BACKUP_INTERVAL = int(os.environ.get('DB_BACKUP_INTERVAL', '3600'))
+DB_BACKUP_WRITES = int(os.environ.get('DB_BACKUP_WRITES', '50'))
+DB_BACKUP_KEEP = int(os.environ.get('DB_BACKUP_KEEP', '20'))
+DB_BACKUP_IN_PROCESS = os.environ.get('DB_BACKUP_IN_PROCESS', 'True') == 'True'
+# Seconds after which an untouched snapshot lock is treated as left behind by a crashed process.
+DB_BACKUP_LOCK_STALE = int(os.environ.get('DB_BACKUP_LOCK_STALE', '600'))
+
+# How download/preview bytes are delivered (files/responses.py):
+#   'proxy'    - Django streams the file (default; supports Range itself).
+#   'sendfile' - Django checks auth and sets headers, then the front server sends
+#                the file: X-Accel-Redirect for nginx, X-Sendfile for apache/lighttpd.
+#                Only applies to local FileSystemStorage files.
+#   'redirect' - count the download, then 302 to a signed, expiring storage URL
+#                (Cloudinary in production). For a local stand-in, set the default
+#                storage backend to 'files.storage.SignedFileSystemStorage'.
+FILE_DELIVERY = os.environ.get('FILE_DELIVERY', 'proxy')
+SENDFILE_SERVER = os.environ.get('SENDFILE_SERVER', 'nginx')
+# nginx `internal` location that maps to MEDIA_ROOT (see README).
+SENDFILE_URL_PREFIX = os.environ.get('SENDFILE_URL_PREFIX', '/protected-media/')
+# Lifetime of signed URLs in 'redirect' mode; cached URLs are replaced
+# SIGNED_URL_REFRESH_MARGIN seconds before they expire.
+SIGNED_URL_TTL = int(os.environ.get('SIGNED_URL_TTL', '600'))
+SIGNED_URL_REFRESH_MARGIN = int(os.environ.get('SIGNED_URL_REFRESH_MARGIN', '60'))
+
+# Cache for rendered catalog pages, signed URLs and thumbnail failures. The file
+# cache is shared by all workers on a host; CACHE_BACKEND=locmem keeps one per
+# process (catalog pages stay correct because their version lives in the database).
+if os.environ.get('CACHE_BACKEND', 'file') == 'locmem':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'mining-portal',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('CACHE_DIR', str(BASE_DIR / 'django_cache')),
+            'OPTIONS': {'MAX_ENTRIES': 5000},
+        }
+    }
+# Seconds a rendered catalog page is kept (files/catalog.py); 0 disables it.
+CATALOG_CACHE_TTL = int(os.environ.get('CATALOG_CACHE_TTL', '600'))
+
+# Admin user exports (files/exports.py): selections larger than the threshold are
+# written to EXPORT_DIR in the background and downloaded from a link when ready.
+EXPORT_DIR = BASE_DIR / 'exports'
+EXPORT_ASYNC_THRESHOLD = int(os.environ.get('EXPORT_ASYNC_THRESHOLD', '5000'))
+EXPORT_KEEP_SECONDS = int(os.environ.get('EXPORT_KEEP_SECONDS', '86400'))
+
+# Bulk password resets (files/passwords.py): hashing processes (0 = one per CPU),
+# and the selection size above which the admin runs the reset in the background.
+PASSWORD_RESET_WORKERS = int(os.environ.get('PASSWORD_RESET_WORKERS', '0'))
+PASSWORD_RESET_ASYNC_THRESHOLD = int(os.environ.get('PASSWORD_RESET_ASYNC_THRESHOLD', '50'))
+
+# Hash uploads while they stream in, so identical files can be stored once
+# (files/uploadhandlers.py, files/blobs.py).
+FILE_UPLOAD_HANDLERS = [
+    'files.uploadhandlers.HashingMemoryFileUploadHandler',
+    'files.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+
+# Resumable chunked uploads from the admin add form (files/chunked.py). The web
+# server's request body limit must allow one chunk.
+CHUNKED_UPLOAD_DIR = BASE_DIR / 'upload_chunks'
+CHUNKED_UPLOAD_CHUNK_SIZE = int(os.environ.get('CHUNKED_UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+CHUNKED_UPLOAD_MAX_SIZE = int(os.environ.get('CHUNKED_UPLOAD_MAX_SIZE', str(2 * 1024 ** 3)))
+CHUNKED_UPLOAD_EXPIRE_SECONDS = int(os.environ.get('CHUNKED_UPLOAD_EXPIRE_SECONDS', '86400'))
+
+# Raw download events (files.models.DownloadEvent) older than this are deleted by
+# `manage.py rollup_downloads` once they are in the daily summaries.
+DOWNLOAD_EVENT_RETENTION_DAYS = int(os.environ.get('DOWNLOAD_EVENT_RETENTION_DAYS', '90'))
+
+# Per-request metrics (files/metrics.py) served at /metrics to staff, or to a
+# scraper sending `Authorization: Bearer <METRICS_TOKEN>`.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Serve downloads and previews with the async views (files/views.py). Set by
+# sitefiles/asgi.py; leave off under WSGI (gunicorn sync workers, runserver).
+ASYNC_FILE_VIEWS = os.environ.get('ASYNC_FILE_VIEWS', '0') == '1'
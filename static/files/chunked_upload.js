@@ -0,0 +1,191 @@
+// Resumable chunked uploads for the admin "Add file upload" form (see
+// files/chunked.py). Files bigger than one chunk are sent in pieces, each
+// with its SHA-256, and the rest of the form is posted once the server has
+// the whole file. After a dropped connection or a page reload the server is
+// asked how much it already has and the upload carries on from there.
+(function () {
+  'use strict';
+  var script = document.currentScript;
+  var startUrl = script.dataset.startUrl;
+  var chunkSize = parseInt(script.dataset.chunkSize, 10);
+  var maxSize = parseInt(script.dataset.maxSize, 10);
+  var form = document.getElementById('fileupload_form');
+  var input = form && form.querySelector('input[type=file][name=file]');
+  if (!input || !window.fetch || !window.Promise) {
+    return;  // plain multipart POST
+  }
+  var csrf = form.querySelector('input[name=csrfmiddlewaretoken]').value;
+  var status = document.createElement('p');
+  status.className = 'help';
+  input.parentNode.appendChild(status);
+  var busy = false;
+  var MAX_RETRIES = 8;
+
+  function storageKey(file) {
+    return 'chunked-upload:' + [file.name, file.size, file.lastModified].join(':');
+  }
+
+  function sleep(ms) {
+    return new Promise(function (resolve) { setTimeout(resolve, ms); });
+  }
+
+  function sha256(blob) {
+    // crypto.subtle only exists on HTTPS/localhost; without it chunks go unchecked.
+    if (!(window.crypto && window.crypto.subtle)) {
+      return Promise.resolve('');
+    }
+    return blob.arrayBuffer()
+      .then(function (buf) { return window.crypto.subtle.digest('SHA-256', buf); })
+      .then(function (digest) {
+        return Array.prototype.map.call(new Uint8Array(digest), function (b) {
+          return ('0' + b.toString(16)).slice(-2);
+        }).join('');
+      });
+  }
+
+  function request(url, options) {
+    options.credentials = 'same-origin';
+    options.headers = Object.assign({'X-CSRFToken': csrf}, options.headers || {});
+    return fetch(url, options).then(function (response) {
+      return response.json().catch(function () { return {}; }).then(function (data) {
+        return {status: response.status, ok: response.ok, data: data};
+      });
+    });
+  }
+
+  // Retry network failures (not HTTP errors) with backoff.
+  function withRetry(send, attempt) {
+    attempt = attempt || 0;
+    return send().catch(function (err) {
+      if (attempt >= MAX_RETRIES) {
+        throw err;
+      }
+      status.textContent = 'Connection lost, retrying…';
+      return sleep(Math.min(30000, 1000 * Math.pow(2, attempt))).then(function () {
+        return withRetry(send, attempt + 1);
+      });
+    });
+  }
+
+  function openSession(file) {
+    var key = storageKey(file);
+    var saved = window.localStorage && localStorage.getItem(key);
+    var resume = saved
+      ? withRetry(function () { return request(saved, {method: 'GET'}); })
+      : Promise.resolve({ok: false});
+    return resume.then(function (r) {
+      if (r.ok) {
+        return r.data;
+      }
+      var body = new FormData();
+      body.append('filename', file.name);
+      body.append('size', file.size);
+      return withRetry(function () { return request(startUrl, {method: 'POST', body: body}); }).then(function (r) {
+        if (!r.ok) {
+          throw new Error(r.data.error || 'Could not start the upload.');
+        }
+        if (window.localStorage) {
+          localStorage.setItem(key, r.data.url);
+        }
+        return r.data;
+      });
+    });
+  }
+
+  function sendChunks(file, session) {
+    var offset = session.offset;
+    var failures = 0;
+
+    function next() {
+      status.textContent = 'Uploaded ' + Math.floor(100 * offset / file.size) + '%';
+      if (offset >= file.size) {
+        return Promise.resolve();
+      }
+      var chunk = file.slice(offset, Math.min(offset + session.chunk_size, file.size));
+      return sha256(chunk).then(function (checksum) {
+        var headers = {'X-Chunk-Offset': String(offset), 'Content-Type': 'application/octet-stream'};
+        if (checksum) {
+          headers['X-Chunk-SHA256'] = checksum;
+        }
+        return withRetry(function () { return request(session.url, {method: 'PUT', headers: headers, body: chunk}); });
+      }).then(function (r) {
+        if (r.ok) {
+          failures = 0;
+          offset = r.data.offset;
+        } else if (typeof r.data.offset === 'number' && failures++ < MAX_RETRIES) {
+          offset = r.data.offset;  // resend from wherever the server is
+        } else {
+          throw new Error(r.data.error || 'Upload failed (' + r.status + ').');
+        }
+        return next();
+      });
+    }
+    return next();
+  }
+
+  function complete(file, session, submitter) {
+    var data = new FormData(form);
+    data.delete('file');
+    return withRetry(function () {
+      return request(session.url + 'complete/', {method: 'POST', body: data});
+    }).then(function (r) {
+      if (r.status === 400 && r.data.errors) {
+        // The file stays on the server; fix the fields and save again.
+        throw new Error(Object.keys(r.data.errors).map(function (field) {
+          return field + ': ' + r.data.errors[field].map(function (e) { return e.message; }).join(' ');
+        }).join('; '));
+      }
+      if (!r.ok) {
+        throw new Error(r.data.error || 'Could not save the upload (' + r.status + ').');
+      }
+      if (window.localStorage) {
+        localStorage.removeItem(storageKey(file));
+      }
+      var name = submitter && submitter.name;
+      if (name === '_continue') {
+        window.location.href = r.data.url;
+      } else if (name === '_addanother') {
+        window.location.reload();
+      } else {
+        window.location.href = new URL('../', window.location.href).href;
+      }
+    });
+  }
+
+  function warnOnLeave(event) {
+    event.preventDefault();
+    event.returnValue = '';
+  }
+
+  form.addEventListener('submit', function (event) {
+    var file = input.files && input.files[0];
+    if (!file || file.size <= chunkSize) {
+      return;  // small enough for the normal form POST
+    }
+    event.preventDefault();
+    if (busy) {
+      return;
+    }
+    if (file.size > maxSize) {
+      status.textContent = 'This file is larger than the ' + Math.round(maxSize / 1048576) + ' MB limit.';
+      return;
+    }
+    busy = true;
+    window.addEventListener('beforeunload', warnOnLeave);
+    openSession(file)
+      .then(function (session) {
+        return sendChunks(file, session).then(function () {
+          status.textContent = 'Saving…';
+          window.removeEventListener('beforeunload', warnOnLeave);
+          return complete(file, session, event.submitter);
+        });
+      })
+      .catch(function (err) {
+        status.textContent = err.message + ' Save again to resume.';
+      })
+      .then(function () {
+        busy = false;
+        window.removeEventListener('beforeunload', warnOnLeave);
+      });
+  });
+})();